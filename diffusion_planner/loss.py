@@ -3,7 +3,10 @@ from typing import Any, Callable, Dict, Tuple
 import torch
 import torch.nn as nn
 
+import diffusion_planner.model.diffusion_utils.dpm_solver_pytorch as dpm
+from diffusion_planner.model.module.decoder import DIFFUSION_PRIOR_STD
 from diffusion_planner.utils.normalizer import StateNormalizer
+from diffusion_planner.utils.time_sampler import TimeSampler
 
 
 def diffusion_loss_func(
@@ -15,6 +18,7 @@ def diffusion_loss_func(
     loss: Dict[str, Any],
     model_type: str,
     eps: float = 1e-3,
+    time_sampler: TimeSampler = None,
 ):
     ego_future, neighbors_future, neighbor_future_mask = futures
     neighbors_future_valid = ~neighbor_future_mask  # [B, P, V]
@@ -35,7 +39,11 @@ def diffusion_loss_func(
     current_states = torch.cat([ego_current[:, None], neighbors_current], dim=1)  # [B, P, 4]
 
     P = gt_future.shape[1]
-    t = torch.rand(B, device=gt_future.device) * (1 - eps) + eps  # [B,]
+    if time_sampler is None:
+        t = torch.rand(B, device=gt_future.device) * (1 - eps) + eps  # [B,]
+        weight = None
+    else:
+        t, weight = time_sampler.sample(B, gt_future.device)  # [B,], [B,]
     z = torch.randn_like(gt_future, device=gt_future.device)  # [B, P, T, 4]
 
     all_gt = torch.cat([current_states[:, :, None, :], norm(gt_future)], dim=2)
@@ -71,6 +79,17 @@ def diffusion_loss_func(
         target_v = all_gt[:, :, 1:, :] - z
         dpm_loss = torch.sum((score - target_v) ** 2, dim=-1)
 
+    if time_sampler is not None:
+        # unweighted per-sample loss for the time histogram
+        neighbor_valid_num = neighbors_future_valid.sum(dim=(1, 2))
+        neighbor_sample_loss = (dpm_loss[:, 1:, :] * neighbors_future_valid).sum(dim=(1, 2)) / (
+            neighbor_valid_num.clamp(min=1)
+        )
+        time_sampler.update(t.reshape(-1), dpm_loss[:, 0, :].mean(dim=-1) + neighbor_sample_loss)
+
+    if weight is not None:
+        dpm_loss = dpm_loss * weight[:, None, None]
+
     masked_prediction_loss = dpm_loss[:, 1:, :][neighbors_future_valid]
 
     if masked_prediction_loss.numel() > 0:
@@ -83,3 +102,129 @@ def diffusion_loss_func(
     assert not torch.isnan(dpm_loss).sum(), f"loss cannot be nan, z={z}"
 
     return loss, decoder_output
+
+
+def progressive_distillation_loss_func(
+    model: nn.Module,
+    inputs: Dict[str, torch.Tensor],
+    futures: Tuple[torch.Tensor, torch.Tensor],
+    norm: StateNormalizer,
+    loss: Dict[str, Any],
+    model_type: str,
+    teacher: nn.Module,
+    student_steps: int,
+    skip_type: str = "logSNR",
+):
+    """
+    Progressive distillation (Salimans & Ho, 2022): one sampler step of the student matches two
+    sampler steps of the teacher, so the student samples in `student_steps` steps what the
+    teacher samples in 2 * `student_steps`.
+
+    x_start: DDIM (DPM-Solver-1) steps on the `skip_type` grid of DPM_Solver, the target is the
+        x_0 for which one student step lands where the two teacher steps land.
+    flow_matching: Euler steps on the uniform grid, the target is the mean teacher velocity.
+
+    The states on the student grid are drawn from the forward process with the prior std of the
+    sampler. The teacher is frozen (eval mode).
+    """
+    ego_future, neighbors_future, neighbor_future_mask = futures
+    neighbors_future_valid = ~neighbor_future_mask  # [B, P, V]
+
+    B, Pn, T, _ = neighbors_future.shape
+    ego_current, neighbors_current = (
+        inputs["ego_current_state"][:, :4],
+        inputs["neighbor_agents_past"][:, :Pn, -1, :4],
+    )
+    neighbor_current_mask = torch.sum(torch.ne(neighbors_current[..., :4], 0), dim=-1) == 0
+    neighbor_mask = torch.concat(
+        (neighbor_current_mask.unsqueeze(-1), neighbor_future_mask), dim=-1
+    )
+
+    gt_future = torch.cat([ego_future[:, None, :, :], neighbors_future[..., :]], dim=1)
+    current_states = torch.cat([ego_current[:, None], neighbors_current], dim=1)  # [B, P, 4]
+    P = gt_future.shape[1]
+    device = gt_future.device
+
+    all_gt = torch.cat([current_states[:, :, None, :], norm(gt_future)], dim=2)
+    all_gt[:, 1:][neighbor_mask] = 0.0
+    z = torch.randn_like(all_gt[:, :, 1:, :])  # [B, P, T, 4]
+    step = torch.randint(0, student_steps, (B,), device=device)
+
+    def with_current(x):
+        # the current states are not sampled
+        return torch.cat([all_gt[:, :, :1, :], x], dim=2)
+
+    with torch.no_grad():
+        teacher_decoder = teacher.decoder.decoder
+        model_condition = teacher_decoder.model_condition(
+            teacher.encoder(inputs)["encoding"], inputs["route_lanes"], neighbor_current_mask
+        )
+
+        def teacher_fn(x, t):
+            return teacher_decoder.dit(x.reshape(B, P, -1), t, **model_condition).reshape(
+                B, P, -1, 4
+            )[:, :, 1:]
+
+        if model_type == "flow_matching":
+            # t=0 is noise, t=1 is data
+            dt = 1.0 / student_steps
+            s = step.float() * dt
+            s_ = s[:, None, None, None]
+            x_s = (1 - s_) * z + s_ * all_gt[:, :, 1:, :]
+            v_1 = teacher_fn(with_current(x_s), s)
+            x_mid = x_s + v_1 * dt / 2
+            v_2 = teacher_fn(with_current(x_mid), s + dt / 2)
+            target = (v_1 + v_2) / 2
+        elif model_type == "x_start":
+            ns = dpm.NoiseScheduleVP()
+            solver = dpm.DPM_Solver(None, ns)
+            t_0, t_T = 1.0 / ns.total_N, ns.T
+            teacher_times = solver.get_time_steps(skip_type, t_T, t_0, 2 * student_steps, device)
+            s, t_mid, t = (
+                teacher_times[2 * step],
+                teacher_times[2 * step + 1],
+                teacher_times[2 * step + 2],
+            )
+
+            def coefficients(t):
+                return [
+                    v[:, None, None, None]
+                    for v in (ns.marginal_alpha(t), ns.marginal_std(t), ns.marginal_lambda(t))
+                ]
+
+            def ddim(x, x_0, s, t):
+                _, sigma_s, lambda_s = coefficients(s)
+                alpha_t, sigma_t, lambda_t = coefficients(t)
+                return sigma_t / sigma_s * x - alpha_t * torch.expm1(lambda_s - lambda_t) * x_0
+
+            alpha_s, sigma_s, lambda_s = coefficients(s)
+            x_s = alpha_s * all_gt[:, :, 1:, :] + sigma_s * DIFFUSION_PRIOR_STD * z
+            x_mid = ddim(x_s, teacher_fn(with_current(x_s), s), s, t_mid)
+            x_t = ddim(x_mid, teacher_fn(with_current(x_mid), t_mid), t_mid, t)
+            # the x_0 of a single student step from s to t
+            alpha_t, sigma_t, lambda_t = coefficients(t)
+            target = (sigma_t / sigma_s * x_s - x_t) / (alpha_t * torch.expm1(lambda_s - lambda_t))
+        else:
+            raise ValueError(f"Progressive distillation does not support {model_type} models")
+
+    merged_inputs = {
+        **inputs,
+        "sampled_trajectories": with_current(x_s),
+        "diffusion_time": s,
+    }
+    _, decoder_output = model(merged_inputs)  # [B, P, 1 + T, 4]
+    prediction = decoder_output["score"][:, :, 1:, :]  # [B, P, T, 4]
+
+    dpm_loss = torch.sum((prediction - target) ** 2, dim=-1)
+
+    masked_prediction_loss = dpm_loss[:, 1:, :][neighbors_future_valid]
+    if masked_prediction_loss.numel() > 0:
+        loss["neighbor_prediction_loss"] = masked_prediction_loss.mean()
+    else:
+        loss["neighbor_prediction_loss"] = torch.tensor(0.0, device=masked_prediction_loss.device)
+
+    loss["ego_planning_loss"] = dpm_loss[:, 0, :].mean()
+
+    assert not torch.isnan(dpm_loss).sum(), "loss cannot be nan"
+
+    return loss, decoder_output
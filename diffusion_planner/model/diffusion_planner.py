@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 
+from diffusion_planner.model.diffusion_utils.sampling import Deadline
 from diffusion_planner.model.module.decoder import Decoder
 from diffusion_planner.model.module.encoder import Encoder
 
@@ -16,9 +17,20 @@ class Diffusion_Planner(nn.Module):
     def sde(self):
         return self.decoder.decoder.sde
 
-    def forward(self, inputs):
+    def forward(self, inputs, num_samples=1, score_fn=None, warm_start=None, time_budget=None):
+        """
+        num_samples, score_fn: draw several plans per scene and select one (inference only),
+            see Decoder.forward
+        warm_start: start the sampler from a previous prediction (inference only),
+            see Decoder.forward
+        time_budget: [s] of the whole inference, the sampler is truncated to meet it (inference
+            only), see Decoder.forward
+        """
+        deadline = Deadline(time_budget) if time_budget is not None else None
         encoder_outputs = self.encoder(inputs)
-        decoder_outputs = self.decoder(encoder_outputs, inputs)
+        decoder_outputs = self.decoder(
+            encoder_outputs, inputs, num_samples, score_fn, warm_start, deadline
+        )
 
         return encoder_outputs, decoder_outputs
 
@@ -94,7 +106,11 @@ class Diffusion_Planner_Decoder(nn.Module):
         nn.init.constant_(self.decoder.dit.final_layer.proj[-1].weight, 0)
         nn.init.constant_(self.decoder.dit.final_layer.proj[-1].bias, 0)
 
-    def forward(self, encoder_outputs, inputs):
-        decoder_outputs = self.decoder(encoder_outputs, inputs)
+    def forward(
+        self, encoder_outputs, inputs, num_samples=1, score_fn=None, warm_start=None, deadline=None
+    ):
+        decoder_outputs = self.decoder(
+            encoder_outputs, inputs, num_samples, score_fn, warm_start, deadline
+        )
 
         return decoder_outputs
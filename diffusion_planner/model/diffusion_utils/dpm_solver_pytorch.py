@@ -131,8 +131,12 @@ def model_wrapper(
 
             The input `classifier_fn` has the following format:
             ``
-                classifier_fn(x, t_input, cond, **classifier_kwargs) -> logits(x, t_input, cond)
+                classifier_fn(x, t_input, cond, model_output, **classifier_kwargs) -> logits(x, t_input, cond)
             ``
+            `model_output` is the (detached) output of `model` at (x, t_input), which the solver evaluates
+            anyway, so the classifier does not need to run the model again.
+            If `classifier_fn` has a method `is_active(t_input) -> bool`, the classifier gradient is only
+            computed when it returns True (it is zero otherwise).
 
             [3] P. Dhariwal and A. Q. Nichol, "Diffusion models beat GANs on image synthesis,"
                 in Advances in Neural Information Processing Systems, vol. 34, 2021, pp. 8780-8794.
@@ -179,10 +183,10 @@ def model_wrapper(
         A noise prediction model that accepts the noised data and the continuous time as the inputs.
     """
 
-    def noise_pred_fn(x, t_continuous, cond=None):
-        if cond is None:
+    def noise_pred_fn(x, t_continuous, cond=None, output=None):
+        if output is None and cond is None:
             output = model(x, t_continuous, **model_kwargs)
-        else:
+        elif output is None:
             output = model(x, t_continuous, cond, **model_kwargs)
         if model_type == "noise":
             return output
@@ -202,13 +206,15 @@ def model_wrapper(
             sigma_t = noise_schedule.marginal_std(t_continuous)
             return -expand_dims(sigma_t, x.dim()) * output
 
-    def cond_grad_fn(x, t_input):
+    def cond_grad_fn(x, t_input, model_output):
         """
         Compute the gradient of the classifier, i.e. nabla_{x} log p_t(cond | x_t).
         """
         with torch.enable_grad():
             x_in = x.detach().requires_grad_(True)
-            log_prob = classifier_fn(x_in, t_input, condition, **classifier_kwargs)
+            log_prob = classifier_fn(
+                x_in, t_input, condition, model_output.detach(), **classifier_kwargs
+            )
             return torch.autograd.grad(log_prob.sum(), x_in)[0]
 
     def model_fn(x, t_continuous):
@@ -219,9 +225,13 @@ def model_wrapper(
             return noise_pred_fn(x, t_continuous)
         elif guidance_type == "classifier":
             assert classifier_fn is not None
-            cond_grad = cond_grad_fn(x, t_continuous)
+            output = model(x, t_continuous, **model_kwargs)
+            noise = noise_pred_fn(x, t_continuous, output=output)
+            is_active = getattr(classifier_fn, "is_active", None)
+            if is_active is not None and not is_active(t_continuous):
+                return noise
+            cond_grad = cond_grad_fn(x, t_continuous, output)
             sigma_t = noise_schedule.marginal_std(t_continuous)
-            noise = noise_pred_fn(x, t_continuous)
             return noise - guidance_scale * expand_dims(sigma_t, x.dim()) * cond_grad
         elif guidance_type == "classifier-free":
             if guidance_scale == 1.0 or unconditional_condition is None:
@@ -483,6 +493,121 @@ class DPM_Solver:
         else:
             return x_t
 
+    def singlestep_dpm_solver_second_update(self, x, s, t, r1=0.5, model_s=None):
+        """
+        Singlestep solver DPM-Solver-2 from time `s` to time `t`.
+
+        Args:
+            x: A pytorch tensor. The initial value at time `s`.
+            s: A pytorch tensor. The starting time, with the shape (1,).
+            t: A pytorch tensor. The ending time, with the shape (1,).
+            r1: A `float`. The hyperparameter of the second-order solver.
+            model_s: A pytorch tensor. The model function evaluated at time `s`.
+                If `model_s` is None, we evaluate the model by `x` and `s`; otherwise we directly use it.
+        Returns:
+            x_t: A pytorch tensor. The approximated solution at time `t`.
+        """
+        ns = self.noise_schedule
+        lambda_s, lambda_t = ns.marginal_lambda(s), ns.marginal_lambda(t)
+        h = lambda_t - lambda_s
+        lambda_s1 = lambda_s + r1 * h
+        s1 = ns.inverse_lambda(lambda_s1)
+        sigma_s, sigma_s1, sigma_t = ns.marginal_std(s), ns.marginal_std(s1), ns.marginal_std(t)
+        alpha_s1 = torch.exp(ns.marginal_log_mean_coeff(s1))
+        alpha_t = torch.exp(ns.marginal_log_mean_coeff(t))
+
+        phi_11 = torch.expm1(-r1 * h)
+        phi_1 = torch.expm1(-h)
+
+        if model_s is None:
+            model_s = self.model_fn(x, s)
+        x_s1 = (sigma_s1 / sigma_s) * x - (alpha_s1 * phi_11) * model_s
+        model_s1 = self.model_fn(x_s1, s1)
+        x_t = (
+            (sigma_t / sigma_s) * x
+            - (alpha_t * phi_1) * model_s
+            - (0.5 / r1) * (alpha_t * phi_1) * (model_s1 - model_s)
+        )
+        return x_t
+
+    def singlestep_dpm_solver_third_update(self, x, s, t, r1=1.0 / 3.0, r2=2.0 / 3.0, model_s=None):
+        """
+        Singlestep solver DPM-Solver-3 from time `s` to time `t`.
+
+        Args:
+            x: A pytorch tensor. The initial value at time `s`.
+            s: A pytorch tensor. The starting time, with the shape (1,).
+            t: A pytorch tensor. The ending time, with the shape (1,).
+            r1: A `float`. The hyperparameter of the third-order solver.
+            r2: A `float`. The hyperparameter of the third-order solver.
+            model_s: A pytorch tensor. The model function evaluated at time `s`.
+                If `model_s` is None, we evaluate the model by `x` and `s`; otherwise we directly use it.
+        Returns:
+            x_t: A pytorch tensor. The approximated solution at time `t`.
+        """
+        ns = self.noise_schedule
+        lambda_s, lambda_t = ns.marginal_lambda(s), ns.marginal_lambda(t)
+        h = lambda_t - lambda_s
+        lambda_s1 = lambda_s + r1 * h
+        lambda_s2 = lambda_s + r2 * h
+        s1 = ns.inverse_lambda(lambda_s1)
+        s2 = ns.inverse_lambda(lambda_s2)
+        sigma_s, sigma_s1, sigma_s2, sigma_t = (
+            ns.marginal_std(s),
+            ns.marginal_std(s1),
+            ns.marginal_std(s2),
+            ns.marginal_std(t),
+        )
+        alpha_s1 = torch.exp(ns.marginal_log_mean_coeff(s1))
+        alpha_s2 = torch.exp(ns.marginal_log_mean_coeff(s2))
+        alpha_t = torch.exp(ns.marginal_log_mean_coeff(t))
+
+        phi_11 = torch.expm1(-r1 * h)
+        phi_12 = torch.expm1(-r2 * h)
+        phi_1 = torch.expm1(-h)
+        phi_22 = torch.expm1(-r2 * h) / (r2 * h) + 1.0
+        phi_2 = phi_1 / h + 1.0
+
+        if model_s is None:
+            model_s = self.model_fn(x, s)
+        x_s1 = (sigma_s1 / sigma_s) * x - (alpha_s1 * phi_11) * model_s
+        model_s1 = self.model_fn(x_s1, s1)
+        x_s2 = (
+            (sigma_s2 / sigma_s) * x
+            - (alpha_s2 * phi_12) * model_s
+            + r2 / r1 * (alpha_s2 * phi_22) * (model_s1 - model_s)
+        )
+        model_s2 = self.model_fn(x_s2, s2)
+        x_t = (
+            (sigma_t / sigma_s) * x
+            - (alpha_t * phi_1) * model_s
+            + (1.0 / r2) * (alpha_t * phi_2) * (model_s2 - model_s)
+        )
+        return x_t
+
+    def singlestep_dpm_solver_update(self, x, s, t, order, r1=None, r2=None):
+        """
+        Singlestep DPM-Solver with the order `order` from time `s` to time `t`.
+
+        Args:
+            x: A pytorch tensor. The initial value at time `s`.
+            s: A pytorch tensor. The starting time, with the shape (1,).
+            t: A pytorch tensor. The ending time, with the shape (1,).
+            order: A `int`. The order of DPM-Solver. We only support order == 1 or 2 or 3.
+            r1: A `float`. The hyperparameter of the second-order or third-order solver.
+            r2: A `float`. The hyperparameter of the third-order solver.
+        Returns:
+            x_t: A pytorch tensor. The approximated solution at time `t`.
+        """
+        if order == 1:
+            return self.dpm_solver_first_update(x, s, t)
+        elif order == 2:
+            return self.singlestep_dpm_solver_second_update(x, s, t, r1=r1)
+        elif order == 3:
+            return self.singlestep_dpm_solver_third_update(x, s, t, r1=r1, r2=r2)
+        else:
+            raise ValueError("Solver order must be 1 or 2 or 3, got {}".format(order))
+
     def multistep_dpm_solver_second_update(self, x, model_prev_list, t_prev_list, t):
         """
         Multistep solver DPM-Solver-2 from time `t_prev_list[-1]` to time `t`.
@@ -522,6 +647,49 @@ class DPM_Solver:
         )
         return x_t
 
+    def multistep_dpm_solver_third_update(self, x, model_prev_list, t_prev_list, t):
+        """
+        Multistep solver DPM-Solver-3 (DPM-Solver++(3M)) from time `t_prev_list[-1]` to time `t`.
+
+        Args:
+            x: A pytorch tensor. The initial value at time `s`.
+            model_prev_list: A list of pytorch tensor. The previous computed model values.
+            t_prev_list: A list of pytorch tensor. The previous times, each time has the shape (1,)
+            t: A pytorch tensor. The ending time, with the shape (1,).
+        Returns:
+            x_t: A pytorch tensor. The approximated solution at time `t`.
+        """
+        ns = self.noise_schedule
+        model_prev_2, model_prev_1, model_prev_0 = model_prev_list[-3:]
+        t_prev_2, t_prev_1, t_prev_0 = t_prev_list[-3:]
+        lambda_prev_2, lambda_prev_1, lambda_prev_0, lambda_t = (
+            ns.marginal_lambda(t_prev_2),
+            ns.marginal_lambda(t_prev_1),
+            ns.marginal_lambda(t_prev_0),
+            ns.marginal_lambda(t),
+        )
+        sigma_prev_0, sigma_t = ns.marginal_std(t_prev_0), ns.marginal_std(t)
+        alpha_t = torch.exp(ns.marginal_log_mean_coeff(t))
+
+        h_1 = lambda_prev_1 - lambda_prev_2
+        h_0 = lambda_prev_0 - lambda_prev_1
+        h = lambda_t - lambda_prev_0
+        r0, r1 = h_0 / h, h_1 / h
+        D1_0 = (1.0 / r0) * (model_prev_0 - model_prev_1)
+        D1_1 = (1.0 / r1) * (model_prev_1 - model_prev_2)
+        D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+        D2 = (1.0 / (r0 + r1)) * (D1_0 - D1_1)
+        phi_1 = torch.expm1(-h)
+        phi_2 = phi_1 / h + 1.0
+        phi_3 = phi_2 / h - 0.5
+        x_t = (
+            (sigma_t / sigma_prev_0) * x
+            - (alpha_t * phi_1) * model_prev_0
+            + (alpha_t * phi_2) * D1
+            - (alpha_t * phi_3) * D2
+        )
+        return x_t
+
     def multistep_dpm_solver_update(self, x, model_prev_list, t_prev_list, t, order):
         """
         Multistep DPM-Solver with the order `order` from time `t_prev_list[-1]` to time `t`.
@@ -539,10 +707,104 @@ class DPM_Solver:
             return self.dpm_solver_first_update(x, t_prev_list[-1], t, model_s=model_prev_list[-1])
         elif order == 2:
             return self.multistep_dpm_solver_second_update(x, model_prev_list, t_prev_list, t)
+        elif order == 3:
+            return self.multistep_dpm_solver_third_update(x, model_prev_list, t_prev_list, t)
+        else:
+            raise ValueError("Solver order must be 1 or 2 or 3, got {}".format(order))
+
+    def multistep_uni_pc_update(
+        self, x, model_prev_list, t_prev_list, t, order, step, use_corrector
+    ):
+        """
+        UniPC (B(h) = e^h - 1, i.e. "bh2") from time `t_prev_list[-1]` to time `t`: the multistep
+        predictor UniP-`order` and the corrector UniC-`order`.
+
+        The corrector reuses the model value at the predicted `x_t`, which is also the model value
+        of the next step, so the corrector does not increase the number of function evaluations.
+
+        Args:
+            x: A pytorch tensor. The initial value at time `s`.
+            model_prev_list: A list of pytorch tensor. The previous computed model values.
+            t_prev_list: A list of pytorch tensor. The previous times, each time has the shape (1,)
+            t: A pytorch tensor. The ending time, with the shape (1,).
+            order: A `int`. The order of UniPC. We only support order == 1 or 2 or 3.
+            step: A `int`. The step index for `correcting_xt_fn`.
+            use_corrector: A `bool`. If false, only the predictor is used (e.g. for the last step).
+        Returns:
+            x_t: A pytorch tensor. The approximated solution at time `t`.
+            model_t: A pytorch tensor. The model value at the predicted `x_t` (None without the corrector).
+        """
+        ns = self.noise_schedule
+        model_prev_0 = model_prev_list[-1]
+        t_prev_0 = t_prev_list[-1]
+        lambda_prev_0, lambda_t = ns.marginal_lambda(t_prev_0), ns.marginal_lambda(t)
+        sigma_prev_0, sigma_t = ns.marginal_std(t_prev_0), ns.marginal_std(t)
+        alpha_t = torch.exp(ns.marginal_log_mean_coeff(t))
+        h = lambda_t - lambda_prev_0
+
+        rks = []
+        D1s = []
+        for i in range(1, order):
+            rk = (ns.marginal_lambda(t_prev_list[-(i + 1)]) - lambda_prev_0) / h
+            rks.append(rk)
+            D1s.append((model_prev_list[-(i + 1)] - model_prev_0) / rk)
+        rks = torch.stack(rks + [torch.ones_like(h)]).reshape(-1)
+
+        hh = -h
+        h_phi_1 = torch.expm1(hh)
+        h_phi_k = h_phi_1 / hh - 1
+        B_h = torch.expm1(hh)
+        factorial_i = 1
+        R = []
+        b = []
+        for i in range(1, order + 1):
+            R.append(torch.pow(rks, i - 1))
+            b.append(h_phi_k * factorial_i / B_h)
+            factorial_i *= i + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial_i
+        R = torch.stack(R)
+        b = torch.stack(b).reshape(-1)
+
+        x_t_ = sigma_t / sigma_prev_0 * x - alpha_t * h_phi_1 * model_prev_0
+
+        # predictor
+        if order == 1:
+            rhos_p = []
+        elif order == 2:
+            rhos_p = [0.5]
         else:
-            raise ValueError("Solver order must be 1 or 2, got {}".format(order))
+            rhos_p = torch.linalg.solve(R[:-1, :-1], b[:-1])
+        pred_res = sum(rho * D1 for rho, D1 in zip(rhos_p, D1s))
+        x_t = x_t_ - alpha_t * B_h * pred_res
+        if self.correcting_xt_fn is not None:
+            x_t = self.correcting_xt_fn(x_t, t, step)
+        if not use_corrector:
+            return x_t, None
+
+        # corrector
+        rhos_c = [0.5] if order == 1 else torch.linalg.solve(R, b)
+        model_t = self.model_fn(x_t, t)
+        corr_res = sum(rho * D1 for rho, D1 in zip(rhos_c[:-1], D1s))
+        x_t = x_t_ - alpha_t * B_h * (corr_res + rhos_c[-1] * (model_t - model_prev_0))
+        if self.correcting_xt_fn is not None:
+            x_t = self.correcting_xt_fn(x_t, t, step)
+        return x_t, model_t
 
-    def sample(self, x, steps, skip_type="time_uniform"):
+    def sample(
+        self,
+        x,
+        steps,
+        order=2,
+        skip_type="time_uniform",
+        method="multistep",
+        denoise_to_zero=True,
+        t_start=None,
+        early_exit_fn=None,
+        early_exit_tol=0.0,
+        early_exit_min_steps=1,
+        deadline=None,
+        return_info=False,
+    ):
         """
         Compute the sample at time `t_end` by DPM-Solver, given the initial `x` at time `t_start`.
 
@@ -554,7 +816,24 @@ class DPM_Solver:
                 We initialize the first `order` values by lower order multistep solvers.
                 Given a fixed NFE == `steps`, the sampling procedure is:
                     Denote K = steps.
-                    - We firstly use 1 step of DPM-Solver-1, then use (K - 1) step of multistep DPM-Solver-2.
+                    - If `order` == 1:
+                        - We use K steps of DPM-Solver-1 (i.e. DDIM).
+                    - If `order` == 2:
+                        - We firstly use 1 step of DPM-Solver-1, then use (K - 1) step of multistep DPM-Solver-2.
+                    - If `order` == 3:
+                        - We firstly use 1 step of DPM-Solver-1, then 1 step of multistep DPM-Solver-2,
+                          then (K - 2) step of multistep DPM-Solver-3 (i.e. DPM-Solver++(3M)).
+            - 'unipc':
+                Multistep UniPC with the order of `order` (1, 2 or 3). The total number of function evaluations (NFE) == `steps`.
+                Every step but the last one is refined by the corrector UniC, without extra NFE.
+            - 'singlestep':
+                Singlestep DPM-Solver (i.e. "DPM-Solver-fast" in the paper), which combines different orders of singlestep DPM-Solver.
+                We use this method for the final steps in the paper.
+                The total number of function evaluations (NFE) == `steps`.
+                See `get_orders_and_timesteps_for_singlestep_solver` for the detailed order of each step.
+            - 'singlestep_fixed':
+                Fixed order singlestep DPM-Solver (i.e. DPM-Solver-1 or singlestep DPM-Solver-2 or singlestep DPM-Solver-3).
+                We use singlestep DPM-Solver-`order` for `order`=1 or 2 or 3, with total [`steps` // `order`] * `order` NFE.
 
         =====================================================
 
@@ -582,70 +861,176 @@ class DPM_Solver:
             x: A pytorch tensor. The initial value at time `t_start`
                 e.g. if `t_start` == T, then `x` is a sample from the standard normal distribution.
             steps: A `int`. The total number of function evaluations (NFE).
+            order: A `int`. The order of DPM-Solver (1, 2 or 3).
             skip_type: A `str`. The type for the spacing of the time steps. 'time_uniform' or 'logSNR' or 'time_quadratic'.
+            method: A `str`. The method for sampling. 'multistep' or 'singlestep' or 'singlestep_fixed' or 'unipc'.
+            denoise_to_zero: A `bool`. Whether to denoise to time 0 at the final step (one more NFE).
+            t_start: A `float`. The starting time of the sampling, T if None.
+            early_exit_fn: A function `(x0_prev, x0) -> change` with shape [B], the change of the data prediction
+                between consecutive steps ('multistep' and 'unipc' only). The sampling stops after at least
+                `early_exit_min_steps` steps (and `order` steps for 'multistep') once the change of every sample is below `early_exit_tol`, and
+                returns the last data prediction (no denoising to time 0).
+            deadline: A `Deadline` (see sampling.py). The sampling stops like for the early exit once one more step
+                would end after the deadline ('multistep' and 'unipc' only).
+            return_info: A `bool`. Also return {"steps": the number of solver steps run, "truncated": whether the
+                deadline stopped the sampling}.
         Returns:
             x_end: A pytorch tensor. The approximated solution at time `t_end`.
+            info: A `dict`, if `return_info`.
 
         """
-        # Args
-        order = 2
-        method = "multistep"
-        denoise_to_zero = True
-
         t_0 = 1.0 / self.noise_schedule.total_N
-        t_T = self.noise_schedule.T
+        t_T = self.noise_schedule.T if t_start is None else t_start
         assert t_0 > 0 and t_T > 0, (
             "Time range needs to be greater than 0. For discrete-time DPMs, it needs to be in [1 / N, 1], where N is the length of betas array"
         )
         if self.correcting_xt_fn is not None:
-            assert method in ["multistep", "singlestep", "singlestep_fixed"], (
+            assert method in ["multistep", "singlestep", "singlestep_fixed", "unipc"], (
                 "Cannot use adaptive solver when correcting_xt_fn is not None"
             )
+        if early_exit_fn is not None or deadline is not None:
+            assert method in ["multistep", "unipc"], "Early exit needs a multistep method"
+
+        truncated = False
+
+        def converged(x0_prev, x0, step):
+            nonlocal truncated
+            if deadline is not None and deadline.near(x0):
+                truncated = True
+                return True
+            if early_exit_fn is None or step < early_exit_min_steps:
+                return False
+            return bool((early_exit_fn(x0_prev, x0) < early_exit_tol).all())
+
         device = x.device
+        exit_step = None
+        if deadline is not None:
+            deadline.start(x)
         with torch.no_grad():
-            assert steps >= order
-            timesteps = self.get_time_steps(
-                skip_type=skip_type, t_T=t_T, t_0=t_0, N=steps, device=device
-            )
-            assert timesteps.shape[0] - 1 == steps
-            # Init the initial values.
-            step = 0
-            t = timesteps[step]
-            t_prev_list = [t]
-            model_prev_list = [self.model_fn(x, t)]
-            if self.correcting_xt_fn is not None:
-                x = self.correcting_xt_fn(x, t, step)
-            # Init the first `order` values by lower order multistep DPM-Solver.
-            for step in range(1, order):
+            if method == "multistep":
+                assert steps >= order
+                timesteps = self.get_time_steps(
+                    skip_type=skip_type, t_T=t_T, t_0=t_0, N=steps, device=device
+                )
+                assert timesteps.shape[0] - 1 == steps
+                # Init the initial values.
+                step = 0
                 t = timesteps[step]
-                x = self.multistep_dpm_solver_update(x, model_prev_list, t_prev_list, t, step)
+                t_prev_list = [t]
+                model_prev_list = [self.model_fn(x, t)]
                 if self.correcting_xt_fn is not None:
                     x = self.correcting_xt_fn(x, t, step)
-                t_prev_list.append(t)
-                model_prev_list.append(self.model_fn(x, t))
-            # Compute the remaining values by `order`-th order multistep DPM-Solver.
-            for step in range(order, steps + 1):
+                # Init the first `order` values by lower order multistep DPM-Solver.
+                for step in range(1, order):
+                    t = timesteps[step]
+                    x = self.multistep_dpm_solver_update(x, model_prev_list, t_prev_list, t, step)
+                    if self.correcting_xt_fn is not None:
+                        x = self.correcting_xt_fn(x, t, step)
+                    t_prev_list.append(t)
+                    model_prev_list.append(self.model_fn(x, t))
+                # Compute the remaining values by `order`-th order multistep DPM-Solver.
+                for step in range(order, steps + 1):
+                    t = timesteps[step]
+                    # We only use lower order for steps < 10
+                    if steps < 10:
+                        step_order = min(order, steps + 1 - step)
+                    else:
+                        step_order = order
+                    x = self.multistep_dpm_solver_update(
+                        x, model_prev_list, t_prev_list, t, step_order
+                    )
+                    if self.correcting_xt_fn is not None:
+                        x = self.correcting_xt_fn(x, t, step)
+                    x0_prev = model_prev_list[-1]
+                    for i in range(order - 1):
+                        t_prev_list[i] = t_prev_list[i + 1]
+                        model_prev_list[i] = model_prev_list[i + 1]
+                    t_prev_list[-1] = t
+                    # We do not need to evaluate the final model value.
+                    if step < steps:
+                        model_prev_list[-1] = self.model_fn(x, t)
+                        if converged(x0_prev, model_prev_list[-1], step):
+                            exit_step = step
+                            break
+            elif method == "unipc":
+                assert steps >= order
+                timesteps = self.get_time_steps(
+                    skip_type=skip_type, t_T=t_T, t_0=t_0, N=steps, device=device
+                )
+                step = 0
                 t = timesteps[step]
-                # We only use lower order for steps < 10
-                if steps < 10:
-                    step_order = min(order, steps + 1 - step)
-                else:
-                    step_order = order
-                x = self.multistep_dpm_solver_update(x, model_prev_list, t_prev_list, t, step_order)
                 if self.correcting_xt_fn is not None:
                     x = self.correcting_xt_fn(x, t, step)
-                for i in range(order - 1):
-                    t_prev_list[i] = t_prev_list[i + 1]
-                    model_prev_list[i] = model_prev_list[i + 1]
-                t_prev_list[-1] = t
-                # We do not need to evaluate the final model value.
-                if step < steps:
-                    model_prev_list[-1] = self.model_fn(x, t)
-            if denoise_to_zero:
+                t_prev_list = [t]
+                model_prev_list = [self.model_fn(x, t)]
+                for step in range(1, steps + 1):
+                    t = timesteps[step]
+                    # Lower orders for the warm-up, and for the final steps if steps < 10
+                    step_order = min(order, step)
+                    if steps < 10:
+                        step_order = min(step_order, steps + 1 - step)
+                    x, model_x = self.multistep_uni_pc_update(
+                        x,
+                        model_prev_list,
+                        t_prev_list,
+                        t,
+                        step_order,
+                        step,
+                        use_corrector=step < steps,
+                    )
+                    t_prev_list = (t_prev_list + [t])[-order:]
+                    # We do not need to evaluate the final model value.
+                    if step < steps:
+                        x0_prev = model_prev_list[-1]
+                        model_prev_list = (model_prev_list + [model_x])[-order:]
+                        if converged(x0_prev, model_x, step):
+                            exit_step = step
+                            break
+            elif method in ["singlestep", "singlestep_fixed"]:
+                if method == "singlestep":
+                    timesteps_outer, orders = self.get_orders_and_timesteps_for_singlestep_solver(
+                        steps=steps,
+                        order=order,
+                        skip_type=skip_type,
+                        t_T=t_T,
+                        t_0=t_0,
+                        device=device,
+                    )
+                else:
+                    K = steps // order
+                    orders = [order] * K
+                    timesteps_outer = self.get_time_steps(
+                        skip_type=skip_type, t_T=t_T, t_0=t_0, N=K, device=device
+                    )
+                step = 0
+                if self.correcting_xt_fn is not None:
+                    x = self.correcting_xt_fn(x, timesteps_outer[0], step)
+                for step, step_order in enumerate(orders):
+                    s, t = timesteps_outer[step], timesteps_outer[step + 1]
+                    timesteps_inner = self.get_time_steps(
+                        skip_type=skip_type, t_T=s.item(), t_0=t.item(), N=step_order, device=device
+                    )
+                    lambda_inner = self.noise_schedule.marginal_lambda(timesteps_inner)
+                    h = lambda_inner[-1] - lambda_inner[0]
+                    r1 = None if step_order <= 1 else (lambda_inner[1] - lambda_inner[0]) / h
+                    r2 = None if step_order <= 2 else (lambda_inner[2] - lambda_inner[0]) / h
+                    x = self.singlestep_dpm_solver_update(x, s, t, step_order, r1=r1, r2=r2)
+                    if self.correcting_xt_fn is not None:
+                        x = self.correcting_xt_fn(x, t, step + 1)
+            else:
+                raise ValueError("Got wrong method {}".format(method))
+            if exit_step is not None:
+                # the data prediction at the last step is the sample
+                x = model_prev_list[-1]
+                if self.correcting_xt_fn is not None:
+                    x = self.correcting_xt_fn(x, t, step + 1)
+            elif denoise_to_zero:
                 t = torch.ones((1,)).to(device) * t_0
                 x = self.data_prediction_fn(x, t)
                 if self.correcting_xt_fn is not None:
                     x = self.correcting_xt_fn(x, t, step + 1)
+        if return_info:
+            return x, {"steps": steps if exit_step is None else exit_step, "truncated": truncated}
         return x
 
 
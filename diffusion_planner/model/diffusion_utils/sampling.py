@@ -1,8 +1,137 @@
-from typing import Dict
+import time
+from typing import Callable, Dict, Optional
 
 import torch
 
 import diffusion_planner.model.diffusion_utils.dpm_solver_pytorch as dpm
+from diffusion_planner.model.flow_matching_utils.ode_solver import ODE_SOLVERS
+
+# solver name -> DPM_Solver.sample method
+DPM_SOLVERS = {"dpm_multistep": "multistep", "dpm_singlestep": "singlestep", "unipc": "unipc"}
+
+
+class Deadline:
+    """
+    Wall-clock deadline of a sampler, checked between its steps.
+    """
+
+    def __init__(self, budget: float):
+        """
+        budget: [s] from now
+        """
+        self.end = time.perf_counter() + budget
+        self._start = None
+        self._steps = 0
+
+    def start(self, x: torch.Tensor):
+        """
+        The sampling of x starts.
+        """
+        self._start = self._now(x)
+        self._steps = 0
+
+    def near(self, x: torch.Tensor) -> bool:
+        """
+        A step of x ended, whether one more step (of the mean duration) would end after the deadline.
+        """
+        now = self._now(x)
+        self._steps += 1
+        return now + (now - self._start) / self._steps > self.end
+
+    @staticmethod
+    def _now(x):
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        return time.perf_counter()
+
+
+def sampler_config(model_type: str, sampler: Optional[Dict] = None) -> Dict:
+    """
+    Complete the sampler settings of a model type with the defaults.
+
+    sampler: {"solver", "steps", "order", "skip_type", "guidance_scale", "denoise_to_zero",
+        "early_exit", "early_exit_tol", "early_exit_min_steps", "tol", "max_nfe"}, missing or None
+        entries take the default ("order", "skip_type" and "denoise_to_zero" are only used by the
+        DPM solvers, "tol" and "max_nfe" by the adaptive flow matching solvers, where "steps" sets
+        the first step size, see ode_solver.adaptive_integration)
+    early_exit: None, "ego" or "all" (valid tokens), stop when the largest change [m] of the
+        predicted future positions of these tokens between consecutive steps is below
+        "early_exit_tol", after at least "early_exit_min_steps" steps ("steps" is the maximum,
+        dpm_multistep and unipc only)
+    """
+    if model_type == "flow_matching":
+        defaults = {"solver": "euler", "steps": 10, "order": 1, "skip_type": None}
+        solvers = list(ODE_SOLVERS.keys())
+    else:
+        defaults = {"solver": "dpm_multistep", "steps": 10, "order": 2, "skip_type": "logSNR"}
+        solvers = list(DPM_SOLVERS.keys())
+    defaults["guidance_scale"] = 0.5
+    defaults["denoise_to_zero"] = True
+    defaults["early_exit"] = None
+    defaults["early_exit_tol"] = 0.05
+    defaults["early_exit_min_steps"] = 3
+    defaults["tol"] = 1e-3
+    defaults["max_nfe"] = None
+
+    sampler = {} if sampler is None else sampler
+    unknown = set(sampler.keys()) - set(defaults.keys())
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown sampler settings: {sorted(unknown)}")
+    config = {k: sampler[k] if sampler.get(k) is not None else v for k, v in defaults.items()}
+
+    if config["solver"] not in solvers:
+        raise ValueError(
+            f"Unknown solver for {model_type}: {config['solver']}, use one of {solvers}"
+        )
+    if config["solver"] in DPM_SOLVERS and config["order"] not in [1, 2, 3]:
+        raise ValueError(f"{config['solver']} supports order 1, 2 or 3, got {config['order']}")
+    if config["early_exit"] is not None:
+        if config["early_exit"] not in ["ego", "all"]:
+            raise ValueError(f"Unknown early exit: {config['early_exit']}, use ego or all")
+        if config["solver"] not in ["dpm_multistep", "unipc"]:
+            raise ValueError(f"Early exit needs dpm_multistep or unipc, got {config['solver']}")
+    return config
+
+
+def check_time_budget(sampler: Dict):
+    """
+    Raise a ValueError when the solver of the sampler settings (see sampler_config) cannot be
+    truncated at a deadline.
+    """
+    if sampler["solver"] == "dpm_singlestep":
+        raise ValueError("A time budget needs dpm_multistep, unipc or a flow matching solver")
+
+
+def warm_start_time(model_type: str, sampler: Dict, steps: int) -> float:
+    """
+    Time on the grid of the sampler from which its last `steps` steps are run (SDEdit): the
+    diffusion time (1 is noise) for the DPM solvers, the flow time (0 is noise) for flow matching.
+    """
+    if not 1 <= steps <= sampler["steps"]:
+        raise ValueError(f"Warm start steps must be in [1, {sampler['steps']}], got {steps}")
+    if model_type == "flow_matching":
+        return 1.0 - steps / sampler["steps"]
+    noise_schedule = dpm.NoiseScheduleVP()
+    timesteps = dpm.DPM_Solver(None, noise_schedule).get_time_steps(
+        sampler["skip_type"],
+        noise_schedule.T,
+        1.0 / noise_schedule.total_N,
+        sampler["steps"],
+        "cpu",
+    )
+    return timesteps[sampler["steps"] - steps].item()
+
+
+def noise_warm_start(model_type: str, x_0: torch.Tensor, noise: torch.Tensor, t_start: float):
+    """
+    Sample the forward process at `t_start` from the data `x_0`, `noise` is a sample of the
+    sampler prior.
+    """
+    if model_type == "flow_matching":
+        return (1.0 - t_start) * noise + t_start * x_0
+    noise_schedule = dpm.NoiseScheduleVP()
+    t = torch.tensor(t_start, device=x_0.device)
+    return noise_schedule.marginal_alpha(t) * x_0 + noise_schedule.marginal_std(t) * noise
 
 
 @torch.no_grad()
@@ -12,7 +141,20 @@ def dpm_sampler(
     other_model_params: Dict,
     model_wrapper_params: Dict,
     dpm_solver_params: Dict,
+    steps: int = 10,
+    order: int = 2,
+    skip_type: str = "logSNR",
+    method: str = "multistep",
+    denoise_to_zero: bool = True,
+    t_start: Optional[float] = None,
+    early_exit_fn: Optional[Callable] = None,
+    early_exit_tol: float = 0.0,
+    early_exit_min_steps: int = 1,
+    deadline: Optional[Deadline] = None,
 ):
+    """
+    Returns the sample and {"steps", "truncated"}, see DPM_Solver.sample.
+    """
     noise_schedule = dpm.NoiseScheduleVP()
 
     model_fn = dpm.model_wrapper(
@@ -25,6 +167,19 @@ def dpm_sampler(
 
     dpm_solver = dpm.DPM_Solver(model_fn, noise_schedule, **dpm_solver_params)
 
-    sample_dpm = dpm_solver.sample(x_T, steps=10, skip_type="logSNR")
+    sample_dpm = dpm_solver.sample(
+        x_T,
+        steps=steps,
+        order=order,
+        skip_type=skip_type,
+        method=method,
+        denoise_to_zero=denoise_to_zero,
+        t_start=t_start,
+        early_exit_fn=early_exit_fn,
+        early_exit_tol=early_exit_tol,
+        early_exit_min_steps=early_exit_min_steps,
+        deadline=deadline,
+        return_info=True,
+    )
 
     return sample_dpm
@@ -1,62 +1,97 @@
 import torch
 
 
-def euler_integration(func, x, num_steps):
+def truncate(x, v, t, deadline, steps, num_steps, return_info):
+    """
+    Stop the integration at t after `steps` steps if the deadline is near: the data estimate is
+    one Euler step to 1 with the velocity v. Returns the (estimated) data and the info when
+    stopping, None otherwise.
+    """
+    if deadline is None or steps == num_steps or not deadline.near(x):
+        return None
+    x = x.clone().reshape(*v.shape)
+    x[:, :, 1:] += v[:, :, 1:] * (1.0 - t)
+    x = x.reshape(x.shape[0], x.shape[1], -1)
+    return (x, {"steps": steps, "truncated": True}) if return_info else x
+
+
+@torch.no_grad()
+def euler_integration(func, x, num_steps, t_start=0.0, deadline=None, return_info=False):
     """
     Numerical integration using Euler's method
     x_t+1 = x_t + f(x_t, t) * dt
+    from t_start (0 is noise) to 1, until the deadline (see sampling.Deadline) is near
+    return_info: also return {"steps": the number of steps run, "truncated": whether the deadline
+        stopped the integration}
+    The future states of x are updated in place, the current states x[:, :, 0] are kept, so the
+    integration runs without autograd (as dpm_sampler).
     """
     B, P, _ = x.shape
-    dt = 1.0 / num_steps
+    dt = (1.0 - t_start) / num_steps
+    if deadline is not None:
+        deadline.start(x)
+    t = x.new_empty(B)
+    future = x.view(B, P, -1, 4)[:, :, 1:]
 
     for i in range(num_steps):
-        t = torch.ones(B).to(x.device) * (i * dt)
-        v = func(x, t)
-        v = v.reshape(B, P, -1, 4)
-        x = x.reshape(B, P, -1, 4)
-        x[:, :, 1:] += v[:, :, 1:] * dt
-        x = x.reshape(B, P, -1)
+        v = func(x, t.fill_(t_start + i * dt)).reshape(B, P, -1, 4)
+        future.add_(v[:, :, 1:], alpha=dt)
+        result = truncate(x, v, t_start + (i + 1) * dt, deadline, i + 1, num_steps, return_info)
+        if result is not None:
+            return result
+
+    return (x, {"steps": num_steps, "truncated": False}) if return_info else x
 
-    return x
+
+def stage_buffer(x):
+    """
+    A buffer for the stage inputs of x [B, P, (T + 1) * 4] with its current states, returns the
+    buffer and the view of its future states.
+    """
+    B, P, _ = x.shape
+    buffer = torch.empty_like(x)
+    buffer.view(B, P, -1, 4)[:, :, 0] = x.view(B, P, -1, 4)[:, :, 0]
+    return buffer, buffer.view(B, P, -1, 4)[:, :, 1:]
 
 
-def heun_integration(func, x, num_steps):
+@torch.no_grad()
+def heun_integration(func, x, num_steps, t_start=0.0, deadline=None, return_info=False):
     """
     Numerical integration using Heun's method (Improved Euler)
     k1 = f(x_t, t)
     k2 = f(x_t + k1 * dt, t + dt)
     x_t+1 = x_t + (k1 + k2) * dt / 2
+    t_start, deadline, return_info: see euler_integration
     """
     B, P, _ = x.shape
-    dt = 1.0 / num_steps
+    dt = (1.0 - t_start) / num_steps
+    if deadline is not None:
+        deadline.start(x)
+    t = x.new_empty(B)
+    future = x.view(B, P, -1, 4)[:, :, 1:]
+    x_pred, x_pred_future = stage_buffer(x)
 
     for i in range(num_steps):
-        t_curr = torch.ones(B).to(x.device) * ((i + 0) * dt)
-        t_next = torch.ones(B).to(x.device) * ((i + 1) * dt)
-
         # Step 1: k1 = f(x_t, t)
-        k1 = func(x, t_curr)
-        k1 = k1.reshape(B, P, -1, 4)
-        x_reshaped = x.reshape(B, P, -1, 4)
+        k1 = func(x, t.fill_(t_start + i * dt)).reshape(B, P, -1, 4)[:, :, 1:]
 
         # Prediction step: x_pred = x_t + k1 * dt
-        x_pred = x.clone().reshape(B, P, -1, 4)
-        x_pred[:, :, 1:] = x_reshaped[:, :, 1:] + k1[:, :, 1:] * dt
-        x_pred = x_pred.reshape(B, P, -1)
+        torch.add(future, k1, alpha=dt, out=x_pred_future)
 
         # Step 2: k2 = f(x_pred, t + dt)
-        k2 = func(x_pred, t_next)
-        k2 = k2.reshape(B, P, -1, 4)
+        k2 = func(x_pred, t.fill_(t_start + (i + 1) * dt)).reshape(B, P, -1, 4)
 
         # Update step: x_t+1 = x_t + (k1 + k2) * dt / 2
-        x = x.reshape(B, P, -1, 4)
-        x[:, :, 1:] += (k1[:, :, 1:] + k2[:, :, 1:]) * dt / 2
-        x = x.reshape(B, P, -1)
+        future.add_(k1, alpha=dt / 2).add_(k2[:, :, 1:], alpha=dt / 2)
+        result = truncate(x, k2, t_start + (i + 1) * dt, deadline, i + 1, num_steps, return_info)
+        if result is not None:
+            return result
 
-    return x
+    return (x, {"steps": num_steps, "truncated": False}) if return_info else x
 
 
-def rk4_integration(func, x, num_steps):
+@torch.no_grad()
+def rk4_integration(func, x, num_steps, t_start=0.0, deadline=None, return_info=False):
     """
     Numerical integration using 4th-order Runge-Kutta method
     k1 = f(x_t, t)
@@ -64,41 +99,171 @@ def rk4_integration(func, x, num_steps):
     k3 = f(x_t + k2 * dt/2, t + dt/2)
     k4 = f(x_t + k3 * dt, t + dt)
     x_t+1 = x_t + (k1 + 2*k2 + 2*k3 + k4) * dt / 6
+    t_start, deadline, return_info: see euler_integration
     """
     B, P, _ = x.shape
-    dt = 1.0 / num_steps
+    dt = (1.0 - t_start) / num_steps
+    if deadline is not None:
+        deadline.start(x)
+    t = x.new_empty(B)
+    future = x.view(B, P, -1, 4)[:, :, 1:]
+    x_stage, x_stage_future = stage_buffer(x)
 
     for i in range(num_steps):
-        t_curr = torch.ones(B).to(x.device) * ((i + 0) * dt)
-        t_mid = torch.ones(B).to(x.device) * ((i + 0.5) * dt)
-        t_next = torch.ones(B).to(x.device) * ((i + 1) * dt)
-
-        x_reshaped = x.reshape(B, P, -1, 4)
-
         # Step 1: k1 = f(x_t, t)
-        k1 = func(x, t_curr).reshape(B, P, -1, 4)
+        k1 = func(x, t.fill_(t_start + i * dt)).reshape(B, P, -1, 4)[:, :, 1:]
 
         # Step 2: k2 = f(x_t + k1 * dt/2, t + dt/2)
-        x_k2 = x.clone().reshape(B, P, -1, 4)
-        x_k2[:, :, 1:] = x_reshaped[:, :, 1:] + k1[:, :, 1:] * dt / 2
-        x_k2 = x_k2.reshape(B, P, -1)
-        k2 = func(x_k2, t_mid).reshape(B, P, -1, 4)
+        torch.add(future, k1, alpha=dt / 2, out=x_stage_future)
+        k2 = func(x_stage, t.fill_(t_start + (i + 0.5) * dt)).reshape(B, P, -1, 4)[:, :, 1:]
 
         # Step 3: k3 = f(x_t + k2 * dt/2, t + dt/2)
-        x_k3 = x.clone().reshape(B, P, -1, 4)
-        x_k3[:, :, 1:] = x_reshaped[:, :, 1:] + k2[:, :, 1:] * dt / 2
-        x_k3 = x_k3.reshape(B, P, -1)
-        k3 = func(x_k3, t_mid).reshape(B, P, -1, 4)
+        torch.add(future, k2, alpha=dt / 2, out=x_stage_future)
+        k3 = func(x_stage, t).reshape(B, P, -1, 4)[:, :, 1:]
 
         # Step 4: k4 = f(x_t + k3 * dt, t + dt)
-        x_k4 = x.clone().reshape(B, P, -1, 4)
-        x_k4[:, :, 1:] = x_reshaped[:, :, 1:] + k3[:, :, 1:] * dt
-        x_k4 = x_k4.reshape(B, P, -1)
-        k4 = func(x_k4, t_next).reshape(B, P, -1, 4)
+        torch.add(future, k3, alpha=dt, out=x_stage_future)
+        k4 = func(x_stage, t.fill_(t_start + (i + 1) * dt)).reshape(B, P, -1, 4)
 
         # Update step: x_t+1 = x_t + (k1 + 2*k2 + 2*k3 + k4) * dt / 6
-        x = x.reshape(B, P, -1, 4)
-        x[:, :, 1:] += (k1[:, :, 1:] + 2 * k2[:, :, 1:] + 2 * k3[:, :, 1:] + k4[:, :, 1:]) * dt / 6
-        x = x.reshape(B, P, -1)
+        future.add_(k1, alpha=dt / 6).add_(k2, alpha=dt / 3).add_(k3, alpha=dt / 3)
+        future.add_(k4[:, :, 1:], alpha=dt / 6)
+        result = truncate(x, k4, t_start + (i + 1) * dt, deadline, i + 1, num_steps, return_info)
+        if result is not None:
+            return result
+
+    return (x, {"steps": num_steps, "truncated": False}) if return_info else x
+
+
+# embedded Runge-Kutta pairs with the first same as last property: nodes c, coefficients a, weights
+# b of the solution and b_low of the embedded lower order one, order of the embedded solution
+BOGACKI_SHAMPINE = {
+    "c": [0.0, 1 / 2, 3 / 4, 1.0],
+    "a": [[], [1 / 2], [0.0, 3 / 4], [2 / 9, 1 / 3, 4 / 9]],
+    "b": [2 / 9, 1 / 3, 4 / 9, 0.0],
+    "b_low": [7 / 24, 1 / 4, 1 / 3, 1 / 8],
+    "order_low": 2,
+}
+DORMAND_PRINCE = {
+    "c": [0.0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.0, 1.0],
+    "a": [
+        [],
+        [1 / 5],
+        [3 / 40, 9 / 40],
+        [44 / 45, -56 / 15, 32 / 9],
+        [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+        [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+        [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+    ],
+    "b": [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0.0],
+    "b_low": [5179 / 57600, 0.0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40],
+    "order_low": 4,
+}
+
+
+@torch.no_grad()
+def adaptive_integration(
+    func,
+    x,
+    num_steps,
+    t_start=0.0,
+    deadline=None,
+    return_info=False,
+    tol=1e-3,
+    max_nfe=None,
+    tableau=BOGACKI_SHAMPINE,
+):
+    """
+    Numerical integration with an embedded Runge-Kutta pair and error control: a step is accepted
+    when the RMS (over the future states, largest over the batch) of the difference to the lower
+    order solution, relative to tol * (1 + |x|), is at most 1, and the next step size is adapted
+    to it. The first step is (1 - t_start) / num_steps.
+    max_nfe: the function evaluations allowed, when the next step does not fit the integration
+        ends with an Euler step to 1 (None: as many as num_steps steps take)
+    t_start, deadline, return_info: see euler_integration, return_info also returns "nfe"
+    """
+    B, P, _ = x.shape
+    c, a, b, b_low = tableau["c"], tableau["a"], tableau["b"], tableau["b_low"]
+    stages = len(c)
+    max_nfe = (stages - 1) * num_steps + 1 if max_nfe is None else max_nfe
+    if deadline is not None:
+        deadline.start(x)
+    t = x.new_empty(B)
+    future = x.view(B, P, -1, 4)[:, :, 1:]
+    x_stage, x_stage_future = stage_buffer(x)
+    x_new, x_new_future = stage_buffer(x)
+    error, scale = torch.empty_like(future), torch.empty_like(future)
+
+    t_curr, h, steps, truncated = t_start, (1.0 - t_start) / num_steps, 0, False
+    k = [func(x, t.fill_(t_curr)).reshape(B, P, -1, 4)] + [None] * (stages - 1)
+    nfe = 1
+    while 1.0 - t_curr > 1e-6:
+        h = min(h, 1.0 - t_curr)
+        out_of_budget = nfe + stages - 1 > max_nfe
+        if out_of_budget or (deadline is not None and deadline.near(x)):
+            # Euler step to 1 with the last velocity
+            future.add_(k[0][:, :, 1:], alpha=1.0 - t_curr)
+            truncated = not out_of_budget
+            break
+
+        for i in range(1, stages):
+            x_stage_future.copy_(future)
+            for j, a_ij in enumerate(a[i]):
+                if a_ij != 0.0:
+                    x_stage_future.add_(k[j][:, :, 1:], alpha=h * a_ij)
+            k[i] = func(x_stage, t.fill_(t_curr + c[i] * h)).reshape(B, P, -1, 4)
+        nfe += stages - 1
+
+        x_new_future.copy_(future)
+        error.zero_()
+        for j in range(stages):
+            if b[j] != 0.0:
+                x_new_future.add_(k[j][:, :, 1:], alpha=h * b[j])
+            if b[j] != b_low[j]:
+                error.add_(k[j][:, :, 1:], alpha=h * (b[j] - b_low[j]))
+        torch.maximum(torch.abs(future, out=scale), x_new_future.abs(), out=scale)
+        error.div_(scale.mul_(tol).add_(tol))
+        error_norm = error.square_().mean(dim=(1, 2, 3)).sqrt_().max().item()
+
+        if error_norm <= 1.0:
+            future.copy_(x_new_future)
+            t_curr += h
+            steps += 1
+            # first same as last: the last stage is the velocity at the new state
+            k[0] = k[-1]
+        factor = 5.0 if error_norm == 0.0 else 0.9 * error_norm ** (-1 / (tableau["order_low"] + 1))
+        h = h * min(5.0, max(0.2, factor))
+
+    return (x, {"steps": steps, "nfe": nfe, "truncated": truncated}) if return_info else x
+
+
+def bosh3_integration(func, x, num_steps, t_start=0.0, deadline=None, return_info=False, **options):
+    """
+    Adaptive Bogacki-Shampine 3(2) integration, see adaptive_integration.
+    """
+    return adaptive_integration(
+        func, x, num_steps, t_start, deadline, return_info, tableau=BOGACKI_SHAMPINE, **options
+    )
+
+
+def dopri5_integration(
+    func, x, num_steps, t_start=0.0, deadline=None, return_info=False, **options
+):
+    """
+    Adaptive Dormand-Prince 5(4) integration, see adaptive_integration.
+    """
+    return adaptive_integration(
+        func, x, num_steps, t_start, deadline, return_info, tableau=DORMAND_PRINCE, **options
+    )
+
+
+ODE_SOLVERS = {
+    "euler": euler_integration,
+    "heun": heun_integration,
+    "rk4": rk4_integration,
+    "bosh3": bosh3_integration,
+    "dopri5": dopri5_integration,
+}
 
-    return x
+# the solvers with error control, they take the tolerance and the evaluation budget (tol, max_nfe)
+ADAPTIVE_ODE_SOLVERS = ["bosh3", "dopri5"]
@@ -1,12 +1,49 @@
+from functools import lru_cache
+
 import torch
 import torch.nn.functional as F
 from nuplan.common.actor_state.vehicle_parameters import get_pacifica_parameters
 
+from diffusion_planner.model.guidance.registry import register_guidance
+
 ego_size = [get_pacifica_parameters().length, get_pacifica_parameters().width]
 
 COG_TO_REAR = 1.67
 CLIP_DISTANCE = 1.0
 INFLATION = 1.0
+TIME_WINDOW = (0.005, 0.1)  # diffusion times at which the guidance is applied
+
+
+@lru_cache(maxsize=None)
+def _corner_template(device, dtype):
+    """
+    [4, 2] corners of the unit rectangle, per device and dtype.
+    """
+    return torch.tensor([[1.0, 1], [-1, 1], [-1, -1], [1, -1]], device=device, dtype=dtype) / 2
+
+
+@lru_cache(maxsize=None)
+def _heading_basis(device, dtype):
+    """
+    [4, 2] maps (cos, sin) to the rotation matrix [[cos, sin], [-sin, cos]] (flattened).
+    """
+    return torch.tensor([[1.0, 0], [0, 1], [0, -1], [1, 0]], device=device, dtype=dtype)
+
+
+@lru_cache(maxsize=None)
+def _smoothing_kernels(T, device, dtype):
+    """
+    The longitudinal [T, T] and lateral [1, 1, 21] smoothing kernels of the guidance gradient,
+    per horizon, device and dtype.
+    """
+    longitudinal = torch.tril(
+        (-torch.linspace(0, 1, T, device=device, dtype=dtype)).exp().unsqueeze(0).repeat(T, 1)
+    )
+    lateral = (
+        torch.ones(1, 1, 21, device=device, dtype=dtype)
+        * (-(torch.linspace(-2, 2, 21, device=device, dtype=dtype) ** 2) / 4).exp()
+    )
+    return longitudinal, lateral
 
 
 def batch_signed_distance_rect(rect1, rect2):
@@ -58,7 +95,7 @@ def center_rect_to_points(rect):
 
     rot = torch.stack([cos_h, -sin_h, sin_h, cos_h], dim=1).reshape(-1, 2, 2)  # [B, 2, 2]
     lw = torch.einsum(
-        "bj,ij->bij", lw, torch.tensor([[1.0, 1], [-1, 1], [-1, -1], [1, -1]], device=lw.device) / 2
+        "bj,ij->bij", lw, _corner_template(lw.device, lw.dtype)
     )  # [B, 2] * [4, 2] -> [B, 4, 2]
     lw = torch.einsum("bij,bkj->bik", lw, rot)  # [B, 4, 2] * [B, 2, 2] -> [B, 4, 2]
 
@@ -67,62 +104,29 @@ def center_rect_to_points(rect):
     return rect
 
 
-def collision_guidance_fn(x, t, cond, inputs, *args, **kwargs) -> torch.Tensor:
+@register_guidance("collision", time_window=TIME_WINDOW)
+def collision_guidance_fn(ctx) -> torch.Tensor:
     """
-    x: [B * Pn+1, T + 1, 4]
-    t: [B, 1],
-    inputs: Dict[str, torch.Tensor]
+    Pushes the ego laterally away from the (inflated) neighbor boxes closer than CLIP_DISTANCE.
+
+    ctx: GuidanceContext
+    return: [B]
     """
+    x = ctx.states  # [B, P + 1, T + 1, 4]
     B, P, T, _ = x.shape
-    neighbor_current_mask = inputs["neighbor_current_mask"]  # [B, Pn]
+    neighbor_current_mask = ctx.neighbor_mask  # [B, Pn]
 
-    x: torch.Tensor = x.reshape(B, P, -1, 4)
-    mask_diffusion_time = t < 0.1 and t > 0.005
-    x = torch.where(mask_diffusion_time, x, x.detach())
+    bbox = torch.cat([ctx.boxes[:, :1], ctx.boxes[:, 1:].detach()], dim=1)  # [B, P, T, 6]
+    Pn, T = P - 1, T - 1
+    lw = ctx.lw + INFLATION  # [B, P, 2]
 
-    x = torch.cat(
-        [
-            x[:, :, :, :2],
-            x[:, :, :, 2:].detach() / torch.norm(x[:, :, :, 2:].detach(), dim=-1, keepdim=True),
-        ],
-        dim=-1,
-    )  # [B, P + 1, T, 4]
-
-    ego_pred = x[:, :1, 1:, :]  # [B, 1, T, 4]
-    cos_h, sin_h = ego_pred[..., 2:3], ego_pred[..., 3:4]
-    ego_pred = torch.cat(
-        [
-            ego_pred[..., 0:1] + cos_h * COG_TO_REAR,
-            ego_pred[..., 1:2] + sin_h * COG_TO_REAR,
-            ego_pred[..., 2:],
-        ],
-        dim=-1,
-    )
-
-    neighbors_pred = x[:, 1:, 1:, :]  # [B, P, T, 4]
-
-    B, Pn, T, _ = neighbors_pred.shape
+    # only the (neighbor, time) pairs of valid neighbors go through the separating axis test
+    pairs = ~neighbor_current_mask[..., None].expand(-1, -1, T)  # [B, Pn, T]
 
-    predictions = torch.cat([ego_pred, neighbors_pred.detach()], dim=1)  # [B, P + 1, T, 4]
+    bbox = torch.cat([bbox[..., :4], lw.unsqueeze(2).expand(-1, -1, T, -1)], dim=-1)
 
-    lw = torch.cat(
-        [
-            torch.tensor(ego_size, device=predictions.device)[None, None, :].repeat(B, 1, 1),
-            inputs["neighbor_agents_past"][:, :Pn, -1, [7, 6]],
-        ],
-        dim=1,
-    )  # [B, P, 2]
-
-    bbox = torch.cat(
-        [predictions, lw.unsqueeze(2).expand(-1, -1, T, -1) + INFLATION], dim=-1
-    )  # [B, P, T, 6]
-
-    bbox = center_rect_to_points(bbox.reshape(-1, 6)).reshape(B, Pn + 1, T, 4, 2)
-
-    ego_bbox = (
-        bbox[:, :1, :, :, :].expand(-1, Pn, -1, -1, -1)[~neighbor_current_mask].reshape(-1, 4, 2)
-    )
-    neighbor_bbox = bbox[:, 1:, :, :, :][~neighbor_current_mask].reshape(-1, 4, 2)
+    ego_bbox = center_rect_to_points(bbox[:, :1].expand(-1, Pn, -1, -1)[pairs])  # [N, 4, 2]
+    neighbor_bbox = center_rect_to_points(bbox[:, 1:][pairs])  # [N, 4, 2]
 
     distances = batch_signed_distance_rect(ego_bbox, neighbor_bbox)
     clip_distances = torch.maximum(
@@ -141,31 +145,18 @@ def collision_guidance_fn(x, t, cond, inputs, *args, **kwargs) -> torch.Tensor:
     ]  # [B, T, 2]
 
     T += 1
-    x_mat = torch.einsum(
-        "btd,nd->btn",
-        x[:, 0, :, 2:],
-        torch.tensor([[1.0, 0], [0, 1], [0, -1], [1, 0]], device=x.device),
-    ).reshape(B, T, 2, 2)
+    x_mat = torch.einsum("btd,nd->btn", x[:, 0, :, 2:], _heading_basis(x.device, x.dtype)).reshape(
+        B, T, 2, 2
+    )
 
     x_aux = torch.einsum("btij,btj->bti", x_mat, x_aux)
     # x_aux = torch.cat([x_aux[:, :5], torch.zeros_like(x_aux[:, 5:])], dim=1)
 
+    longitudinal, lateral = _smoothing_kernels(T, x.device, x.dtype)
     x_aux = torch.stack(
         [
-            torch.einsum(
-                "bt,it->bi",
-                x_aux[..., 0],
-                torch.tril(
-                    (-torch.linspace(0, 1, T, device=x.device)).exp().unsqueeze(0).repeat(T, 1)
-                ),
-            )
-            * 0,
-            F.conv1d(
-                F.pad(x_aux[:, None, :, 1], (10, 10), mode="replicate"),
-                torch.ones(1, 1, 21, device=x.device)
-                * (-(torch.linspace(-2, 2, 21, device=x.device) ** 2) / 4).exp(),
-            )[:, 0]
-            * 1.0,
+            torch.einsum("bt,it->bi", x_aux[..., 0], longitudinal) * 0,
+            F.conv1d(F.pad(x_aux[:, None, :, 1], (10, 10), mode="replicate"), lateral)[:, 0] * 1.0,
         ],
         dim=2,
     )
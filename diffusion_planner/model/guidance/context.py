@@ -0,0 +1,92 @@
+"""Geometry shared by the guidance terms of one sampler step.
+
+GuidanceWrapper builds one GuidanceContext from the denoised estimate of the trajectories, and
+every guidance term reads the quantities it needs from it. They are computed on first use and
+then reused by the other terms.
+"""
+
+from functools import cached_property
+
+import torch
+
+from diffusion_planner.model.guidance.collision import (
+    COG_TO_REAR,
+    center_rect_to_points,
+    ego_size,
+)
+from diffusion_planner.model.guidance.map_sdf import MapSDF
+
+
+class GuidanceContext:
+    def __init__(self, x, t, inputs):
+        """
+        x: [B, P, T + 1, 4] de-normalized (x, y, cos, sin) trajectories (ego first, the current
+            state at index 0), differentiable w.r.t. the sampler state
+        t: [B] diffusion time
+        inputs: Dict[str, torch.Tensor] de-normalized observation
+        """
+        self.x = x
+        self.t = t
+        self.inputs = inputs
+
+    @property
+    def neighbor_mask(self):
+        """
+        [B, Pn] True for the empty neighbor slots.
+        """
+        return self.inputs["neighbor_current_mask"][:, : self.x.shape[1] - 1]
+
+    @cached_property
+    def states(self):
+        """
+        [B, P, T + 1, 4] positions with the unit (detached) heading.
+        """
+        heading = self.x[..., 2:].detach()
+        heading = heading / torch.norm(heading, dim=-1, keepdim=True)
+        return torch.cat([self.x[..., :2], heading], dim=-1)
+
+    @cached_property
+    def lw(self):
+        """
+        [B, P, 2] length and width of the ego and the neighbors.
+        """
+        B, P = self.x.shape[:2]
+        ego_lw = torch.tensor(ego_size, device=self.x.device, dtype=self.x.dtype)
+        return torch.cat(
+            [
+                ego_lw[None, None, :].expand(B, 1, 2),
+                self.inputs["neighbor_agents_past"][:, : P - 1, -1, [7, 6]],
+            ],
+            dim=1,
+        )
+
+    @cached_property
+    def boxes(self):
+        """
+        [B, P, T, 6] (x, y, cos, sin, l, w) future boxes, centered on the ego body (not the rear
+        axle).
+        """
+        future = self.states[:, :, 1:]
+        ego = future[:, :1]
+        ego = torch.cat([ego[..., :2] + ego[..., 2:] * COG_TO_REAR, ego[..., 2:]], dim=-1)
+        T = future.shape[2]
+        lw = self.lw[:, :, None].expand(-1, -1, T, -1)
+        return torch.cat([torch.cat([ego, future[:, 1:]], dim=1), lw], dim=-1)
+
+    @cached_property
+    def corners(self):
+        """
+        [B, P, T, 4, 2] corners of the future boxes.
+        """
+        B, P, T, _ = self.boxes.shape
+        return center_rect_to_points(self.boxes.reshape(-1, 6)).reshape(B, P, T, 4, 2)
+
+    @cached_property
+    def map_sdf(self):
+        """
+        MapSDF of the drivable area, rasterized at the first use in a sampling and kept in the
+        observation for the other steps.
+        """
+        if "map_sdf" not in self.inputs:
+            self.inputs["map_sdf"] = MapSDF.from_lanes(self.inputs["lanes"])
+        return self.inputs["map_sdf"]
@@ -0,0 +1,18 @@
+import torch
+
+from diffusion_planner.model.guidance.registry import register_guidance
+
+MARGIN = 0.2  # [m] the ego corners are kept this far inside the drivable area
+
+
+@register_guidance("drivable_area", time_window=(0.005, 0.1))
+def drivable_area_guidance_fn(ctx) -> torch.Tensor:
+    """
+    Pulls the corners of the ego boxes that leave the drivable area (see map_sdf.py) back in.
+
+    ctx: GuidanceContext
+    return: [B]
+    """
+    corners = ctx.corners[:, 0]  # [B, T, 4, 2]
+    outside = torch.relu(ctx.map_sdf(corners) + MARGIN)  # [B, T, 4]
+    return -outside.sum(dim=(1, 2))
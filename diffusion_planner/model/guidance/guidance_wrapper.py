@@ -1,30 +1,76 @@
 import torch
 
+# registers the guidance terms
+import diffusion_planner.model.guidance.collision  # noqa: F401
+import diffusion_planner.model.guidance.drivable_area  # noqa: F401
 from diffusion_planner.model.diffusion_utils.sde import VPSDE_linear
-from diffusion_planner.model.guidance.collision import collision_guidance_fn
+from diffusion_planner.model.guidance.context import GuidanceContext
+from diffusion_planner.model.guidance.registry import GUIDANCE_TERMS
 
 N = 1
 sde = VPSDE_linear()
 
 
 class GuidanceWrapper:
-    def __init__(self):
-        self._guidance_fns = [collision_guidance_fn]
+    def __init__(self, terms=None):
+        """
+        terms: {name: {"weight", "time_window"}} the registered guidance terms (see registry.py)
+            to apply, the energy is their weighted sum; a missing or None weight is 1.0, a missing
+            or None time_window the one of the term. None: {"collision": {}}
+        """
+        terms = {"collision": {}} if terms is None else terms
+        self._terms = []
+        for name, settings in terms.items():
+            if name not in GUIDANCE_TERMS:
+                raise ValueError(
+                    f"Unknown guidance term: {name}, use one of {sorted(GUIDANCE_TERMS.keys())}"
+                )
+            settings = {} if settings is None else settings
+            unknown = set(settings.keys()) - {"weight", "time_window"}
+            if len(unknown) > 0:
+                raise ValueError(f"Unknown settings of guidance term {name}: {sorted(unknown)}")
+            guidance_fn = GUIDANCE_TERMS[name]
+            weight = settings.get("weight")
+            time_window = settings.get("time_window")
+            self._terms.append(
+                (
+                    guidance_fn,
+                    1.0 if weight is None else weight,
+                    guidance_fn.time_window if time_window is None else tuple(time_window),
+                )
+            )
+
+    @staticmethod
+    def _active(time_window, t_input):
+        """
+        [B] whether the diffusion times t_input [B] are in the time window.
+        """
+        if time_window is None:
+            return torch.ones_like(t_input, dtype=torch.bool)
+        return (t_input > time_window[0]) & (t_input < time_window[1])
 
-    def __call__(self, x_in, t_input, cond, *args, **kwargs):
+    def is_active(self, t_input):
+        """
+        Whether any guidance term is applied at the diffusion times t_input [B].
+        """
+        return any(
+            bool(self._active(time_window, t_input).any()) for _, _, time_window in self._terms
+        )
+
+    def __call__(self, x_in, t_input, cond, model_output, *args, **kwargs):
         """
         This function is a wrapper for the guidance functions in the model.
+
+        model_output: the x_start prediction of the model at (x_in, t_input), evaluated by the solver
+        kwargs["inputs"]: the observation, already de-normalized (once per sampling)
         """
-        energy = 0
+        energy = torch.zeros_like(t_input)
 
         state_normalizer = kwargs["state_normalizer"]
-        observation_normalizer = kwargs["observation_normalizer"]
 
         B, P, _ = x_in.shape
-        model = kwargs["model"]
-        model_condition = kwargs["model_condition"]
 
-        x_fix = model(x_in, t_input, **model_condition).detach() - x_in.detach()
+        x_fix = model_output - x_in.detach()
         x_fix = x_fix.reshape(B, P, -1, 4)
         x_fix[:, :, 0] = 0.0
         x_in = x_in + x_fix.reshape(B, P, -1)
@@ -38,10 +84,12 @@ class GuidanceWrapper:
         # x_in = torch.cat([x_in[:, :1] + sigma_t[:, None, None] * torch.randn_like(x_in[:, :1]), x_in[:, 1:]], dim=1)
 
         x_in = state_normalizer.inverse(x_in.reshape(B, P, -1, 4))
-        kwargs["inputs"] = observation_normalizer.inverse(kwargs["inputs"])
+        ctx = GuidanceContext(x_in, t_input, kwargs["inputs"])
 
-        for guidance_fn in self._guidance_fns:
-            energy += guidance_fn(x_in, t_input, cond, **kwargs)
+        for guidance_fn, weight, time_window in self._terms:
+            active = self._active(time_window, t_input)
+            if active.any():
+                energy = energy + weight * active * guidance_fn(ctx)
         # energy1 = self._guidance_fns[0](x_in, t_input, cond, **kwargs)
         # energy2 = self._guidance_fns[1](x_in, t_input, cond, **kwargs)
 
@@ -0,0 +1,111 @@
+"""Signed distance field of the drivable area, rasterized from the lane features.
+
+The drivable area is the union of the lane segments, each a capsule around the centerline segment
+with the (interpolated) half width of the lane. The field is truncated at `max_distance`, so every
+segment only updates the cells around it. It is rasterized once per planning cycle on the device
+of the lanes; looking up a point is then a bilinear interpolation, differentiable w.r.t. the point,
+instead of a distance to every lane segment.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def lane_segments(lanes):
+    """
+    lanes: [B, L, N, 12] unnormalized ego-centric lane features (x, y, dx, dy, to_left (2),
+        to_right (2), traffic light (4)), all zero for the padding
+    return: start [B, S, 2], end [B, S, 2], half width at start and end [B, S, 2] and the valid
+        segments [B, S] (S = L * (N - 1))
+    """
+    B = lanes.shape[0]
+    valid = torch.ne(lanes, 0).any(dim=-1)  # [B, L, N]
+    half_width = (torch.norm(lanes[..., 4:6], dim=-1) + torch.norm(lanes[..., 6:8], dim=-1)) / 2
+    start, end = lanes[:, :, :-1, :2], lanes[:, :, 1:, :2]
+    width = torch.stack([half_width[:, :, :-1], half_width[:, :, 1:]], dim=-1)
+    valid = valid[:, :, :-1] & valid[:, :, 1:]
+    return (
+        start.reshape(B, -1, 2),
+        end.reshape(B, -1, 2),
+        width.reshape(B, -1, 2),
+        valid.reshape(B, -1),
+    )
+
+
+class MapSDF:
+    def __init__(self, sdf, extent):
+        """
+        sdf: [B, H, W] signed distance [m] to the boundary of the drivable area (negative inside) on
+            the grid x = linspace(-extent, extent, W), y = linspace(-extent, extent, H)
+        extent: [m] half size of the grid around the ego
+        """
+        self.sdf = sdf
+        self.extent = extent
+
+    @classmethod
+    @torch.no_grad()
+    def from_lanes(cls, lanes, extent=80.0, resolution=0.5, max_distance=3.0, chunk_size=256):
+        """
+        Rasterize the drivable area of the lanes (see lane_segments), truncated at `max_distance`
+        [m] outside (also without any lane).
+
+        extent: [m] half size of the grid around the ego
+        resolution: [m] cell size
+        chunk_size: segments rasterized at once (bounds the memory)
+        """
+        start, end, width, valid = lane_segments(lanes)
+        B, device, dtype = lanes.shape[0], lanes.device, lanes.dtype
+        size = int(round(2 * extent / resolution)) + 1
+        sdf = torch.full((B * size * size,), max_distance, device=device, dtype=dtype)
+        if not valid.any():
+            return cls(sdf.reshape(B, size, size), extent)
+
+        # the valid segments of all scenes
+        batch = valid.nonzero()[:, 0] * size * size  # [M]
+        start, end, width = start[valid], end[valid], width[valid]  # [M, 2]
+
+        # every cell closer than max_distance to a capsule is in the window around its segment
+        direction = end - start
+        length2 = (direction**2).sum(dim=-1).clamp(min=1e-6)  # [M]
+        reach = torch.sqrt(length2) / 2 + width.amax(dim=-1) + max_distance  # [M]
+        half = math.ceil(reach.max().item() / resolution) + 1
+        window = torch.arange(-half, half + 1, device=device)  # [K]
+        center = torch.round(((start + end) / 2 + extent) / resolution).long()  # [M, 2]
+
+        for i in range(0, start.shape[0], chunk_size):
+            chunk = slice(i, i + chunk_size)
+            ix = center[chunk, None, None, 0] + window[None, None, :]  # [C, 1, K]
+            iy = center[chunk, None, None, 1] + window[None, :, None]  # [C, K, 1]
+            cells = torch.stack(
+                torch.broadcast_tensors(ix * resolution - extent, iy * resolution - extent), dim=-1
+            ).to(dtype)  # [C, K, K, 2]
+
+            d = direction[chunk, None, None]
+            w = width[chunk, None, None]
+            offset = cells - start[chunk, None, None]
+            s = ((offset * d).sum(dim=-1) / length2[chunk, None, None]).clamp(0, 1)
+            distance = torch.norm(offset - s[..., None] * d, dim=-1)
+            distance = distance - (w[..., 0] + s * (w[..., 1] - w[..., 0]))  # [C, K, K]
+
+            inside = ((ix >= 0) & (ix < size) & (iy >= 0) & (iy < size)).expand_as(distance)
+            index = batch[chunk, None, None] + iy * size + ix
+            sdf.scatter_reduce_(
+                0, index[inside], distance[inside].clamp(max=max_distance), reduce="amin"
+            )
+        return cls(sdf.reshape(B, size, size), extent)
+
+    def __call__(self, points):
+        """
+        Bilinear lookup, points outside the grid take the value at its border.
+
+        points: [B, ..., 2] (x, y) ego-centric positions
+        return: [B, ...] signed distance [m]
+        """
+        B = points.shape[0]
+        grid = (points / self.extent).reshape(B, -1, 1, 2).to(self.sdf.dtype)
+        value = F.grid_sample(
+            self.sdf[:, None], grid, mode="bilinear", padding_mode="border", align_corners=True
+        )  # [B, 1, M, 1]
+        return value.reshape(points.shape[:-1])
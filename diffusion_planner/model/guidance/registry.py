@@ -0,0 +1,25 @@
+"""Guidance terms selectable by name (planner yaml, see GuidanceWrapper).
+
+A guidance term takes the GuidanceContext of a sampler step and returns the [B] energy (higher is
+better) whose gradient w.r.t. the trajectories guides the sampler.
+"""
+
+from typing import Callable, Dict, Optional, Tuple
+
+GUIDANCE_TERMS: Dict[str, Callable] = {}
+
+
+def register_guidance(name: str, time_window: Optional[Tuple[float, float]] = None):
+    """
+    Register a guidance term under `name`, it acts in the open interval `time_window` of diffusion
+    times by default (None: at all times).
+    """
+
+    def register(guidance_fn):
+        if name in GUIDANCE_TERMS:
+            raise ValueError(f"Guidance term {name} is already registered")
+        guidance_fn.time_window = time_window
+        GUIDANCE_TERMS[name] = guidance_fn
+        return guidance_fn
+
+    return register
@@ -0,0 +1,95 @@
+"""Scores for selecting one plan among the samples drawn for a scene.
+
+A score function takes
+    samples: [B, S, P, T, 4] (x, y, cos, sin) ego-centric future states of S samples per scene
+    inputs: Dict[str, torch.Tensor] unnormalized model inputs of the B scenes
+and returns [B, S] scores (higher is better), computed for all samples at once.
+"""
+
+import torch
+
+from diffusion_planner.model.guidance.collision import (
+    COG_TO_REAR,
+    batch_signed_distance_rect,
+    center_rect_to_points,
+    ego_size,
+)
+from diffusion_planner.model.guidance.map_sdf import MapSDF
+
+
+def collision_score(samples, inputs, margin=0.5):
+    """
+    Minus the summed penetration (inflated by `margin`) of the ego box into the boxes of the
+    neighbors predicted in the same sample.
+    """
+    B, S, P, T, _ = samples.shape
+    Pn = P - 1
+    neighbor_current_mask = inputs["neighbor_current_mask"][:, :Pn]  # [B, Pn]
+
+    # a degenerate (0, 0) heading would collapse the boxes, fall back to the x axis
+    heading_norm = torch.norm(samples[..., 2:], dim=-1, keepdim=True)
+    heading = torch.where(
+        heading_norm > 1e-6,
+        samples[..., 2:] / heading_norm.clamp(min=1e-6),
+        torch.tensor([1.0, 0.0], device=samples.device),
+    )
+    ego = samples[:, :, 0]  # [B, S, T, 4]
+    ego = torch.cat([ego[..., :2] + heading[:, :, 0] * COG_TO_REAR, heading[:, :, 0]], dim=-1)
+    neighbors = torch.cat([samples[:, :, 1:, :, :2], heading[:, :, 1:]], dim=-1)
+
+    ego_lw = torch.tensor(ego_size, device=samples.device).expand(B, S, T, 2)
+    neighbor_lw = inputs["neighbor_agents_past"][:, :Pn, -1, [7, 6]]  # [B, Pn, 2]
+    neighbor_lw = neighbor_lw[:, None, :, None, :].expand(B, S, Pn, T, 2)
+
+    ego_bbox = center_rect_to_points(torch.cat([ego, ego_lw], dim=-1).reshape(-1, 6))
+    ego_bbox = ego_bbox.reshape(B, S, 1, T, 4, 2).expand(B, S, Pn, T, 4, 2)
+    neighbor_bbox = center_rect_to_points(
+        torch.cat([neighbors, neighbor_lw], dim=-1).reshape(-1, 6)
+    )
+
+    distance = batch_signed_distance_rect(
+        ego_bbox.reshape(-1, 4, 2), neighbor_bbox.reshape(-1, 4, 2)
+    ).reshape(B, S, Pn, T)
+    penetration = torch.relu(margin - distance)
+    penetration = penetration.masked_fill(neighbor_current_mask[:, None, :, None], 0.0)
+
+    return -penetration.amax(dim=2).sum(dim=-1)
+
+
+def progress_score(samples, inputs):
+    """
+    Length of the ego path.
+    """
+    ego_xy = samples[:, :, 0, :, :2]  # [B, S, T, 2]
+    ego_xy = torch.cat([torch.zeros_like(ego_xy[:, :, :1]), ego_xy], dim=2)
+    return torch.norm(ego_xy[:, :, 1:] - ego_xy[:, :, :-1], dim=-1).sum(dim=-1)
+
+
+def drivable_area_score(samples, inputs, margin=0.0, map_sdf=None):
+    """
+    Minus the summed distance [m] by which the ego box corners leave the drivable area (shrunk by
+    `margin`), map_sdf: the MapSDF of the scenes, rasterized from inputs["lanes"] if None.
+    """
+    B, S, P, T, _ = samples.shape
+    if map_sdf is None:
+        map_sdf = MapSDF.from_lanes(inputs["lanes"])
+
+    heading_norm = torch.norm(samples[:, :, 0, :, 2:], dim=-1, keepdim=True)
+    heading = torch.where(
+        heading_norm > 1e-6,
+        samples[:, :, 0, :, 2:] / heading_norm.clamp(min=1e-6),
+        torch.tensor([1.0, 0.0], device=samples.device),
+    )  # [B, S, T, 2]
+    ego = torch.cat([samples[:, :, 0, :, :2] + heading * COG_TO_REAR, heading], dim=-1)
+    ego_lw = torch.tensor(ego_size, device=samples.device).expand(B, S, T, 2)
+    corners = center_rect_to_points(torch.cat([ego, ego_lw], dim=-1).reshape(-1, 6))
+
+    outside = torch.relu(map_sdf(corners.reshape(B, -1, 2)) + margin)  # [B, S * T * 4]
+    return -outside.reshape(B, S, -1).sum(dim=-1)
+
+
+def default_score(samples, inputs):
+    """
+    Avoid collisions first, then prefer progress.
+    """
+    return 10.0 * collision_score(samples, inputs) + 0.1 * progress_score(samples, inputs)
@@ -4,17 +4,41 @@ import torch
 import torch.nn as nn
 from timm.models.layers import Mlp
 
-from diffusion_planner.model.diffusion_utils.sampling import dpm_sampler
+from diffusion_planner.model.diffusion_utils.sampling import (
+    DPM_SOLVERS,
+    check_time_budget,
+    dpm_sampler,
+    noise_warm_start,
+    sampler_config,
+    warm_start_time,
+)
 from diffusion_planner.model.diffusion_utils.sde import SDE, VPSDE_linear
 from diffusion_planner.model.flow_matching_utils.ode_solver import (
-    euler_integration,
-    heun_integration,
-    rk4_integration,
+    ADAPTIVE_ODE_SOLVERS,
+    ODE_SOLVERS,
 )
 from diffusion_planner.model.module.dit import DiTBlock, FinalLayer, TimestepEmbedder
+from diffusion_planner.model.module.encoder import static_shape_enabled
 from diffusion_planner.model.module.mixer import MixerBlock
 from diffusion_planner.utils.normalizer import ObservationNormalizer, StateNormalizer
 
+# std of the noise the diffusion sampler starts from (flow matching starts from N(0, 1))
+DIFFUSION_PRIOR_STD = 0.5
+
+
+def repeat_samples(x, num_samples):
+    """
+    Repeat tensors (also in dicts, lists and tuples) along the batch dimension:
+    [B, ...] -> [B * num_samples, ...], the samples of a scene are contiguous.
+    """
+    if isinstance(x, torch.Tensor):
+        return x.repeat_interleave(num_samples, dim=0)
+    if isinstance(x, dict):
+        return {k: repeat_samples(v, num_samples) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(repeat_samples(v, num_samples) for v in x)
+    return x
+
 
 class Decoder(nn.Module):
     def __init__(self, config):
@@ -32,6 +56,7 @@ class Decoder(nn.Module):
                 config.lane_len,
                 drop_path_rate=config.encoder_drop_path_rate,
                 hidden_dim=config.hidden_dim,
+                static_shape=getattr(config, "static_shape_encoder", "inference"),
             ),
             depth=config.decoder_depth,
             output_dim=(config.future_len + 1) * 4,  # x, y, cos, sin
@@ -49,12 +74,39 @@ class Decoder(nn.Module):
             config.guidance_fn if config.__dict__.get("guidance_fn") is not None else None
         )
         self._model_type = config.diffusion_model_type
+        self.sampler = getattr(config, "sampler", None)
 
     @property
     def sde(self):
         return self._sde
 
-    def forward(self, encoder_outputs, inputs):
+    @property
+    def sampler(self):
+        return self._sampler
+
+    @sampler.setter
+    def sampler(self, sampler):
+        """
+        sampler: {"solver", "steps", ...}, see sampler_config
+        """
+        self._sampler = sampler_config(self._model_type, sampler)
+
+    def model_condition(self, ego_neighbor_encoding, route_lanes, neighbor_current_mask):
+        """
+        Keyword arguments of the DiT that do not change during sampling: the route is encoded and
+        the cross-attention keys and values are projected once for all solver steps.
+        """
+        return {
+            "cross_c": ego_neighbor_encoding,
+            "route_lanes": route_lanes,
+            "neighbor_current_mask": neighbor_current_mask,
+            "route_encoding": self.dit.route_encoder(route_lanes),
+            "cross_kv": self.dit.cross_attn_kv(ego_neighbor_encoding),
+        }
+
+    def forward(
+        self, encoder_outputs, inputs, num_samples=1, score_fn=None, warm_start=None, deadline=None
+    ):
         """
         Diffusion decoder process.
 
@@ -82,9 +134,22 @@ class Decoder(nn.Module):
                     ...
                     [training-only] "score": Predicted future states, [B, P, 1 + V_future, 4]
                     [inference-only] "prediction": Predicted future states, [B, P, V_future, 4]
+                    [num_samples > 1] "samples": All sampled future states, [B, S, P, V_future, 4]
+                    [num_samples > 1] "scores": score_fn of the samples, [B, S]
+                    [early exit or deadline] "sampler_steps": number of solver steps run
+                    [deadline] "truncated": whether the deadline stopped the sampler
                     ...
                 }
 
+            num_samples: number of plans drawn per scene from the same encoding
+            score_fn: score_fn(samples, inputs) -> [B, S], see guidance/scoring.py.
+                The best sample is the prediction (the first one if not given).
+            warm_start: {"prediction": [B, P, V_future, 4], "steps": int} start from a previous
+                prediction (in the current frame) noised to the time of the last `steps` sampler
+                steps, and only run these (SDEdit)
+            deadline: sampling.Deadline, the sampler returns its current data estimate once one
+                more step would end after it
+
         """
         # Extract ego & neighbor current states
         ego_current = inputs["ego_current_state"][:, None, :4]
@@ -119,73 +184,135 @@ class Decoder(nn.Module):
                 ).reshape(B, P, -1, 4)
             }
         else:
-            if self._model_type == "flow_matching":
-                # [B, 1 + predicted_neighbor_num, (1 + V_future) * 4]
-                x = torch.cat(
-                    [
-                        current_states[:, :, None],
-                        torch.randn(B, P, self._future_len, 4).to(current_states.device),
-                    ],
-                    dim=2,
-                ).reshape(B, P, -1)
-                NUM_STEP = 10
-                func = partial(
-                    self.dit,
-                    cross_c=ego_neighbor_encoding,
-                    route_lanes=route_lanes,
-                    neighbor_current_mask=neighbor_current_mask,
-                )
-                x = euler_integration(func, x, NUM_STEP)
-                # x = heun_integration(func, x, NUM_STEP)
-                # x = rk4_integration(func, x, NUM_STEP)
-                x = self._state_normalizer.inverse(x.reshape(B, P, -1, 4))[:, :, 1:]
-                return {"prediction": x}
+            model_condition = self.model_condition(
+                ego_neighbor_encoding, route_lanes, neighbor_current_mask
+            )
 
+            scene_inputs = inputs
+            if num_samples > 1:
+                # the encoding is shared, only the conditions are repeated for every sample
+                model_condition = repeat_samples(model_condition, num_samples)
+                current_states = repeat_samples(current_states, num_samples)
+                warm_start = repeat_samples(warm_start, num_samples)
+                if self._guidance_fn is not None:
+                    inputs = repeat_samples(inputs, num_samples)
+                B = B * num_samples
+
+            noise = torch.randn(B, P, self._future_len, 4).to(current_states.device)
+            if self._model_type != "flow_matching":
+                noise = noise * DIFFUSION_PRIOR_STD
+            steps = self._sampler["steps"]
+            t_start = 0.0 if self._model_type == "flow_matching" else None
+            if warm_start is not None:
+                steps = warm_start["steps"]
+                t_start = warm_start_time(self._model_type, self._sampler, steps)
+                noise = noise_warm_start(
+                    self._model_type,
+                    self._state_normalizer(warm_start["prediction"]),
+                    noise,
+                    t_start,
+                )
             # [B, 1 + predicted_neighbor_num, (1 + V_future) * 4]
-            xT = torch.cat(
-                [
-                    current_states[:, :, None],
-                    torch.randn(B, P, self._future_len, 4).to(current_states.device) * 0.5,
-                ],
-                dim=2,
-            ).reshape(B, P, -1)
-
-            def initial_state_constraint(xt, t, step):
-                xt = xt.reshape(B, P, -1, 4)
-                xt[:, :, 0, :] = current_states
-                return xt.reshape(B, P, -1)
-
-            x0 = dpm_sampler(
-                self.dit,
-                xT,
-                other_model_params={
-                    "cross_c": ego_neighbor_encoding,
-                    "route_lanes": route_lanes,
-                    "neighbor_current_mask": neighbor_current_mask,
-                },
-                dpm_solver_params={
-                    "correcting_xt_fn": initial_state_constraint,
-                },
-                model_wrapper_params={
-                    "classifier_fn": self._guidance_fn,
-                    "classifier_kwargs": {
-                        "model": self.dit,
-                        "model_condition": {
-                            "cross_c": ego_neighbor_encoding,
-                            "route_lanes": route_lanes,
-                            "neighbor_current_mask": neighbor_current_mask,
+            xT = torch.cat([current_states[:, :, None], noise], dim=2).reshape(B, P, -1)
+
+            if self._model_type == "flow_matching":
+                func = partial(self.dit, **model_condition)
+                options = {}
+                if self._sampler["solver"] in ADAPTIVE_ODE_SOLVERS:
+                    options = {"tol": self._sampler["tol"], "max_nfe": self._sampler["max_nfe"]}
+                x0, sampler_info = ODE_SOLVERS[self._sampler["solver"]](
+                    func, xT, steps, t_start, deadline, return_info=True, **options
+                )
+            else:
+
+                def initial_state_constraint(xt, t, step):
+                    xt = xt.reshape(B, P, -1, 4)
+                    xt[:, :, 0, :] = current_states
+                    return xt.reshape(B, P, -1)
+
+                if deadline is not None:
+                    check_time_budget(self._sampler)
+                guidance_inputs = None
+                if self._guidance_fn is not None:
+                    # de-normalized once, not at every guided step
+                    guidance_inputs = self._observation_normalizer.inverse(inputs)
+                early_exit_fn = None
+                if self._sampler["early_exit"] is not None:
+                    early_exit_fn = partial(
+                        self.prediction_change,
+                        neighbor_current_mask=model_condition["neighbor_current_mask"],
+                    )
+
+                x0, sampler_info = dpm_sampler(
+                    self.dit,
+                    xT,
+                    other_model_params=model_condition,
+                    dpm_solver_params={
+                        "correcting_xt_fn": initial_state_constraint,
+                    },
+                    model_wrapper_params={
+                        "classifier_fn": self._guidance_fn,
+                        "classifier_kwargs": {
+                            "inputs": guidance_inputs,
+                            "state_normalizer": self._state_normalizer,
                         },
-                        "inputs": inputs,
-                        "observation_normalizer": self._observation_normalizer,
-                        "state_normalizer": self._state_normalizer,
+                        "guidance_scale": self._sampler["guidance_scale"],
+                        "guidance_type": "classifier"
+                        if self._guidance_fn is not None
+                        else "uncond",
                     },
-                    "guidance_scale": 0.5,
-                    "guidance_type": "classifier" if self._guidance_fn is not None else "uncond",
-                },
-            )
+                    steps=steps,
+                    order=min(self._sampler["order"], steps),
+                    skip_type=self._sampler["skip_type"],
+                    method=DPM_SOLVERS[self._sampler["solver"]],
+                    denoise_to_zero=self._sampler["denoise_to_zero"],
+                    t_start=t_start,
+                    early_exit_fn=early_exit_fn,
+                    early_exit_tol=self._sampler["early_exit_tol"],
+                    early_exit_min_steps=self._sampler["early_exit_min_steps"],
+                    deadline=deadline,
+                )
             x0 = self._state_normalizer.inverse(x0.reshape(B, P, -1, 4))[:, :, 1:]
 
-            return {"prediction": x0}
+            if num_samples == 1:
+                outputs = {"prediction": x0}
+            else:
+                samples = x0.reshape(B // num_samples, num_samples, *x0.shape[1:])
+                outputs = self.select_sample(samples, scene_inputs, score_fn)
+            if self._sampler["early_exit"] is not None or deadline is not None:
+                outputs["sampler_steps"] = sampler_info["steps"]
+            if "nfe" in sampler_info:
+                outputs["sampler_steps"] = sampler_info["steps"]
+                outputs["sampler_nfe"] = sampler_info["nfe"]
+            if deadline is not None:
+                outputs["truncated"] = sampler_info["truncated"]
+            return outputs
+
+    def prediction_change(self, x0_prev, x0, neighbor_current_mask):
+        """
+        [m] largest change of the predicted future positions of the early exit tokens between two
+        data predictions [B, P, (1 + V_future) * 4], [B]
+        """
+        B, P, _ = x0.shape
+        change = (x0 - x0_prev).reshape(B, P, -1, 4) * self._state_normalizer.std.to(x0.device)
+        change = torch.norm(change[:, :, 1:, :2], dim=-1)  # [B, P, V_future]
+        if self._sampler["early_exit"] == "ego":
+            return change[:, 0].amax(dim=-1)
+        change[:, 1:] = change[:, 1:].masked_fill(neighbor_current_mask[..., None], 0.0)
+        return change.amax(dim=(1, 2))
+
+    def select_sample(self, samples, inputs, score_fn):
+        """
+        samples: [B, S, P, V_future, 4]
+        inputs: normalized model inputs of the B scenes
+        """
+        if score_fn is None:
+            return {"prediction": samples[:, 0], "samples": samples}
+
+        scores = score_fn(samples, self._observation_normalizer.inverse(inputs))  # [B, S]
+        best = scores.argmax(dim=1)
+        prediction = samples[torch.arange(samples.shape[0], device=samples.device), best]
+        return {"prediction": prediction, "samples": samples, "scores": scores}
 
 
 class RouteEncoder(nn.Module):
@@ -197,10 +324,12 @@ class RouteEncoder(nn.Module):
         hidden_dim=192,
         tokens_mlp_dim=32,
         channels_mlp_dim=64,
+        static_shape="inference",
     ):
         super().__init__()
 
         self._channel = channels_mlp_dim
+        self.static_shape = static_shape
 
         self.channel_pre_project = Mlp(
             in_features=4,
@@ -242,7 +371,9 @@ class RouteEncoder(nn.Module):
         x = x.view(B, P * V, -1)
 
         valid_indices = ~mask_b.view(-1)
-        x = x[valid_indices]
+        static_shape = static_shape_enabled(self)
+        if not static_shape:
+            x = x[valid_indices]
 
         x = self.channel_pre_project(x)
         x = x.permute(0, 2, 1)
@@ -254,8 +385,11 @@ class RouteEncoder(nn.Module):
 
         x = self.emb_project(self.norm(x))
 
-        x_result = torch.zeros((B, x.shape[-1]), device=x.device)
-        x_result[valid_indices] = x  # Fill in valid parts
+        if static_shape:
+            x_result = x * valid_indices.unsqueeze(-1)
+        else:
+            x_result = torch.zeros((B, x.shape[-1]), device=x.device)
+            x_result[valid_indices] = x  # Fill in valid parts
 
         return x_result.view(B, -1)
 
@@ -300,12 +434,29 @@ class DiT(nn.Module):
     def model_type(self):
         return self._model_type
 
-    def forward(self, x, t, cross_c, route_lanes, neighbor_current_mask):
+    def cross_attn_kv(self, cross_c):
+        """
+        Cross-attention keys and values of every block, to be reused across solver steps.
+        """
+        return [block.cross_attn_kv(cross_c) for block in self.blocks]
+
+    def forward(
+        self,
+        x,
+        t,
+        cross_c,
+        route_lanes,
+        neighbor_current_mask,
+        route_encoding=None,
+        cross_kv=None,
+    ):
         """
         Forward pass of DiT.
         x: (B, P, output_dim)   -> Embedded out of DiT
         t: (B,)
         cross_c: (B, N, D)      -> Cross-Attention context
+        route_encoding: (B, D)  -> route_encoder(route_lanes) if already computed (inference)
+        cross_kv: [(k, v)]      -> cross_attn_kv(cross_c) if already computed (inference)
         """
         B, P, _ = x.shape
 
@@ -321,15 +472,18 @@ class DiT(nn.Module):
         x_embedding = x_embedding[None, :, :].expand(B, -1, -1)  # (B, P, D)
         x = x + x_embedding
 
-        route_encoding = self.route_encoder(route_lanes)
+        if route_encoding is None:
+            route_encoding = self.route_encoder(route_lanes)
         y = route_encoding
         y = y + self.t_embedder(t)
 
         attn_mask = torch.zeros((B, P), dtype=torch.bool, device=x.device)
         attn_mask[:, 1:] = neighbor_current_mask
 
-        for block in self.blocks:
-            x = block(x, cross_c, y, attn_mask)
+        if cross_kv is None:
+            cross_kv = [None] * len(self.blocks)
+        for block, block_cross_kv in zip(self.blocks, cross_kv):
+            x = block(x, cross_c, y, attn_mask, block_cross_kv)
 
         x = self.final_layer(x, y)
 
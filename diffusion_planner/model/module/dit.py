@@ -2,6 +2,7 @@ import math
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.models.layers import Mlp
 
 
@@ -90,7 +91,35 @@ class DiTBlock(nn.Module):
             in_features=dim, hidden_features=mlp_hidden_dim, act_layer=approx_gelu, drop=0
         )
 
-    def forward(self, x, cross_c, y, attn_mask):
+    def cross_attn_kv(self, cross_c):
+        """
+        Project the cross-attention context into per-head keys and values.
+        cross_c: (B, N, D)
+        return: k, v (B, heads, N, D // heads)
+        """
+        B, N, D = cross_c.shape
+        H = self.cross_attn.num_heads
+        w_k, w_v = self.cross_attn.in_proj_weight[D:].chunk(2, dim=0)
+        b_k, b_v = self.cross_attn.in_proj_bias[D:].chunk(2, dim=0)
+        k = F.linear(cross_c, w_k, b_k).view(B, N, H, D // H).transpose(1, 2)
+        v = F.linear(cross_c, w_v, b_v).view(B, N, H, D // H).transpose(1, 2)
+        return k, v
+
+    def cached_cross_attn(self, x, cross_kv):
+        """
+        Same as self.cross_attn(x, cross_c, cross_c)[0] with the keys and values of
+        cross_c already projected by cross_attn_kv (inference only, no dropout).
+        """
+        B, P, D = x.shape
+        H = self.cross_attn.num_heads
+        k, v = cross_kv
+        q = F.linear(x, self.cross_attn.in_proj_weight[:D], self.cross_attn.in_proj_bias[:D])
+        q = q.view(B, P, H, D // H).transpose(1, 2)
+        x = F.scaled_dot_product_attention(q, k, v)
+        x = x.transpose(1, 2).reshape(B, P, D)
+        return self.cross_attn.out_proj(x)
+
+    def forward(self, x, cross_c, y, attn_mask, cross_kv=None):
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(
             y
         ).chunk(6, dim=1)
@@ -105,7 +134,10 @@ class DiTBlock(nn.Module):
         modulated_x = modulate(self.norm2(x), shift_mlp, scale_mlp)
         x = x + gate_mlp.unsqueeze(1) * self.mlp1(modulated_x)
 
-        x = x + self.cross_attn(self.norm3(x), cross_c, cross_c)[0]
+        if cross_kv is None:
+            x = x + self.cross_attn(self.norm3(x), cross_c, cross_c)[0]
+        else:
+            x = x + self.cached_cross_attn(self.norm3(x), cross_kv)
         x = x + self.mlp2(self.norm4(x))
 
         return x
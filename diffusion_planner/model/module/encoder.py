@@ -1,16 +1,32 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.layers import DropPath
 from timm.models.layers import Mlp
 
 from diffusion_planner.model.module.mixer import MixerBlock
 
+STATIC_SHAPE_MODES = ["never", "inference", "always"]
+
+
+def static_shape_enabled(module):
+    """
+    Whether the module runs its dense path, which processes padded rows too and zeroes them with
+    the mask instead of gathering the valid rows, so that all shapes are static
+    (torch.compile full graph, CUDA graphs, no host syncs).
+    module.static_shape: "never", "inference" (eval mode only) or "always"
+    """
+    return module.static_shape == "always" or (
+        module.static_shape == "inference" and not module.training
+    )
+
 
 class Encoder(nn.Module):
     def __init__(self, config):
         super().__init__()
 
         self.hidden_dim = config.hidden_dim
+        self.static_shape = getattr(config, "static_shape_encoder", "inference")
 
         self.token_num = config.agent_num + config.static_objects_num + config.lane_num
 
@@ -19,17 +35,20 @@ class Encoder(nn.Module):
             drop_path_rate=config.encoder_drop_path_rate,
             hidden_dim=config.hidden_dim,
             depth=config.encoder_depth,
+            static_shape=self.static_shape,
         )
         self.static_encoder = StaticFusionEncoder(
             config.static_objects_state_dim,
             drop_path_rate=config.encoder_drop_path_rate,
             hidden_dim=config.hidden_dim,
+            static_shape=self.static_shape,
         )
         self.lane_encoder = LaneFusionEncoder(
             config.lane_len,
             drop_path_rate=config.encoder_drop_path_rate,
             hidden_dim=config.hidden_dim,
             depth=config.encoder_depth,
+            static_shape=self.static_shape,
         )
 
         self.fusion = FusionEncoder(
@@ -38,6 +57,7 @@ class Encoder(nn.Module):
             drop_path_rate=config.encoder_drop_path_rate,
             depth=config.encoder_depth,
             device=config.device,
+            packed=getattr(config, "fusion_packed_attention", False),
         )
 
         # position embedding encode x, y, cos, sin, type
@@ -71,11 +91,14 @@ class Encoder(nn.Module):
             B * self.token_num, -1
         )
         encoding_mask = torch.cat([neighbors_mask, static_mask, lanes_mask], dim=1).view(-1)
-        encoding_pos = self.pos_emb(encoding_pos[~encoding_mask])
-        encoding_pos_result = torch.zeros(
-            (B * self.token_num, self.hidden_dim), device=encoding_pos.device
-        )
-        encoding_pos_result[~encoding_mask] = encoding_pos  # Fill in valid parts
+        if static_shape_enabled(self):
+            encoding_pos_result = self.pos_emb(encoding_pos) * (~encoding_mask).unsqueeze(-1)
+        else:
+            encoding_pos = self.pos_emb(encoding_pos[~encoding_mask])
+            encoding_pos_result = torch.zeros(
+                (B * self.token_num, self.hidden_dim), device=encoding_pos.device
+            )
+            encoding_pos_result[~encoding_mask] = encoding_pos  # Fill in valid parts
 
         encoding_input = encoding_input + encoding_pos_result.view(B, self.token_num, -1)
 
@@ -105,6 +128,37 @@ class SelfAttentionBlock(nn.Module):
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
 
+    def forward_packed(self, x, q_offsets, kv_offsets, is_key):
+        """
+        Inference-only forward of the tokens of all scenes packed into one sequence.
+        x: (N, D) packed tokens
+        q_offsets: (B + 1,) start of each scene in x
+        kv_offsets: (B + 1,) start of each scene in x[is_key]
+        is_key: (N,) tokens that are attended to (the others only query)
+        """
+        x = x + self.packed_attention(self.norm1(x), x[is_key], q_offsets, kv_offsets)
+        x = x + self.mlp(self.norm2(x))
+        return x
+
+    def packed_attention(self, query, key, q_offsets, kv_offsets):
+        """
+        self.attn(query, key, key) with block-diagonal attention between the scenes.
+        """
+        N, D = query.shape
+        H = self.attn.num_heads
+        w_q, w_k, w_v = self.attn.in_proj_weight.chunk(3, dim=0)
+        b_q, b_k, b_v = self.attn.in_proj_bias.chunk(3, dim=0)
+        q = F.linear(query, w_q, b_q).view(-1, H, D // H)
+        k = F.linear(key, w_k, b_k).view(-1, H, D // H)
+        v = F.linear(key, w_v, b_v).view(-1, H, D // H)
+
+        # (B, H, jagged, D // H)
+        q = torch.nested.nested_tensor_from_jagged(q, offsets=q_offsets).transpose(1, 2)
+        k = torch.nested.nested_tensor_from_jagged(k, offsets=kv_offsets).transpose(1, 2)
+        v = torch.nested.nested_tensor_from_jagged(v, offsets=kv_offsets).transpose(1, 2)
+        x = F.scaled_dot_product_attention(q, k, v).transpose(1, 2).values()
+        return self.attn.out_proj(x.reshape(N, D))
+
 
 class AgentFusionEncoder(nn.Module):
     def __init__(
@@ -115,11 +169,13 @@ class AgentFusionEncoder(nn.Module):
         depth=3,
         tokens_mlp_dim=64,
         channels_mlp_dim=128,
+        static_shape="inference",
     ):
         super().__init__()
 
         self._hidden_dim = hidden_dim
         self._channel = channels_mlp_dim
+        self.static_shape = static_shape
 
         self.type_emb = nn.Linear(3, channels_mlp_dim)
 
@@ -170,7 +226,9 @@ class AgentFusionEncoder(nn.Module):
         x = x.view(B * P, V, -1)
 
         valid_indices = ~mask_p.view(-1)
-        x = x[valid_indices]
+        static_shape = static_shape_enabled(self)
+        if not static_shape:
+            x = x[valid_indices]
 
         x = self.channel_pre_project(x)
         x = x.permute(0, 2, 1)
@@ -183,23 +241,30 @@ class AgentFusionEncoder(nn.Module):
         x = torch.mean(x, dim=1)
 
         neighbor_type = neighbor_type.view(B * P, -1)
-        neighbor_type = neighbor_type[valid_indices]
+        if not static_shape:
+            neighbor_type = neighbor_type[valid_indices]
         type_embedding = self.type_emb(neighbor_type)  # Type embedding for valid data
         x = x + type_embedding
 
         x = self.emb_project(self.norm(x))
 
-        x_result = torch.zeros((B * P, x.shape[-1]), device=x.device)
-        x_result[valid_indices] = x  # Fill in valid parts
+        if static_shape:
+            x_result = x * valid_indices.unsqueeze(-1)
+        else:
+            x_result = torch.zeros((B * P, x.shape[-1]), device=x.device)
+            x_result[valid_indices] = x  # Fill in valid parts
 
         return x_result.view(B, P, -1), mask_p.reshape(B, -1), pos.view(B, P, -1)
 
 
 class StaticFusionEncoder(nn.Module):
-    def __init__(self, dim, drop_path_rate=0.3, hidden_dim=192, device="cuda"):
+    def __init__(
+        self, dim, drop_path_rate=0.3, hidden_dim=192, device="cuda", static_shape="inference"
+    ):
         super().__init__()
 
         self._hidden_dim = hidden_dim
+        self.static_shape = static_shape
 
         self.projection = Mlp(
             in_features=dim,
@@ -220,12 +285,15 @@ class StaticFusionEncoder(nn.Module):
         pos[..., -3:] = 0.0
         pos[..., -2] = 1.0
 
-        x_result = torch.zeros((B * P, self._hidden_dim), device=x.device)
-
         mask_p = torch.sum(torch.ne(x[..., :10], 0), dim=-1).to(x.device) == 0
 
         valid_indices = ~mask_p.view(-1)
 
+        if static_shape_enabled(self):
+            x_result = self.projection(x.view(B * P, -1)) * valid_indices.unsqueeze(-1)
+            return x_result.view(B, P, -1), mask_p.view(B, P), pos.view(B, P, -1)
+
+        x_result = torch.zeros((B * P, self._hidden_dim), device=x.device)
         if valid_indices.sum() > 0:
             x = x.view(B * P, -1)
             x = x[valid_indices]
@@ -244,11 +312,13 @@ class LaneFusionEncoder(nn.Module):
         depth=3,
         tokens_mlp_dim=64,
         channels_mlp_dim=128,
+        static_shape="inference",
     ):
         super().__init__()
 
         self._lane_len = lane_len
         self._channel = channels_mlp_dim
+        self.static_shape = static_shape
 
         self.speed_limit_emb = nn.Linear(1, channels_mlp_dim)
         self.unknown_speed_emb = nn.Embedding(1, channels_mlp_dim)
@@ -305,7 +375,9 @@ class LaneFusionEncoder(nn.Module):
         x = x.view(B * P, V, -1)
 
         valid_indices = ~mask_p.view(-1)
-        x = x[valid_indices]
+        static_shape = static_shape_enabled(self)
+        if not static_shape:
+            x = x[valid_indices]
 
         x = self.channel_pre_project(x)
         x = x.permute(0, 2, 1)
@@ -321,6 +393,18 @@ class LaneFusionEncoder(nn.Module):
         has_speed_limit = has_speed_limit.view(B * P, 1)
         traffic = traffic.view(B * P, -1)
 
+        if static_shape:
+            speed_limit_embedding = torch.where(
+                has_speed_limit,
+                self.speed_limit_emb(speed_limit),
+                self.unknown_speed_emb.weight,
+            )
+            x = x + speed_limit_embedding + self.traffic_emb(traffic)
+            x = self.emb_project(self.norm(x))
+
+            x_result = x * valid_indices.unsqueeze(-1)
+            return x_result.view(B, P, -1), mask_p.reshape(B, -1), pos.view(B, P, -1)
+
         # Apply embedding directly to valid speed limit data
         has_speed_limit = has_speed_limit[valid_indices].squeeze(-1)
         speed_limit = speed_limit[valid_indices].squeeze(-1)
@@ -354,10 +438,19 @@ class LaneFusionEncoder(nn.Module):
 
 
 class FusionEncoder(nn.Module):
-    def __init__(self, hidden_dim=192, num_heads=6, drop_path_rate=0.3, depth=3, device="cuda"):
+    def __init__(
+        self,
+        hidden_dim=192,
+        num_heads=6,
+        drop_path_rate=0.3,
+        depth=3,
+        device="cuda",
+        packed=False,
+    ):
         super().__init__()
 
         dpr = drop_path_rate
+        self.packed = packed
 
         self.blocks = nn.ModuleList(
             [SelfAttentionBlock(hidden_dim, num_heads, dropout=dpr) for i in range(depth)]
@@ -368,7 +461,42 @@ class FusionEncoder(nn.Module):
     def forward(self, x, mask):
         mask[:, 0] = False
 
+        if self.packed and not self.training:
+            return self.forward_packed(x, mask)
+
         for b in self.blocks:
             x = b(x, mask)
 
         return self.norm(x)
+
+    def forward_packed(self, x, mask):
+        """
+        Same as forward in eval mode, but only the valid tokens of the batch are computed,
+        packed into one sequence with per-scene offsets.
+
+        The padded tokens are not attended to, but they are still queries and their outputs are
+        used by the decoder. All padded tokens of a scene start from the same state and attend to
+        the same keys, so a single query-only token per scene stands for all of them.
+        """
+        B, N, D = x.shape
+        valid = ~mask
+        has_padding = mask.any(dim=1)
+
+        # the first padded token of every scene is appended as its representative
+        first_padded = mask.int().argmax(dim=1)
+        padding_token = x[torch.arange(B, device=x.device), first_padded]
+        tokens = torch.cat([x, padding_token[:, None]], dim=1)  # (B, N + 1, D)
+        is_token = torch.cat([valid, has_padding[:, None]], dim=1)
+
+        packed = tokens[is_token]
+        is_key = torch.cat([valid, torch.zeros_like(has_padding)[:, None]], dim=1)[is_token]
+        q_offsets = F.pad(is_token.sum(dim=1).cumsum(dim=0), (1, 0))
+        kv_offsets = F.pad(valid.sum(dim=1).cumsum(dim=0), (1, 0))
+
+        for b in self.blocks:
+            packed = b.forward_packed(packed, q_offsets, kv_offsets, is_key)
+        packed = self.norm(packed)
+
+        tokens = torch.zeros((B, N + 1, D), dtype=packed.dtype, device=packed.device)
+        tokens[is_token] = packed
+        return torch.where(mask.unsqueeze(-1), tokens[:, N:], tokens[:, :N])
@@ -0,0 +1,234 @@
+"""Batched inference service shared by many DiffusionPlanner instances.
+
+The server owns one Diffusion_Planner, collects requests from the clients (e.g. the nuPlan
+simulation workers) over a Unix socket, micro-batches them under a latency deadline and sends
+every client its own slice of the batched prediction.
+
+    python -m diffusion_planner.planner.inference_service --config args.json --ckpt latest.pth \
+        --address /tmp/diffusion_planner.sock --device cuda
+
+The sampler and the guidance are those of the server (--sampler, --guidance_terms), the
+settings of the planners do not apply.
+"""
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from typing import Dict
+
+import numpy as np
+import torch
+
+from diffusion_planner.model.diffusion_planner import Diffusion_Planner
+from diffusion_planner.utils.config import Config
+from diffusion_planner.utils.train_utils import load_planner_checkpoint
+
+DEFAULT_AUTHKEY = b"diffusion_planner"
+
+
+class InferenceServer:
+    """
+    Micro-batching server of a Diffusion_Planner.
+
+    A batch is closed when it has `max_batch_size` requests or `max_wait_ms` after its first
+    request arrived, whichever comes first. Requests are dicts of normalized model inputs with a
+    batch dimension of 1 (numpy arrays), responses are {"prediction": [1, P, T, 4]}, or
+    {"error": message} when the model failed on the request.
+    """
+
+    def __init__(
+        self,
+        model,
+        address,
+        authkey=DEFAULT_AUTHKEY,
+        max_batch_size=32,
+        max_wait_ms=5.0,
+        device="cpu",
+    ):
+        self._model = model
+        self._address = address
+        self._authkey = authkey
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._device = device
+
+        self._requests = queue.Queue()
+        self._stop = threading.Event()
+        self._listener = None
+        self.batch_sizes = []
+
+    def serve_forever(self):
+        if os.path.exists(self._address):
+            os.unlink(self._address)  # stale socket of a previous server
+        self._listener = Listener(self._address, family="AF_UNIX", authkey=self._authkey)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+        while not self._stop.is_set():
+            requests = self._collect_batch()
+            if len(requests) > 0:
+                self._process(requests)
+
+    def shutdown(self):
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.close()
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # closed by shutdown or failed authentication
+                continue
+            threading.Thread(target=self._receive_loop, args=(conn,), daemon=True).start()
+
+    def _receive_loop(self, conn):
+        while not self._stop.is_set():
+            try:
+                inputs = conn.recv()
+            except (EOFError, OSError):
+                break
+            self._requests.put((conn, inputs))
+        conn.close()
+
+    def _collect_batch(self):
+        try:
+            requests = [self._requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self._max_wait
+        while len(requests) < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self._requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def _predict(self, requests):
+        keys = requests[0][1].keys()
+        inputs = {
+            k: torch.from_numpy(np.concatenate([r[1][k] for r in requests], axis=0)).to(
+                self._device
+            )
+            for k in keys
+        }
+        with torch.no_grad():
+            _, outputs = self._model(inputs)
+        return outputs["prediction"].cpu().numpy()
+
+    def _process(self, requests):
+        try:
+            prediction = self._predict(requests)
+            responses = [{"prediction": prediction[i : i + 1]} for i in range(len(requests))]
+        except Exception as e:
+            if len(requests) == 1:
+                print(f"Inference failed: {type(e).__name__}: {e}")
+                responses = [{"error": f"{type(e).__name__}: {e}"}]
+            else:
+                # e.g. a request of another model config or out of memory, run them one by one so
+                # that only the failing requests get an error
+                for request in requests:
+                    self._process([request])
+                return
+        self.batch_sizes.append(len(requests))
+
+        for (conn, _), response in zip(requests, responses):
+            try:
+                conn.send(response)
+            except (OSError, EOFError):
+                # the client is gone, its receive loop closes the connection
+                pass
+
+
+class InferenceClient:
+    """
+    Client of InferenceServer, one blocking request at a time.
+    """
+
+    def __init__(self, address, authkey=DEFAULT_AUTHKEY, device="cpu"):
+        self._conn = Client(address, family="AF_UNIX", authkey=authkey)
+        self._device = device
+
+    def predict(self, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        inputs: normalized model inputs with a batch dimension of 1
+        raises RuntimeError when the server failed on the request
+        """
+        self._conn.send({k: v.detach().cpu().numpy() for k, v in inputs.items()})
+        outputs = self._conn.recv()
+        if "error" in outputs:
+            raise RuntimeError(f"Inference service: {outputs['error']}")
+        return {k: torch.from_numpy(v).to(self._device) for k, v in outputs.items()}
+
+    def close(self):
+        self._conn.close()
+
+
+def build_server(args):
+    guidance_fn = None
+    if args.guidance or args.guidance_terms is not None:
+        from diffusion_planner.model.guidance.guidance_wrapper import GuidanceWrapper
+
+        guidance_fn = GuidanceWrapper(args.guidance_terms)
+    config = Config(args.config, guidance_fn=guidance_fn, sampler=args.sampler)
+
+    model = Diffusion_Planner(config)
+    if args.ckpt is not None:
+        load_planner_checkpoint(model, args.ckpt, args.enable_ema, args.device)
+    else:
+        print("load random model")
+    model.eval()
+    model = model.to(args.device)
+
+    return InferenceServer(
+        model,
+        args.address,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        device=args.device,
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="args.json of the model")
+    parser.add_argument("--ckpt", type=str, default=None)
+    parser.add_argument("--address", type=str, default="/tmp/diffusion_planner.sock")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    parser.add_argument("--disable_ema", action="store_false", dest="enable_ema")
+    parser.add_argument("--guidance", action="store_true", help="use the GuidanceWrapper")
+    parser.add_argument(
+        "--guidance_terms",
+        type=json.loads,
+        default=None,
+        help='guidance terms as JSON, e.g. \'{"collision": {"weight": 1.0}}\' (implies --guidance)',
+    )
+    parser.add_argument(
+        "--sampler",
+        type=json.loads,
+        default=None,
+        help='overrides of the sampler of --config as JSON, e.g. \'{"solver": "dpm_multistep", '
+        '"steps": 5}\'',
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = build_server(args)
+    print(f"Serving on {args.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
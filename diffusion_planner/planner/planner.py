@@ -1,5 +1,6 @@
+import time
 import warnings
-from typing import Deque, Dict, List, Type
+from typing import Deque, Dict, List, Optional, Type
 
 import numpy as np
 import torch
@@ -23,7 +24,12 @@ from nuplan.planning.simulation.trajectory.trajectory_sampling import Trajectory
 
 from diffusion_planner.data_process.data_processor import DataProcessor
 from diffusion_planner.model.diffusion_planner import Diffusion_Planner
+from diffusion_planner.model.diffusion_utils.sampling import check_time_budget
+from diffusion_planner.model.guidance.scoring import default_score
+from diffusion_planner.planner.inference_service import InferenceClient
+from diffusion_planner.planner.warm_start import warm_start_prediction
 from diffusion_planner.utils.config import Config
+from diffusion_planner.utils.train_utils import load_planner_checkpoint
 
 
 def identity(ego_state, predictions):
@@ -39,7 +45,26 @@ class DiffusionPlanner(AbstractPlanner):
         future_trajectory_sampling: TrajectorySampling,
         enable_ema: bool = True,
         device: str = "cpu",
+        inference_server: Optional[str] = None,
+        num_samples: int = 1,
+        warm_start_steps: Optional[int] = None,
+        warm_start_max_jump: float = 1.0,
+        time_budget: Optional[float] = None,
     ):
+        """
+        inference_server: socket address of a running inference_service, the model is then
+            run there (batched with the other planners) instead of in this process, with the
+            sampler and guidance of the server
+        num_samples: plans drawn per step from one scene encoding, the best one by default_score
+            is executed (local model only)
+        warm_start_steps: start the sampler from the previous plan noised to the time of its last
+            `warm_start_steps` steps and run only these, None to always start from noise
+            (local model only)
+        warm_start_max_jump: [m] the sampler starts from noise when the ego deviated more than
+            this from the previous plan
+        time_budget: [s] per planner step, the sampler returns its current estimate when the
+            next solver step would exceed it, None for no budget (local model only)
+        """
         assert device in ["cpu", "cuda"], f"device {device} not supported"
         if device == "cuda":
             assert torch.cuda.is_available(), "cuda is not available"
@@ -58,7 +83,32 @@ class DiffusionPlanner(AbstractPlanner):
         self._ema_enabled = enable_ema
         self._device = device
 
-        self._planner = Diffusion_Planner(config)
+        if inference_server is not None:
+            local_only = {
+                "num_samples": num_samples != 1,
+                "warm_start_steps": warm_start_steps is not None,
+                "time_budget": time_budget is not None,
+                "config.guidance_fn": config.guidance_fn is not None,
+                "config.sampler": len(getattr(config, "sampler_overrides", {})) > 0,
+            }
+            local_only = [name for name, is_set in local_only.items() if is_set]
+            if len(local_only) > 0:
+                raise ValueError(
+                    f"{local_only} are not applied with inference_server, run the model locally "
+                    "or set the sampler and the guidance of the server (inference_service "
+                    "--sampler / --guidance_terms)"
+                )
+
+        self._inference_server = inference_server
+        self._num_samples = num_samples
+        self._warm_start_steps = warm_start_steps
+        self._warm_start_max_jump = warm_start_max_jump
+        self._time_budget = time_budget
+        self._previous_plan = None
+        self._client = None
+        self._planner = Diffusion_Planner(config) if inference_server is None else None
+        if self._planner is not None and time_budget is not None:
+            check_time_budget(self._planner.decoder.decoder.sampler)
 
         self.data_processor = DataProcessor(config)
 
@@ -82,26 +132,21 @@ class DiffusionPlanner(AbstractPlanner):
         """
         self._map_api = initialization.map_api
         self._route_roadblock_ids = initialization.route_roadblock_ids
+        self._initialization = initialization
+        self._previous_plan = None
+
+        if self._inference_server is not None:
+            # the server owns the model and the checkpoint
+            self._client = InferenceClient(self._inference_server, device=self._device)
+            return
 
         if self._ckpt_path is not None:
-            state_dict: Dict = torch.load(self._ckpt_path, map_location=self._device)
-
-            if self._ema_enabled:
-                state_dict = state_dict["ema_state_dict"]
-            else:
-                if "model" in state_dict.keys():
-                    state_dict = state_dict["model"]
-            # use for ddp
-            model_state_dict = {
-                k[len("module.") :]: v for k, v in state_dict.items() if k.startswith("module.")
-            }
-            self._planner.load_state_dict(model_state_dict)
+            load_planner_checkpoint(self._planner, self._ckpt_path, self._ema_enabled, self._device)
         else:
             print("load random model")
 
         self._planner.eval()
         self._planner = self._planner.to(self._device)
-        self._initialization = initialization
 
     def planner_input_to_model_inputs(self, planner_input: PlannerInput) -> Dict[str, torch.Tensor]:
         history = planner_input.history
@@ -125,14 +170,65 @@ class DiffusionPlanner(AbstractPlanner):
 
         return states
 
+    def warm_start(self, current_input: PlannerInput, inputs: Dict[str, torch.Tensor]):
+        """
+        The previous prediction as a warm start of the sampler (unnormalized inputs), None on the
+        first step, after a pose jump or a route change.
+        """
+        previous = self._previous_plan
+        if self._warm_start_steps is None or previous is None:
+            return None
+        if previous["route_roadblock_ids"] != self._route_roadblock_ids:
+            return None
+
+        ego_state = current_input.history.current_state[0]
+        shift = round((current_input.iteration.time_s - previous["time_s"]) / self._step_interval)
+        prediction = warm_start_prediction(
+            previous["prediction"],
+            previous["pose"],
+            (ego_state.rear_axle.x, ego_state.rear_axle.y, ego_state.rear_axle.heading),
+            shift,
+            inputs["neighbor_agents_past"][0, : previous["neighbor_mask"].shape[0], -1],
+            previous["neighbor_mask"],
+            self._step_interval,
+            self._warm_start_max_jump,
+        )
+        if prediction is None:
+            return None
+        return {"prediction": prediction[None], "steps": self._warm_start_steps}
+
     def compute_planner_trajectory(self, current_input: PlannerInput) -> AbstractTrajectory:
         """
         Inherited.
         """
+        start = time.perf_counter()
         inputs = self.planner_input_to_model_inputs(current_input)
+        warm_start = self.warm_start(current_input, inputs)
 
         inputs = self.observation_normalizer(inputs)
-        _, outputs = self._planner(inputs)
+        if self._client is not None:
+            outputs = self._client.predict(inputs)
+        else:
+            time_budget = None
+            if self._time_budget is not None:
+                time_budget = max(self._time_budget - (time.perf_counter() - start), 0.0)
+            _, outputs = self._planner(
+                inputs,
+                num_samples=self._num_samples,
+                score_fn=default_score,
+                warm_start=warm_start,
+                time_budget=time_budget,
+            )
+
+        if self._warm_start_steps is not None and self._client is None:
+            ego_state = current_input.history.current_state[0]
+            self._previous_plan = {
+                "prediction": outputs["prediction"][0],
+                "pose": (ego_state.rear_axle.x, ego_state.rear_axle.y, ego_state.rear_axle.heading),
+                "time_s": current_input.iteration.time_s,
+                "neighbor_mask": inputs["neighbor_current_mask"][0],
+                "route_roadblock_ids": list(self._route_roadblock_ids),
+            }
 
         trajectory = InterpolatedTrajectory(
             trajectory=self.outputs_to_trajectory(outputs, current_input.history.ego_states)
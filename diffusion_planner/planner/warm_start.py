@@ -0,0 +1,98 @@
+"""Warm start of the sampler from the plan of the previous planner step.
+
+The previous prediction is moved into the current ego frame and shifted by the elapsed time, then
+the decoder noises it to an intermediate diffusion time and runs only the remaining solver steps
+(see Decoder.forward).
+"""
+
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+def transform_to_frame(states, from_pose, to_pose):
+    """
+    states: [..., 4] (x, y, cos, sin) in the frame of from_pose
+    from_pose, to_pose: (x, y, heading) in the global frame
+    return: [..., 4] in the frame of to_pose
+    """
+    dx, dy = from_pose[0] - to_pose[0], from_pose[1] - to_pose[1]
+    cos, sin = np.cos(-to_pose[2]), np.sin(-to_pose[2])
+    offset = torch.tensor([cos * dx - sin * dy, sin * dx + cos * dy], dtype=states.dtype)
+    dheading = from_pose[2] - to_pose[2]
+    rotation = torch.tensor(
+        [[np.cos(dheading), np.sin(dheading)], [-np.sin(dheading), np.cos(dheading)]],
+        dtype=states.dtype,
+    )  # row vectors times rotation
+    rotation, offset = rotation.to(states.device), offset.to(states.device)
+    return torch.cat([states[..., :2] @ rotation + offset, states[..., 2:] @ rotation], dim=-1)
+
+
+def shift_in_time(states, shift):
+    """
+    states: [..., T, 4], drop the first `shift` (< T) steps and extrapolate as many at the end
+    with the final velocity and heading
+    """
+    if shift == 0:
+        return states
+    shifted = states[..., shift:, :]
+    velocity = states[..., -1, :2] - states[..., -2, :2]
+    k = torch.arange(1, shift + 1, dtype=states.dtype, device=states.device)[:, None]
+    tail = states[..., -1:, :].repeat_interleave(shift, dim=-2)
+    tail = torch.cat([states[..., -1:, :2] + k * velocity[..., None, :], tail[..., 2:]], dim=-1)
+    return torch.cat([shifted, tail], dim=-2)
+
+
+def constant_velocity(neighbors_current, future_len, step_interval):
+    """
+    neighbors_current: [Pn, 11] current neighbor states (x, y, cos, sin, vx, vy, ...)
+    return: [Pn, T, 4]
+    """
+    k = torch.arange(1, future_len + 1, dtype=neighbors_current.dtype)[:, None]
+    k = k.to(neighbors_current.device) * step_interval
+    xy = neighbors_current[:, None, :2] + k * neighbors_current[:, None, 4:6]
+    heading = neighbors_current[:, None, 2:4].expand(-1, future_len, -1)
+    return torch.cat([xy, heading], dim=-1)
+
+
+def warm_start_prediction(
+    prediction,
+    previous_pose,
+    pose,
+    shift,
+    neighbors_current,
+    previous_neighbor_mask,
+    step_interval,
+    max_jump=1.0,
+) -> Optional[torch.Tensor]:
+    """
+    The previous prediction as a warm start in the current frame, None (sample from the prior)
+    when the ego deviated more than `max_jump` [m] from it.
+
+    prediction: [P, T, 4] previous prediction in the frame of previous_pose
+    previous_pose, pose: (x, y, heading) of the ego (rear axle) in the global frame
+    shift: number of prediction steps elapsed since the previous prediction
+    neighbors_current: [Pn, 11] current neighbor states (unnormalized model input)
+    previous_neighbor_mask: [Pn] True for the empty neighbor slots of the previous prediction
+    return: [P, T, 4]
+    """
+    T = prediction.shape[-2]
+    if not 1 <= shift < T:
+        return None
+    prediction = transform_to_frame(prediction, previous_pose, pose)
+
+    # the ego is at the origin, where the previous plan expected it to be now
+    if torch.norm(prediction[0, shift - 1, :2]) > max_jump:
+        return None
+
+    # the neighbor slots are ordered by distance: match the previous predictions by position,
+    # neighbors seen for the first time move with constant velocity
+    neighbors = constant_velocity(neighbors_current, T, step_interval)
+    distance = torch.cdist(neighbors_current[:, :2], prediction[1:, shift - 1, :2])  # [Pn, Pn]
+    distance[:, previous_neighbor_mask] = float("inf")
+    distance, match = distance.min(dim=-1)
+    matched = distance < max_jump
+    neighbors[matched] = shift_in_time(prediction[1:][match[matched]], shift)
+
+    return torch.cat([shift_in_time(prediction[:1], shift), neighbors], dim=0)
@@ -5,19 +5,47 @@ from tqdm import tqdm
 from diffusion_planner.loss import diffusion_loss_func
 from diffusion_planner.utils import ddp
 from diffusion_planner.utils.data_augmentation import StatePerturbation
+from diffusion_planner.utils.time_sampler import TimeSampler
 from diffusion_planner.utils.train_utils import get_epoch_mean_loss
 
 
-def train_epoch(data_loader, model, optimizer, args, ema, aug: StatePerturbation = None):
+def train_epoch(
+    data_loader,
+    model,
+    optimizer,
+    args,
+    ema,
+    aug: StatePerturbation = None,
+    start_step: int = 0,
+    step_callback=None,
+    time_sampler: TimeSampler = None,
+    loss_func=None,
+):
+    """
+    start_step: number of batches of this epoch already consumed (when resuming mid-epoch)
+    step_callback: called as step_callback(step, loss) after every optimizer step,
+                   where step is the number of batches of this epoch consumed so far
+    time_sampler: sampler of the diffusion time (default: uniform), its per-time-bin losses
+                  are added to the returned losses
+    loss_func: replaces diffusion_loss_func, called as
+               loss_func(model, inputs, futures, state_normalizer, loss, model_type)
+               (e.g. progressive_distillation_loss_func with the teacher bound)
+    """
     epoch_loss = []
 
     model.train()
 
-    if args.ddp:
+    if args.ddp and args.device == "cuda":
         torch.cuda.synchronize()
 
-    with tqdm(data_loader, desc="Training", unit="batch") as data_epoch:
-        for batch in data_epoch:
+    with tqdm(
+        data_loader,
+        desc="Training",
+        unit="batch",
+        initial=start_step,
+        total=start_step + len(data_loader),
+    ) as data_epoch:
+        for step, batch in enumerate(data_epoch, start=start_step + 1):
             """
             data structure in batch: Tuple(Tensor)
 
@@ -84,15 +112,26 @@ def train_epoch(data_loader, model, optimizer, args, ema, aug: StatePerturbation
             optimizer.zero_grad()
             loss = {}
 
-            loss, _ = diffusion_loss_func(
-                model,
-                inputs,
-                ddp.get_model(model, args.ddp).sde.marginal_prob,
-                (ego_future, neighbors_future, mask),
-                args.state_normalizer,
-                loss,
-                args.diffusion_model_type,
-            )
+            if loss_func is None:
+                loss, _ = diffusion_loss_func(
+                    model,
+                    inputs,
+                    ddp.get_model(model, args.ddp).sde.marginal_prob,
+                    (ego_future, neighbors_future, mask),
+                    args.state_normalizer,
+                    loss,
+                    args.diffusion_model_type,
+                    time_sampler=time_sampler,
+                )
+            else:
+                loss, _ = loss_func(
+                    model,
+                    inputs,
+                    (ego_future, neighbors_future, mask),
+                    args.state_normalizer,
+                    loss,
+                    args.diffusion_model_type,
+                )
 
             loss["loss"] = (
                 loss["neighbor_prediction_loss"]
@@ -109,13 +148,18 @@ def train_epoch(data_loader, model, optimizer, args, ema, aug: StatePerturbation
 
             ema.update(model)
 
-            if args.ddp:
+            if args.ddp and args.device == "cuda":
                 torch.cuda.synchronize()
 
             data_epoch.set_postfix(loss="{:.4f}".format(total_loss))
             epoch_loss.append(loss)
 
+            if step_callback is not None:
+                step_callback(step, total_loss)
+
     epoch_mean_loss = get_epoch_mean_loss(epoch_loss)
+    if time_sampler is not None:
+        epoch_mean_loss.update(time_sampler.get_bin_losses(device=torch.device(args.device)))
 
     if args.ddp:
         epoch_mean_loss = ddp.reduce_and_average_losses(epoch_mean_loss, torch.device(args.device))
@@ -6,7 +6,11 @@ from diffusion_planner.utils.normalizer import ObservationNormalizer, StateNorma
 
 
 class Config:
-    def __init__(self, args_file, guidance_fn=None):
+    def __init__(self, args_file, guidance_fn=None, sampler=None):
+        """
+        sampler: overrides of the inference sampler settings, see the keys accepted by
+            diffusion_utils.sampling.sampler_config
+        """
         with open(args_file, "r") as f:
             args_dict = json.load(f)
 
@@ -23,3 +27,9 @@ class Config:
         )
 
         self.guidance_fn = guidance_fn
+        # None keeps the setting of args_file (or the default)
+        self.sampler_overrides = {
+            k: v for k, v in ({} if sampler is None else sampler).items() if v is not None
+        }
+        if len(self.sampler_overrides) > 0:
+            self.sampler = {**getattr(self, "sampler", {}), **self.sampler_overrides}
@@ -55,12 +55,14 @@ class StatePerturbation:
         augment_prob: float = 0.5,
         normalize=True,
         device: Optional[torch.device] = "cpu",
+        seed: Optional[int] = None,
     ) -> None:
         """
         Initialize the augmentor,
         :param low: Parameter to set lower bound vector of the Uniform noise on [x, y, yaw, vx, vy, ax, ay, steering angle, yaw rate].
         :param high: Parameter to set upper bound vector of the Uniform noise on [x, y, yaw, vx, vy, ax, ay, steering angle, yaw rate].
         :param augment_prob: probability between 0 and 1 of applying the data augmentation
+        :param seed: seed of the augmentor's own RNG (default: derived from the torch global seed)
         """
         self._augment_prob = augment_prob
         self._normalize = normalize
@@ -68,6 +70,9 @@ class StatePerturbation:
         self._low = torch.tensor(low).to(self._device)
         self._high = torch.tensor(high).to(self._device)
         self._wheel_base = get_pacifica_parameters().wheel_base
+        self._generator = torch.Generator().manual_seed(
+            torch.initial_seed() if seed is None else seed
+        )
 
         self.refine_horizon = REFINE_HORIZON
         self.num_refine = NUM_REFINE
@@ -104,16 +109,22 @@ class StatePerturbation:
 
         return self.centric_transform(inputs, ego_future, neighbors_future)
 
+    def state_dict(self):
+        return {"generator": self._generator.get_state()}
+
+    def load_state_dict(self, state_dict):
+        self._generator.set_state(state_dict["generator"].cpu())
+
     def augment(self, inputs):
         # Only aug current state
         ego_current_state = inputs["ego_current_state"].clone()
 
         B = ego_current_state.shape[0]
-        aug_flag = (torch.rand(B) >= self._augment_prob).bool().to(self._device) & ~(
-            abs(ego_current_state[:, 4]) < 2.0
-        )
+        aug_flag = (torch.rand(B, generator=self._generator) >= self._augment_prob).bool().to(
+            self._device
+        ) & ~(abs(ego_current_state[:, 4]) < 2.0)
 
-        random_tensor = torch.rand(B, len(self._low)).to(self._device)
+        random_tensor = torch.rand(B, len(self._low), generator=self._generator).to(self._device)
         scaled_random_tensor = self._low + (self._high - self._low) * random_tensor
 
         new_state = torch.zeros((B, 9), dtype=torch.float32).to(self._device)
@@ -180,90 +191,75 @@ class StatePerturbation:
         ego_future: torch.Tensor,
         neighbors_future: torch.Tensor,
     ):
-        cur_state = inputs["ego_current_state"].clone()
-        center_xy = cur_state[:, :2]
-        transform_matrix = self.get_transform_matrix_batch(cur_state)
-
-        # ego xy
-        inputs["ego_current_state"][..., :2] = vector_transform(
-            inputs["ego_current_state"][..., :2], transform_matrix, center_xy
-        )
-        # ego cos sin
-        inputs["ego_current_state"][..., 2:4] = vector_transform(
-            inputs["ego_current_state"][..., 2:4], transform_matrix
-        )
-        # ego vx, vy
-        inputs["ego_current_state"][..., 4:6] = vector_transform(
-            inputs["ego_current_state"][..., 4:6], transform_matrix
-        )
-        # ego ax, ay
-        inputs["ego_current_state"][..., 6:8] = vector_transform(
-            inputs["ego_current_state"][..., 6:8], transform_matrix
-        )
-
-        # ego future xy
-        ego_future[..., :2] = vector_transform(ego_future[..., :2], transform_matrix, center_xy)
-        ego_future[..., 2] = heading_transform(ego_future[..., 2], transform_matrix)
+        """
+        Transform all inputs and futures into the frame of the (augmented) ego current state.
 
-        # neighbor past xy
-        mask = torch.sum(torch.ne(inputs["neighbor_agents_past"][..., :6], 0), dim=-1) == 0
-        inputs["neighbor_agents_past"][..., :2] = vector_transform(
-            inputs["neighbor_agents_past"][..., :2], transform_matrix, center_xy
-        )
-        # neighbor past cos sin
-        inputs["neighbor_agents_past"][..., 2:4] = vector_transform(
-            inputs["neighbor_agents_past"][..., 2:4], transform_matrix
-        )
-        # neighbor past vx, vy
-        inputs["neighbor_agents_past"][..., 4:6] = vector_transform(
-            inputs["neighbor_agents_past"][..., 4:6], transform_matrix
-        )
-        inputs["neighbor_agents_past"][mask] = 0.0
+        All 2-D vectors are packed into one tensor, positions first (translated by the ego position),
+        then directions (cos/sin, velocities, accelerations and lane offsets), rotated with a single
+        einsum and written back in place. Future headings are shifted by the ego heading.
+        """
+        ego_current_state = inputs["ego_current_state"]
+        neighbor_agents_past = inputs["neighbor_agents_past"]
+        lanes = inputs["lanes"]
+        route_lanes = inputs["route_lanes"]
+        static_objects = inputs["static_objects"]
+        B = ego_current_state.shape[0]
 
-        # neighbor future xy
-        mask = torch.sum(torch.ne(neighbors_future[..., :2], 0), dim=-1) == 0
-        neighbors_future[..., :2] = vector_transform(
-            neighbors_future[..., :2], transform_matrix, center_xy
-        )
-        neighbors_future[..., 2] = heading_transform(neighbors_future[..., 2], transform_matrix)
-        neighbors_future[mask] = 0.0
+        cur_state = ego_current_state.clone()
+        center_xy = cur_state[:, :2]
+        transform_matrix = self.get_transform_matrix_batch(cur_state)
 
-        # lanes
-        mask = torch.sum(torch.ne(inputs["lanes"][..., :8], 0), dim=-1) == 0
-        inputs["lanes"][..., :2] = vector_transform(
-            inputs["lanes"][..., :2], transform_matrix, center_xy
-        )
-        inputs["lanes"][..., 2:4] = vector_transform(inputs["lanes"][..., 2:4], transform_matrix)
-        inputs["lanes"][..., 4:6] = vector_transform(inputs["lanes"][..., 4:6], transform_matrix)
-        inputs["lanes"][..., 6:8] = vector_transform(inputs["lanes"][..., 6:8], transform_matrix)
-        inputs["lanes"][mask] = 0.0
-
-        # route_lanes
-        mask = torch.sum(torch.ne(inputs["route_lanes"][..., :8], 0), dim=-1) == 0
-        inputs["route_lanes"][..., :2] = vector_transform(
-            inputs["route_lanes"][..., :2], transform_matrix, center_xy
-        )
-        inputs["route_lanes"][..., 2:4] = vector_transform(
-            inputs["route_lanes"][..., 2:4], transform_matrix
-        )
-        inputs["route_lanes"][..., 4:6] = vector_transform(
-            inputs["route_lanes"][..., 4:6], transform_matrix
-        )
-        inputs["route_lanes"][..., 6:8] = vector_transform(
-            inputs["route_lanes"][..., 6:8], transform_matrix
-        )
-        inputs["route_lanes"][mask] = 0.0
+        # padding masks of the original values
+        neighbor_past_mask = torch.sum(torch.ne(neighbor_agents_past[..., :6], 0), dim=-1) == 0
+        neighbor_future_mask = torch.sum(torch.ne(neighbors_future[..., :2], 0), dim=-1) == 0
+        lanes_mask = torch.sum(torch.ne(lanes[..., :8], 0), dim=-1) == 0
+        route_lanes_mask = torch.sum(torch.ne(route_lanes[..., :8], 0), dim=-1) == 0
+        static_objects_mask = torch.sum(torch.ne(static_objects[..., :10], 0), dim=-1) == 0
+
+        # xy
+        positions = [
+            ego_current_state[..., :2],
+            ego_future[..., :2],
+            neighbor_agents_past[..., :2],
+            neighbors_future[..., :2],
+            lanes[..., :2],
+            route_lanes[..., :2],
+            static_objects[..., :2],
+        ]
+        # cos sin, vx vy, ax ay / x'-x, left and right boundary offsets
+        directions = [
+            ego_current_state[..., 2:8],
+            neighbor_agents_past[..., 2:6],
+            lanes[..., 2:8],
+            route_lanes[..., 2:8],
+            static_objects[..., 2:4],
+        ]
+        headings = [ego_future[..., 2], neighbors_future[..., 2]]
+
+        packed = torch.cat(
+            [field.reshape(B, -1, 2) - center_xy[:, None, :] for field in positions]
+            + [field.reshape(B, -1, 2) for field in directions],
+            dim=1,
+        )  # (B, N, 2)
+        packed = torch.einsum("bij,bnj->bni", transform_matrix, packed)
+
+        fields = positions + directions
+        results = torch.split(packed, [field.numel() // B // 2 for field in fields], dim=1)
+        for field, result in zip(fields, results):
+            field.copy_(result.reshape(field.shape))
+
+        # rotating a heading is subtracting the ego heading
+        ego_heading = torch.atan2(cur_state[:, 3], cur_state[:, 2])
+        for heading in headings:
+            heading.copy_(
+                self.normalize_angle(heading - ego_heading.reshape(B, *([1] * (heading.ndim - 1))))
+            )
 
-        # static objects xy
-        mask = torch.sum(torch.ne(inputs["static_objects"][..., :10], 0), dim=-1) == 0
-        inputs["static_objects"][..., :2] = vector_transform(
-            inputs["static_objects"][..., :2], transform_matrix, center_xy
-        )
-        # static objects cos sin
-        inputs["static_objects"][..., 2:4] = vector_transform(
-            inputs["static_objects"][..., 2:4], transform_matrix
-        )
-        inputs["static_objects"][mask] = 0.0
+        neighbor_agents_past[neighbor_past_mask] = 0.0
+        neighbors_future[neighbor_future_mask] = 0.0
+        lanes[lanes_mask] = 0.0
+        route_lanes[route_lanes_mask] = 0.0
+        static_objects[static_objects_mask] = 0.0
 
         return inputs, ego_future, neighbors_future
 
@@ -359,3 +355,193 @@ class StatePerturbation:
             [torch.cat([traj_x, traj_y, traj_heading[..., None]], axis=-1), ego_future[:, P:, :]],
             axis=1,
         )
+
+
+class SampleStatePerturbation:
+    """
+    Per-sample NumPy version of StatePerturbation, run in the DataLoader workers as the transform of
+    DiffusionPlannerData. The returned sample is already augmented and ego-centric.
+
+    The random draws of a sample only depend on (seed, epoch, index), so the result does not depend
+    on the number of workers and a resumed epoch reproduces the same augmentation.
+    """
+
+    def __init__(
+        self,
+        low: List[float] = [-0.0, -0.75, -0.35, -1, -0.5, -0.2, -0.1, 0.0, -0.0],
+        high: List[float] = [0.0, 0.75, 0.35, 1, 0.5, 0.2, 0.1, 0.0, 0.0],
+        augment_prob: float = 0.5,
+        seed: int = 0,
+    ) -> None:
+        self._augment_prob = augment_prob
+        self._low = np.asarray(low, dtype=np.float64)
+        self._high = np.asarray(high, dtype=np.float64)
+        self._wheel_base = get_pacifica_parameters().wheel_base
+        self._seed = seed
+        self._epoch = 0
+
+        T = REFINE_HORIZON + TIME_INTERVAL
+        self.coeff_matrix = np.linalg.inv(
+            np.array(
+                [
+                    [1, 0, 0, 0, 0, 0],
+                    [0, 1, 0, 0, 0, 0],
+                    [0, 0, 2, 0, 0, 0],
+                    [1, T, T**2, T**3, T**4, T**5],
+                    [0, 1, 2 * T, 3 * T**2, 4 * T**3, 5 * T**4],
+                    [0, 0, 2, 6 * T, 12 * T**2, 20 * T**3],
+                ],
+                dtype=np.float64,
+            )
+        )
+        self.t_matrix = np.power(
+            np.linspace(TIME_INTERVAL, REFINE_HORIZON, NUM_REFINE)[:, None], np.arange(6)[None, :]
+        )  # (N, 6)
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+
+    def __call__(self, data, idx):
+        """
+        data: sample dict of DiffusionPlannerData
+        """
+        rng = np.random.default_rng([self._seed, self._epoch, idx])
+        return self.perturb(data, rng.random(), rng.random(len(self._low)))
+
+    def perturb(self, data, flag_random, noise_random):
+        """
+        flag_random: uniform draw deciding whether the sample is augmented
+        noise_random: (9,) uniform draws of the state noise
+        """
+        ego_current_state = data["ego_current_state"].astype(np.float64)
+        ego_future = data["ego_future_gt"].astype(np.float64)
+
+        if flag_random >= self._augment_prob and not abs(ego_current_state[4]) < 2.0:
+            ego_current_state = self.augment(ego_current_state, noise_random)
+            ego_future = self.interpolation_future_trajectory(ego_current_state, ego_future)
+
+        data["ego_current_state"] = ego_current_state
+        data["ego_future_gt"] = ego_future
+        return self.centric_transform(data)
+
+    def normalize_angle(self, angle):
+        return (angle + np.pi) % (2 * np.pi) - np.pi
+
+    def augment(self, ego_current_state, noise_random):
+        new_state = np.zeros(9)
+        # x, y, h is 0 because of ego-centric, update vx, vy, ax, ay, steering angle, yaw rate
+        new_state[3:] = ego_current_state[4:10]
+        new_state = new_state + self._low + (self._high - self._low) * noise_random
+        new_state[3] = max(new_state[3], 0.0)
+        new_state[-1] = np.clip(new_state[-1], -0.85, 0.85)
+
+        ego_current_state = ego_current_state.copy()
+        ego_current_state[:2] = new_state[:2]
+        ego_current_state[2] = np.cos(new_state[2])
+        ego_current_state[3] = np.sin(new_state[2])
+        ego_current_state[4:8] = new_state[3:7]
+
+        # update steering angle and yaw rate
+        cur_velocity = ego_current_state[4]
+        yaw_rate = new_state[-1]
+        if abs(cur_velocity) < 0.2:
+            ego_current_state[8:10] = 0.0
+        else:
+            steering_angle = np.arctan(yaw_rate * self._wheel_base / abs(cur_velocity))
+            ego_current_state[8] = np.clip(steering_angle, -2 / 3 * np.pi, 2 / 3 * np.pi)
+            ego_current_state[9] = yaw_rate
+
+        return ego_current_state
+
+    def interpolation_future_trajectory(self, aug_current_state, ego_future):
+        """
+        aug_current_state: (10,) current state of the ego vehicle after augmentation
+        ego_future: (80, 3) future trajectory of the ego vehicle
+        """
+        P = NUM_REFINE
+        dt = TIME_INTERVAL
+
+        x0, y0 = aug_current_state[:2]
+        theta0 = np.arctan2(ego_future[P // 2, 1] - y0, ego_future[P // 2, 0] - x0)
+        v0 = np.linalg.norm(aug_current_state[4:6])
+        a0 = np.linalg.norm(aug_current_state[6:8])
+        omega0 = aug_current_state[9]
+
+        xT, yT, thetaT = ego_future[P]
+        vT = np.linalg.norm(ego_future[P, :2] - ego_future[P - 1, :2]) / dt
+        aT = (
+            np.linalg.norm(ego_future[P, :2] - 2 * ego_future[P - 1, :2] + ego_future[P - 2, :2])
+            / dt**2
+        )
+        omegaT = self.normalize_angle(ego_future[P, 2] - ego_future[P - 1, 2]) / dt
+
+        # Boundary conditions
+        sx = np.array(
+            [
+                x0,
+                v0 * np.cos(theta0),
+                a0 * np.cos(theta0) - v0 * np.sin(theta0) * omega0,
+                xT,
+                vT * np.cos(thetaT),
+                aT * np.cos(thetaT) - vT * np.sin(thetaT) * omegaT,
+            ]
+        )
+        sy = np.array(
+            [
+                y0,
+                v0 * np.sin(theta0),
+                a0 * np.sin(theta0) + v0 * np.cos(theta0) * omega0,
+                yT,
+                vT * np.sin(thetaT),
+                aT * np.sin(thetaT) + vT * np.cos(thetaT) * omegaT,
+            ]
+        )
+
+        traj_x = self.t_matrix @ (self.coeff_matrix @ sx)
+        traj_y = self.t_matrix @ (self.coeff_matrix @ sy)
+        traj_heading = np.arctan2(
+            np.diff(traj_y, prepend=y0),
+            np.diff(traj_x, prepend=x0),
+        )
+
+        return np.concatenate(
+            [np.stack([traj_x, traj_y, traj_heading], axis=-1), ego_future[P:]], axis=0
+        )
+
+    def centric_transform(self, data):
+        ego_current_state = data["ego_current_state"]
+        center_xy = ego_current_state[:2].copy()
+        cos, sin = ego_current_state[2], ego_current_state[3]
+        rotation = np.array([[cos, sin], [-sin, cos]])
+        ego_heading = np.arctan2(sin, cos)
+
+        def transform(array, position_dim, direction_dim, heading_dim=None, mask_dim=None):
+            array = array.astype(np.float64)
+            if mask_dim is not None:
+                mask = ~np.any(array[..., :mask_dim] != 0, axis=-1)
+            array[..., :2] = (array[..., :2] - center_xy) @ rotation.T
+            if direction_dim > position_dim:
+                directions = array[..., position_dim:direction_dim]
+                shape = directions.shape
+                directions = directions.reshape(*shape[:-1], -1, 2) @ rotation.T
+                array[..., position_dim:direction_dim] = directions.reshape(shape)
+            if heading_dim is not None:
+                array[..., heading_dim] = self.normalize_angle(
+                    array[..., heading_dim] - ego_heading
+                )
+            if mask_dim is not None:
+                array[mask] = 0.0
+            return array.astype(np.float32)
+
+        # xy, then cos sin, vx vy, ax ay / x'-x, left and right boundary offsets
+        data["ego_current_state"] = transform(ego_current_state, 2, 8)
+        data["ego_future_gt"] = transform(data["ego_future_gt"], 2, 2, heading_dim=2)
+        data["neighbor_agents_past"] = transform(data["neighbor_agents_past"], 2, 6, mask_dim=6)
+        data["neighbors_future_gt"] = transform(
+            data["neighbors_future_gt"], 2, 2, heading_dim=2, mask_dim=2
+        )
+        data["lanes"] = transform(data["lanes"], 2, 8, mask_dim=8)
+        data["route_lanes"] = transform(data["route_lanes"], 2, 8, mask_dim=8)
+        data["static_objects"] = transform(data["static_objects"], 2, 4, mask_dim=10)
+
+        return data
@@ -5,11 +5,17 @@ from diffusion_planner.utils.train_utils import openjson
 
 
 class DiffusionPlannerData(Dataset):
-    def __init__(self, data_list, past_neighbor_num, predicted_neighbor_num, future_len):
+    def __init__(
+        self, data_list, past_neighbor_num, predicted_neighbor_num, future_len, transform=None
+    ):
+        """
+        transform: called as transform(data, idx) on the sample dict (e.g. SampleStatePerturbation)
+        """
         self.data_list = openjson(data_list)
         self._past_neighbor_num = past_neighbor_num
         self._predicted_neighbor_num = predicted_neighbor_num
         self._future_len = future_len
+        self.transform = transform
 
     def __len__(self):
         return len(self.data_list)
@@ -47,4 +53,7 @@ class DiffusionPlannerData(Dataset):
             "static_objects": static_objects,
         }
 
+        if self.transform is not None:
+            data = self.transform(data, idx)
+
         return tuple(data.values())
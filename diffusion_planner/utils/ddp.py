@@ -1,29 +1,37 @@
 import os
+import re
 import subprocess
 from datetime import timedelta
 
 import torch
 import torch.distributed as dist
 from torch.distributed import init_process_group
+from torch.distributed.optim import ZeroRedundancyOptimizer
 
 
 def ddp_setup_universal(verbose=False, args=None):
     if args.ddp == False:
-        print(f"do not use ddp, train on GPU 0")
+        print(f"do not use ddp, train on {args.device}")
         return 0, 0, 1
 
+    use_cuda = getattr(args, "device", "cuda") == "cuda"
+
     if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
         rank = int(os.environ["RANK"])
         world_size = int(os.environ["WORLD_SIZE"])
         gpu = int(os.environ["LOCAL_RANK"])
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
         os.environ["MASTER_PORT"] = str(getattr(args, "port", "29529"))
         os.environ["MASTER_ADDR"] = "localhost"
     elif "SLURM_PROCID" in os.environ:
         rank = int(os.environ["SLURM_PROCID"])
-        gpu = rank % torch.cuda.device_count()
         world_size = int(os.environ["SLURM_NTASKS"])
+        if use_cuda:
+            gpu = rank % torch.cuda.device_count()
+        else:
+            gpu = int(os.environ.get("SLURM_LOCALID", 0))
+        local_world_size = slurm_tasks_per_node(world_size)
         node_list = os.environ["SLURM_NODELIST"]
-        num_gpus = torch.cuda.device_count()
         addr = subprocess.getoutput(f"scontrol show hostname {node_list} | head -n1")
         os.environ["MASTER_PORT"] = str(args.port)
         os.environ["MASTER_ADDR"] = addr
@@ -35,12 +43,22 @@ def ddp_setup_universal(verbose=False, args=None):
     os.environ["LOCAL_RANK"] = str(gpu)
     os.environ["RANK"] = str(rank)
 
-    torch.cuda.set_device(gpu)
-    dist_backend = "nccl"
+    if use_cuda:
+        torch.cuda.set_device(gpu)
+        dist_backend = "nccl"
+    else:
+        # split the cores of the node between the local ranks
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+        dist_backend = "gloo"
     # I don't know why but this is needed for DDP to work instead of 'env://'
     dist_url = "file://"
     file_path = "/tmp/tmp_dist_init"
-    print("| distributed init (rank {}): {}, gpu {}".format(rank, dist_url, gpu), flush=True)
+    print(
+        "| distributed init (rank {}): {}, {}, gpu {}, threads {}".format(
+            rank, dist_url, dist_backend, gpu if use_cuda else None, torch.get_num_threads()
+        ),
+        flush=True,
+    )
     init_process_group(
         init_method=f"{dist_url}{file_path}",
         backend=dist_backend,
@@ -54,6 +72,21 @@ def ddp_setup_universal(verbose=False, args=None):
     return rank, gpu, world_size
 
 
+def slurm_tasks_per_node(default):
+    """
+    Number of tasks on the node of this process, from the compressed SLURM_TASKS_PER_NODE
+    (e.g. "4(x2),3": 4 tasks on the first two nodes, 3 on the third), `default` if not set.
+    """
+    counts = []
+    for item in os.environ.get("SLURM_TASKS_PER_NODE", "").split(","):
+        match = re.fullmatch(r"(\d+)(?:\(x(\d+)\))?", item.strip())
+        if match is None:
+            return default
+        counts += [int(match.group(1))] * int(match.group(2) or 1)
+    node = int(os.environ.get("SLURM_NODEID", 0))
+    return counts[min(node, len(counts) - 1)]
+
+
 def setup_for_distributed(is_master):
     """
     This function disables printing when not in master process
@@ -82,6 +115,13 @@ def get_rank():
     return dist.get_rank()
 
 
+def get_device_ids(rank, device):
+    """
+    device_ids argument of DistributedDataParallel (None for CPU modules)
+    """
+    return [rank] if device == "cuda" else None
+
+
 def get_model(model, use_ddp):
     if use_ddp:
         return model.module
@@ -98,10 +138,46 @@ def is_dist_avail_and_initialized():
 
 
 def reduce_and_average_losses(loss_dict, device):
+    """
+    device: cuda device for nccl, cpu for gloo
+    """
     torch.distributed.barrier()
     world_size = dist.get_world_size()
-    for key in loss_dict.keys():
-        loss_tensor = torch.tensor([loss_dict[key].item()]).to(device)
-        dist.all_reduce(loss_tensor, op=dist.ReduceOp.SUM)
-        loss_dict[key] = loss_tensor.item() / world_size
+    keys = list(loss_dict.keys())
+    # reduce all losses in a single collective
+    loss_tensor = torch.tensor(
+        [float(loss_dict[key]) for key in keys], dtype=torch.float64, device=device
+    )
+    dist.all_reduce(loss_tensor, op=dist.ReduceOp.SUM)
+    for key, value in zip(keys, (loss_tensor / world_size).tolist()):
+        loss_dict[key] = value
     return loss_dict
+
+
+def all_reduce_sum(tensor, device):
+    """
+    Sum of `tensor` over the ranks (unchanged without DDP), on the device of `tensor`.
+    device: cuda device for nccl, cpu for gloo
+    """
+    if not is_dist_avail_and_initialized():
+        return tensor
+    reduced = tensor.to(device, copy=True)
+    dist.all_reduce(reduced, op=dist.ReduceOp.SUM)
+    return reduced.to(tensor.device)
+
+
+def all_gather_object(obj):
+    if not is_dist_avail_and_initialized():
+        return [obj]
+    object_list = [None] * dist.get_world_size()
+    dist.all_gather_object(object_list, obj)
+    return object_list
+
+
+def consolidate_optimizer_state(optimizer, to=0):
+    """
+    Gather a sharded optimizer state on rank `to` before calling `optimizer.state_dict()` there.
+    Must be called on all ranks. No-op for non-sharded optimizers.
+    """
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        optimizer.consolidate_state_dict(to=to)
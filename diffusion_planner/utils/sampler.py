@@ -0,0 +1,28 @@
+from torch.utils.data import DistributedSampler
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """
+    DistributedSampler that can start part-way through an epoch.
+
+    The index order of an epoch only depends on (seed, epoch), so skipping the first
+    `start_index` indices of the rank's shard reproduces the remaining batches exactly.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start_index :])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
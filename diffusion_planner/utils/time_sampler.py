@@ -0,0 +1,174 @@
+import torch
+
+from diffusion_planner.utils import ddp
+
+
+class TimeSampler:
+    """
+    Sampler of the diffusion time t in [eps, 1] for training.
+
+    `sample` returns the times and per-sample loss weights; weighting the loss with them keeps the
+    objective equal to the one of uniformly sampled t (weights are all ones for unweighted samplers).
+    The per-sample losses reported through `update` are accumulated in `num_bins` time bins.
+    With DDP, `update` and `get_bin_losses` must be called on all ranks (they reduce over them).
+    """
+
+    def __init__(self, eps=1e-3, num_bins=10):
+        self._eps = eps
+        self._num_bins = num_bins
+        self._bin_loss_sum = torch.zeros(num_bins, dtype=torch.float64)
+        self._bin_count = torch.zeros(num_bins, dtype=torch.float64)
+
+    def sample(self, B, device):
+        """
+        return: t [B], weight [B]
+        """
+        raise NotImplementedError
+
+    def time_to_bin(self, t):
+        u = (t - self._eps) / (1 - self._eps)
+        return torch.clamp((u * self._num_bins).long(), 0, self._num_bins - 1)
+
+    def histogram(self, t, loss):
+        """
+        t: [B] sampled times
+        loss: [B] unweighted per-sample loss
+        return: [2, num_bins] (loss sum, count) per time bin, on the cpu
+        """
+        bins = self.time_to_bin(t.detach()).cpu()
+        loss = loss.detach().double().cpu()
+        histogram = torch.zeros(2, self._num_bins, dtype=torch.float64)
+        histogram[0].index_add_(0, bins, loss)
+        histogram[1].index_add_(0, bins, torch.ones_like(loss))
+        return histogram
+
+    def update(self, t, loss):
+        """
+        t: [B] sampled times
+        loss: [B] unweighted per-sample loss
+        """
+        histogram = self.histogram(t, loss)
+        self._bin_loss_sum += histogram[0]
+        self._bin_count += histogram[1]
+
+    def get_bin_losses(self, reset=True, device="cpu"):
+        """
+        return: {"t_bin_00": mean loss of t in [eps, eps + (1 - eps) / num_bins), ...} over the
+            samples of all ranks, bins without samples on any rank are nan
+        device: of the reduction over the ranks, cuda device for nccl, cpu for gloo
+        """
+        bin_loss_sum, bin_count = ddp.all_reduce_sum(
+            torch.stack([self._bin_loss_sum, self._bin_count]), device
+        )
+        bin_losses = {
+            f"t_bin_{i:02d}": (bin_loss_sum[i] / bin_count[i]).item()
+            if bin_count[i] > 0
+            else float("nan")
+            for i in range(self._num_bins)
+        }
+        if reset:
+            self._bin_loss_sum.zero_()
+            self._bin_count.zero_()
+        return bin_losses
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
+
+class UniformTimeSampler(TimeSampler):
+    def sample(self, B, device):
+        t = torch.rand(B, device=device) * (1 - self._eps) + self._eps
+        return t, torch.ones_like(t)
+
+
+class LogitNormalTimeSampler(TimeSampler):
+    """
+    t = sigmoid(mean + std * n), n ~ N(0, 1), rescaled to [eps, 1].
+
+    The loss is intentionally left unweighted, so training focuses on intermediate noise levels.
+    """
+
+    def __init__(self, eps=1e-3, num_bins=10, mean=0.0, std=1.0):
+        super().__init__(eps, num_bins)
+        self._mean = mean
+        self._std = std
+
+    def sample(self, B, device):
+        u = torch.sigmoid(self._mean + self._std * torch.randn(B, device=device))
+        t = u * (1 - self._eps) + self._eps
+        return t, torch.ones_like(t)
+
+
+class AdaptiveTimeSampler(TimeSampler):
+    """
+    Importance sampler driven by a running per-bin loss histogram.
+
+    A bin is drawn with probability proportional to the running (EMA) mean loss of the bin,
+    mixed with `uniform_ratio` of the uniform distribution, and t is drawn uniformly inside the bin.
+    The histogram is updated with the losses of all ranks, so every rank samples the same bins.
+    The weight (1 / num_bins) / p(bin) keeps the loss an unbiased estimate of the uniform-t loss.
+    t is sampled uniformly until every bin has seen `warmup_count` samples.
+    """
+
+    def __init__(self, eps=1e-3, num_bins=10, ema_decay=0.99, uniform_ratio=0.1, warmup_count=10):
+        super().__init__(eps, num_bins)
+        self._ema_decay = ema_decay
+        self._uniform_ratio = uniform_ratio
+        self._warmup_count = warmup_count
+        self._ema_loss = torch.zeros(num_bins, dtype=torch.float64)
+        self._seen_count = torch.zeros(num_bins, dtype=torch.float64)
+
+    def probs(self):
+        if (self._seen_count < self._warmup_count).any():
+            return torch.full((self._num_bins,), 1.0 / self._num_bins, dtype=torch.float64)
+        probs = self._ema_loss / self._ema_loss.sum()
+        return (1 - self._uniform_ratio) * probs + self._uniform_ratio / self._num_bins
+
+    def sample(self, B, device):
+        probs = self.probs()
+        bins = torch.multinomial(probs, B, replacement=True)
+        u = (bins + torch.rand(B, dtype=torch.float64)) / self._num_bins
+        t = (u * (1 - self._eps) + self._eps).float().to(device)
+        weight = ((1.0 / self._num_bins) / probs[bins]).float().to(device)
+        return t, weight
+
+    def update(self, t, loss):
+        histogram = self.histogram(t, loss)
+        self._bin_loss_sum += histogram[0]
+        self._bin_count += histogram[1]
+
+        bin_loss_sum, bin_count = ddp.all_reduce_sum(histogram, t.device)
+        for i in bin_count.nonzero()[:, 0].tolist():
+            bin_mean = bin_loss_sum[i] / bin_count[i]
+            if self._seen_count[i] == 0:
+                self._ema_loss[i] = bin_mean
+            else:
+                self._ema_loss[i] = (
+                    self._ema_decay * self._ema_loss[i] + (1 - self._ema_decay) * bin_mean
+                )
+        self._seen_count += bin_count
+
+    def state_dict(self):
+        return {"ema_loss": self._ema_loss.clone(), "seen_count": self._seen_count.clone()}
+
+    def load_state_dict(self, state_dict):
+        self._ema_loss.copy_(state_dict["ema_loss"])
+        self._seen_count.copy_(state_dict["seen_count"])
+
+
+def build_time_sampler(args):
+    if args.time_sampler == "uniform":
+        return UniformTimeSampler(num_bins=args.time_sampler_bins)
+    elif args.time_sampler == "logit_normal":
+        return LogitNormalTimeSampler(
+            num_bins=args.time_sampler_bins,
+            mean=args.logit_normal_mean,
+            std=args.logit_normal_std,
+        )
+    elif args.time_sampler == "adaptive":
+        return AdaptiveTimeSampler(num_bins=args.time_sampler_bins)
+    else:
+        raise ValueError(f"Unknown time sampler: {args.time_sampler}")
@@ -1,5 +1,6 @@
 import json
 import random
+from typing import Dict
 
 import numpy as np
 import torch
@@ -19,6 +20,28 @@ def set_seed(CUR_SEED):
     torch.backends.cudnn.benchmark = False
 
 
+def get_rng_state():
+    # numpy state is stored as plain lists so that checkpoints stay loadable with weights_only
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": [name, keys.tolist(), pos, has_gauss, cached_gaussian],
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"].cpu())
+    if torch.cuda.is_available() and "cuda" in state:
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
 def get_epoch_mean_loss(epoch_loss):
     epoch_mean_loss = {}
     for current_loss in epoch_loss:
@@ -36,26 +59,53 @@ def get_epoch_mean_loss(epoch_loss):
     return epoch_mean_loss
 
 
-def save_model(model, optimizer, scheduler, save_path, epoch, train_loss, wandb_id, ema):
+def save_model(
+    model, optimizer, scheduler, save_path, epoch, train_loss, wandb_id, ema, train_state=None
+):
     """
     save the model to path
+
+    train_state: sampler position, per-rank RNG states, ... (see `resume_train_state`).
+    If `train_state["step"]` is non-zero, the checkpoint is taken in the middle of `epoch`,
+    so training resumes inside that epoch and only `latest.pth` is updated.
     """
+    step = 0 if train_state is None else train_state["step"]
     save_model = {
-        "epoch": epoch + 1,
+        "epoch": epoch + 1 if step == 0 else epoch,
         "model": model.state_dict(),
         "ema_state_dict": ema.state_dict(),
         "optimizer": optimizer.state_dict(),
         "schedule": scheduler.state_dict(),
         "loss": train_loss,
         "wandb_id": wandb_id,
+        "train_state": train_state,
     }
 
-    torch.save(
-        save_model, f"{save_path}/model_epoch_{epoch + 1:06d}_trainloss_{train_loss:.4f}.pth"
-    )
+    if step == 0:
+        torch.save(
+            save_model, f"{save_path}/model_epoch_{epoch + 1:06d}_trainloss_{train_loss:.4f}.pth"
+        )
     torch.save(save_model, f"{save_path}/latest.pth")
 
 
+def load_planner_checkpoint(model, ckpt_path, enable_ema=True, device="cpu"):
+    """
+    load the (EMA) weights of a training checkpoint into a model for inference
+    """
+    state_dict: Dict = torch.load(ckpt_path, map_location=device)
+
+    if enable_ema:
+        state_dict = state_dict["ema_state_dict"]
+    else:
+        if "model" in state_dict.keys():
+            state_dict = state_dict["model"]
+    # use for ddp
+    model_state_dict = {
+        k[len("module.") :]: v for k, v in state_dict.items() if k.startswith("module.")
+    }
+    model.load_state_dict(model_state_dict)
+
+
 def resume_model(path: str, model, optimizer, scheduler, ema, device):
     """
     load ckpt from path
@@ -108,3 +158,26 @@ def resume_model(path: str, model, optimizer, scheduler, ema, device):
         print("no ema shadow found")
 
     return model, optimizer, scheduler, init_epoch, wandb_id, ema
+
+
+def resume_train_state(path: str, rank: int):
+    """
+    load mid-epoch train state from path and restore the RNG states of this rank
+
+    return: train state dict ({"step", "sampler", "rank_states"}) or None
+    """
+    ckpt = torch.load(path, map_location="cpu")
+
+    train_state = ckpt.get("train_state")
+    if train_state is None:
+        print("no train state found")
+        return None
+
+    rank_states = train_state["rank_states"]
+    if rank < len(rank_states):
+        set_rng_state(rank_states[rank]["rng"])
+        print("RNG state load done")
+    else:
+        print(f"no RNG state found for rank {rank}")
+
+    return train_state
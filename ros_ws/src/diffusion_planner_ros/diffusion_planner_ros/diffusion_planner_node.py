@@ -23,6 +23,8 @@ from rclpy.qos import (
 from visualization_msgs.msg import MarkerArray
 
 from diffusion_planner.model.diffusion_planner import Diffusion_Planner
+from diffusion_planner.model.diffusion_utils.sampling import check_time_budget
+from diffusion_planner.model.guidance.scoring import default_score
 from diffusion_planner.utils.config import Config
 
 from .lanelet2_utils.lanelet_converter import (
@@ -101,6 +103,12 @@ class DiffusionPlannerNode(Node):
         self.batch_size = self.declare_parameter("batch_size", value=1).value
         self.get_logger().info(f"Batch size: {self.batch_size}")
 
+        # param(6) time_budget_msec (PyTorch backend, from the tracked objects message, 0: none)
+        self.time_budget_msec = self.declare_parameter("time_budget_msec", value=0.0).value
+        self.get_logger().info(f"Time budget: {self.time_budget_msec} msec")
+        if self.backend == "PYTHORCH" and self.time_budget_msec > 0:
+            check_time_budget(self.diffusion_planner.decoder.decoder.sampler)
+
         ###############
         # Subscribers #
         ###############
@@ -216,6 +224,7 @@ class DiffusionPlannerNode(Node):
     def cb_tracked_objects(self, msg):
         if self.route is None:
             return
+        callback_start = time.perf_counter()
         dev = self.diffusion_planner.parameters().__next__().device
         stamp = msg.header.stamp
 
@@ -314,8 +323,9 @@ class DiffusionPlannerNode(Node):
             # "route_lanes_has_speed_limit": route_has_speed_limit,
             "static_objects": torch.zeros((1, 5, 10), device=dev),
         }
-        if self.batch_size > 1:
+        if self.batch_size > 1 and self.backend == "ONNXRUNTIME":
             # copy the input dict for batch size
+            # (the PyTorch model shares one scene encoding among the samples instead)
             for key in input_dict.keys():
                 s = input_dict[key].shape
                 ones = [1] * (len(s) - 1)
@@ -337,9 +347,28 @@ class DiffusionPlannerNode(Node):
 
         start = time.time()
         if self.backend == "PYTHORCH":
+            time_budget = None
+            if self.time_budget_msec > 0:
+                elapsed = time.perf_counter() - callback_start
+                time_budget = max(self.time_budget_msec / 1000 - elapsed, 0.0)
             with torch.no_grad():
-                out = self.diffusion_planner(input_dict)[1]
-                pred = out["prediction"].detach().cpu().numpy()
+                out = self.diffusion_planner(
+                    input_dict,
+                    num_samples=self.batch_size,
+                    score_fn=default_score,
+                    time_budget=time_budget,
+                )[1]
+                if out.get("truncated", False):
+                    self.get_logger().warn(
+                        f"Sampler truncated after {out['sampler_steps']} steps to meet the budget"
+                    )
+                if self.batch_size > 1:
+                    # the best sample first, the others are only visualized
+                    pred = out["samples"][0].detach().cpu().numpy()
+                    best = out["scores"][0].argmax().item()
+                    pred[[0, best]] = pred[[best, 0]]
+                else:
+                    pred = out["prediction"].detach().cpu().numpy()
         elif self.backend == "ONNXRUNTIME":
             out = self.ort_session.run(None, input_dict)[0]
             pred = out
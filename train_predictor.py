@@ -1,24 +1,64 @@
 import argparse
+import copy
 import json
 import os
+from functools import partial
 
 import torch
 import wandb
 from timm.utils import ModelEma
 from torch import optim
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader, DistributedSampler
 
+from diffusion_planner.loss import progressive_distillation_loss_func
 from diffusion_planner.model.diffusion_planner import Diffusion_Planner
+from diffusion_planner.model.module.encoder import STATIC_SHAPE_MODES
 from diffusion_planner.train_epoch import train_epoch
 from diffusion_planner.utils import ddp
-from diffusion_planner.utils.data_augmentation import StatePerturbation
+from diffusion_planner.utils.config import Config
+from diffusion_planner.utils.data_augmentation import SampleStatePerturbation, StatePerturbation
 from diffusion_planner.utils.dataset import DiffusionPlannerData
 from diffusion_planner.utils.lr_schedule import CosineAnnealingWarmUpRestarts
 from diffusion_planner.utils.normalizer import ObservationNormalizer, StateNormalizer
-from diffusion_planner.utils.train_utils import resume_model, save_model, set_seed
+from diffusion_planner.utils.sampler import ResumableDistributedSampler
+from diffusion_planner.utils.time_sampler import build_time_sampler
+from diffusion_planner.utils.train_utils import (
+    get_rng_state,
+    load_planner_checkpoint,
+    openjson,
+    resume_model,
+    resume_train_state,
+    save_model,
+    set_seed,
+)
 from valid_predictor import validate_model
 
+# the student of a distillation has the inputs, the architecture and the model type of the teacher
+TEACHER_ARGS = [
+    "future_len",
+    "time_len",
+    "agent_state_dim",
+    "agent_num",
+    "static_objects_state_dim",
+    "static_objects_num",
+    "lane_len",
+    "lane_state_dim",
+    "lane_num",
+    "route_len",
+    "route_state_dim",
+    "route_num",
+    "encoder_depth",
+    "decoder_depth",
+    "num_heads",
+    "hidden_dim",
+    "diffusion_model_type",
+    "predicted_neighbor_num",
+    "static_shape_encoder",
+    "fusion_packed_attention",
+]
+
 
 def boolean(v):
     if isinstance(v, bool):
@@ -78,6 +118,12 @@ def get_args():
         type=str,
     )
     parser.add_argument("--use_data_augment", default=True, type=boolean)
+    parser.add_argument(
+        "--augment_in_workers",
+        default=False,
+        type=boolean,
+        help="run the augmentation per sample in the DataLoader workers instead of on the device",
+    )
     parser.add_argument("--num_workers", default=4, type=int)
     parser.add_argument(
         "--pin-mem",
@@ -102,6 +148,35 @@ def get_args():
         "--decoder_drop_path_rate", type=float, help="decoder drop out rate", default=0.1
     )
 
+    parser.add_argument(
+        "--static_shape_encoder",
+        type=str,
+        help="when the encoders skip the boolean gather of valid rows to keep static shapes",
+        choices=STATIC_SHAPE_MODES,
+        default="inference",
+    )
+
+    parser.add_argument(
+        "--fusion_packed_attention",
+        default=False,
+        type=boolean,
+        help="run the fusion self-attention over the valid tokens only, packed across the batch "
+        "(inference only)",
+    )
+
+    parser.add_argument(
+        "--time_sampler",
+        type=str,
+        help="sampler of the diffusion time in the loss",
+        choices=["uniform", "logit_normal", "adaptive"],
+        default="uniform",
+    )
+    parser.add_argument(
+        "--time_sampler_bins", type=int, help="number of time bins to log the loss", default=10
+    )
+    parser.add_argument("--logit_normal_mean", type=float, default=0.0)
+    parser.add_argument("--logit_normal_std", type=float, default=1.0)
+
     parser.add_argument(
         "--alpha_planning_loss",
         type=float,
@@ -114,6 +189,12 @@ def get_args():
     )
 
     parser.add_argument("--use_ema", default=True, type=boolean)
+    parser.add_argument(
+        "--zero_optimizer",
+        default=False,
+        type=boolean,
+        help="shard optimizer state across ddp ranks (ZeroRedundancyOptimizer)",
+    )
 
     # Model
     parser.add_argument("--encoder_depth", type=int, help="number of encoding layers", default=3)
@@ -135,7 +216,42 @@ def get_args():
         help="number of neighbor agents to predict",
         default=32,
     )
+    # Distillation
+    parser.add_argument(
+        "--teacher_model_path",
+        type=str,
+        help="distill this checkpoint into a sampler with half the steps (progressive "
+        "distillation) instead of training from scratch",
+        default=None,
+    )
+    parser.add_argument(
+        "--teacher_args_json_path",
+        type=str,
+        help="args.json of the teacher (default: next to the checkpoint)",
+        default=None,
+    )
+    parser.add_argument(
+        "--student_steps",
+        type=int,
+        help="sampler steps of the student, the teacher takes twice as many",
+        default=None,
+    )
+    parser.add_argument(
+        "--skip_type",
+        type=str,
+        help="time grid of the DPM sampler of the student (default: that of the teacher, "
+        "or logSNR)",
+        choices=["logSNR", "time_uniform", "time_quadratic"],
+        default=None,
+    )
+
     parser.add_argument("--resume_model_path", type=str, help="path to resume model", default=None)
+    parser.add_argument(
+        "--save_every_n_steps",
+        type=int,
+        help="also save latest.pth every n steps to resume mid-epoch (0: only at epoch end)",
+        default=0,
+    )
 
     parser.add_argument("--use_wandb", default=False, type=boolean)
     parser.add_argument("--notes", default="", type=str)
@@ -146,12 +262,72 @@ def get_args():
 
     args = parser.parse_args()
 
-    args.state_normalizer = StateNormalizer.from_json(args)
-    args.observation_normalizer = ObservationNormalizer.from_json(args)
+    if args.teacher_model_path is not None:
+        set_distillation_args(args)
+    else:
+        args.state_normalizer = StateNormalizer.from_json(args)
+        args.observation_normalizer = ObservationNormalizer.from_json(args)
 
     return args
 
 
+def set_distillation_args(args):
+    """
+    The student takes the TEACHER_ARGS and the normalizers of the teacher, its sampler (saved in
+    its args.json) has `student_steps` steps.
+    """
+    if args.student_steps is None:
+        raise ValueError("--student_steps is needed with --teacher_model_path")
+    if args.teacher_args_json_path is None:
+        args.teacher_args_json_path = os.path.join(
+            os.path.dirname(args.teacher_model_path), "args.json"
+        )
+    teacher_args = openjson(args.teacher_args_json_path)
+    for key in TEACHER_ARGS:
+        if key in teacher_args:
+            setattr(args, key, teacher_args[key])
+    if args.diffusion_model_type not in ["x_start", "flow_matching"]:
+        raise ValueError(
+            f"Distillation needs x_start or flow_matching, got {args.diffusion_model_type}"
+        )
+
+    teacher_config = Config(args.teacher_args_json_path)
+    args.state_normalizer = teacher_config.state_normalizer
+    args.observation_normalizer = teacher_config.observation_normalizer
+
+    teacher_sampler = teacher_args.get("sampler", {})
+    if args.skip_type is None:
+        args.skip_type = teacher_sampler.get("skip_type") or "logSNR"
+    if teacher_sampler.get("steps", 2 * args.student_steps) != 2 * args.student_steps:
+        print(
+            f"Warning: the teacher was distilled for {teacher_sampler['steps']} steps, "
+            f"but is used with {2 * args.student_steps} steps"
+        )
+    if args.diffusion_model_type == "flow_matching":
+        args.sampler = {"solver": "euler", "steps": args.student_steps}
+    else:
+        # DDIM steps, the last one lands on the data
+        args.sampler = {
+            "solver": "dpm_multistep",
+            "steps": args.student_steps,
+            "order": 1,
+            "skip_type": args.skip_type,
+            "denoise_to_zero": False,
+        }
+
+
+def load_teacher(args, device):
+    """
+    The frozen teacher of a distillation.
+    """
+    teacher = Diffusion_Planner(Config(args.teacher_args_json_path))
+    load_planner_checkpoint(teacher, args.teacher_model_path, device=args.device)
+    teacher = teacher.to(device).eval()
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    return teacher
+
+
 def model_training(args):
     # init ddp
     global_rank, rank, _ = ddp.ddp_setup_universal(True, args)
@@ -163,9 +339,13 @@ def model_training(args):
         print("Batch size: {}".format(args.batch_size))
         print("Learning rate: {}".format(args.learning_rate))
         print("Use device: {}".format(args.device))
+        if args.teacher_model_path is not None:
+            print(
+                f"Distill {args.teacher_model_path} to {args.student_steps} steps: {args.sampler}"
+            )
 
         if args.resume_model_path is not None:
-            save_path = args.resume_model_path
+            save_path = os.path.dirname(args.resume_model_path)
         else:
             from datetime import datetime
 
@@ -198,12 +378,25 @@ def model_training(args):
 
     # set up data loaders
     aug = (
-        StatePerturbation(augment_prob=args.augment_prob, device=args.device)
-        if args.use_data_augment
+        StatePerturbation(
+            augment_prob=args.augment_prob, device=args.device, seed=args.seed + global_rank
+        )
+        if args.use_data_augment and not args.augment_in_workers
+        else None
+    )
+    sample_aug = (
+        SampleStatePerturbation(augment_prob=args.augment_prob, seed=args.seed)
+        if args.use_data_augment and args.augment_in_workers
         else None
     )
+    time_sampler = build_time_sampler(args)
+
     data_set = DiffusionPlannerData(
-        args.train_set_list, args.agent_num, args.predicted_neighbor_num, args.future_len
+        args.train_set_list,
+        args.agent_num,
+        args.predicted_neighbor_num,
+        args.future_len,
+        transform=sample_aug,
     )
 
     # prepare validation set
@@ -212,6 +405,9 @@ def model_training(args):
         valid_size = int(total_size * 0.1)
         train_size = total_size - valid_size
         train_set, valid_set = torch.utils.data.random_split(data_set, [train_size, valid_size])
+        # the validation split is not augmented
+        valid_set.dataset = copy.copy(data_set)
+        valid_set.dataset.transform = None
     else:
         train_set = data_set
         valid_set = DiffusionPlannerData(
@@ -219,16 +415,22 @@ def model_training(args):
         )
     print(f"Train set size: {len(train_set)}, Valid set size: {len(valid_set)}")
 
-    train_sampler = DistributedSampler(
+    rank_batch_size = batch_size // ddp.get_world_size()
+    # the train loader draws the base seed of its workers from this generator, seeded per epoch,
+    # instead of the global RNG: creating its iterator then does not shift the RNG states
+    # restored when resuming mid-epoch
+    loader_generator = torch.Generator()
+    train_sampler = ResumableDistributedSampler(
         train_set, num_replicas=ddp.get_world_size(), rank=global_rank, shuffle=True
     )
     train_loader = DataLoader(
         train_set,
         sampler=train_sampler,
-        batch_size=batch_size // ddp.get_world_size(),
+        batch_size=rank_batch_size,
         num_workers=args.num_workers,
         pin_memory=args.pin_mem,
         drop_last=True,
+        generator=loader_generator,
     )
     valid_sampler = DistributedSampler(
         valid_set, num_replicas=ddp.get_world_size(), rank=global_rank, shuffle=False
@@ -236,7 +438,7 @@ def model_training(args):
     valid_loader = DataLoader(
         valid_set,
         sampler=valid_sampler,
-        batch_size=batch_size // ddp.get_world_size(),
+        batch_size=rank_batch_size,
         num_workers=args.num_workers,
         pin_memory=args.pin_mem,
         drop_last=False,
@@ -249,11 +451,27 @@ def model_training(args):
         torch.distributed.barrier()
 
     # set up model
+    device = rank if args.device == "cuda" else args.device
     diffusion_planner = Diffusion_Planner(args)
-    diffusion_planner = diffusion_planner.to(rank if args.device == "cuda" else args.device)
+    loss_func = None
+    if args.teacher_model_path is not None:
+        # the student starts from the teacher
+        teacher = load_teacher(args, device)
+        diffusion_planner.load_state_dict(teacher.state_dict())
+        loss_func = partial(
+            progressive_distillation_loss_func,
+            teacher=teacher,
+            student_steps=args.student_steps,
+            skip_type=args.skip_type,
+        )
+    diffusion_planner = diffusion_planner.to(device)
 
     if args.ddp:
-        diffusion_planner = DDP(diffusion_planner, device_ids=[rank], find_unused_parameters=False)
+        diffusion_planner = DDP(
+            diffusion_planner,
+            device_ids=ddp.get_device_ids(rank, args.device),
+            find_unused_parameters=False,
+        )
 
     if args.use_ema:
         model_ema = ModelEma(
@@ -277,7 +495,13 @@ def model_training(args):
         }
     ]
 
-    optimizer = optim.AdamW(params)
+    if args.ddp and args.zero_optimizer:
+        # shard the AdamW state across ranks, the full state is only gathered to save
+        optimizer = ZeroRedundancyOptimizer(
+            params[0]["params"], optimizer_class=optim.AdamW, lr=args.learning_rate
+        )
+    else:
+        optimizer = optim.AdamW(params)
     scheduler = CosineAnnealingWarmUpRestarts(optimizer, train_epochs, args.warm_up_epoch)
 
     if args.resume_model_path is not None:
@@ -285,9 +509,67 @@ def model_training(args):
         diffusion_planner, optimizer, scheduler, init_epoch, wandb_id, model_ema = resume_model(
             args.resume_model_path, diffusion_planner, optimizer, scheduler, model_ema, args.device
         )
+        train_state = resume_train_state(args.resume_model_path, global_rank)
     else:
         init_epoch = 0
         wandb_id = None
+        train_state = None
+
+    def set_epoch(epoch):
+        train_sampler.set_epoch(epoch)
+        if sample_aug is not None:
+            sample_aug.set_epoch(epoch)
+        loader_generator.manual_seed(args.seed + epoch * ddp.get_world_size() + global_rank)
+
+    # restore the position in the (possibly partially trained) epoch
+    set_epoch(init_epoch)
+    start_step = 0
+    if train_state is not None:
+        start_step = train_state["step"]
+        train_sampler.set_start_index(train_state["sampler"]["start_index"])
+        rank_states = train_state["rank_states"]
+        if global_rank < len(rank_states):
+            if aug is not None:
+                aug.load_state_dict(rank_states[global_rank]["aug"])
+            if "time_sampler" in rank_states[global_rank]:
+                time_sampler.load_state_dict(rank_states[global_rank]["time_sampler"])
+        print(f"Resume from epoch {init_epoch + 1}, step {start_step}")
+
+    steps_per_epoch = train_sampler.num_samples // rank_batch_size
+
+    def get_train_state(epoch, step):
+        # must be called on all ranks, RNG states are gathered per rank
+        rank_state = {
+            "rng": get_rng_state(),
+            "aug": aug.state_dict() if aug is not None else None,
+            "time_sampler": time_sampler.state_dict(),
+        }
+        return {
+            "step": step,
+            "sampler": {"epoch": epoch, "start_index": step * rank_batch_size},
+            "rank_states": ddp.all_gather_object(rank_state),
+        }
+
+    def save_step_checkpoint(step, loss):
+        if args.save_every_n_steps <= 0 or step % args.save_every_n_steps != 0:
+            return
+        if step >= steps_per_epoch:
+            # the end of epoch is saved after validation
+            return
+        train_state = get_train_state(epoch, step)
+        ddp.consolidate_optimizer_state(optimizer)
+        if global_rank == 0:
+            save_model(
+                diffusion_planner,
+                optimizer,
+                scheduler,
+                save_path,
+                epoch,
+                loss,
+                wandb_id,
+                model_ema.ema,
+                train_state,
+            )
 
     # logger
     if global_rank == 0:
@@ -310,14 +592,29 @@ def model_training(args):
         if global_rank == 0:
             print(f"Epoch {epoch + 1}/{train_epochs}")
         train_loss, train_total_loss = train_epoch(
-            train_loader, diffusion_planner, optimizer, args, model_ema, aug
+            train_loader,
+            diffusion_planner,
+            optimizer,
+            args,
+            model_ema,
+            aug,
+            start_step=start_step,
+            step_callback=save_step_checkpoint,
+            # the distillation loss draws the steps of the student grid instead
+            time_sampler=time_sampler if loss_func is None else None,
+            loss_func=loss_func,
         )
+        start_step = 0
 
         valid_dict = validate_model(diffusion_planner, valid_loader, args)
         valid_loss_ego = valid_dict["avg_loss_ego"]
         valid_loss_neighbor = valid_dict["avg_loss_neighbor"]
         print(f"{valid_loss_ego=:.3f}, {valid_loss_neighbor=:.3f}")
 
+        if (epoch + 1) % save_utd == 0:
+            train_state = get_train_state(epoch + 1, 0)
+            ddp.consolidate_optimizer_state(optimizer)
+
         if global_rank == 0:
             lr_dict = {"lr": optimizer.param_groups[0]["lr"]}
             wandb.log(
@@ -341,11 +638,12 @@ def model_training(args):
                     train_total_loss,
                     wandb_id,
                     model_ema.ema,
+                    train_state,
                 )
                 print(f"Model saved in {save_path}\n")
 
         scheduler.step()
-        train_sampler.set_epoch(epoch + 1)
+        set_epoch(epoch + 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+"""This script measures the throughput and latency of the batched inference service.
+
+Each of `num_clients` processes sends `num_requests` batch-size-1 requests one after another,
+like a simulation worker does. `--max_batch_size 1` gives the unbatched baseline.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from diffusion_planner.model.diffusion_planner import Diffusion_Planner
+from diffusion_planner.planner.inference_service import InferenceClient, InferenceServer
+from diffusion_planner.utils.config import Config
+from diffusion_planner.utils.train_utils import load_planner_checkpoint
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_json_path", type=Path)
+    parser.add_argument("--ckpt_path", type=Path, default=None)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--num_clients", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--max_batch_size", type=int, nargs="+", default=[1, 32])
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    parser.add_argument("--num_requests", type=int, default=50)
+    return parser.parse_args()
+
+
+def make_inputs():
+    return {
+        "ego_current_state": torch.zeros((1, 10)),
+        "neighbor_agents_past": torch.zeros((1, 32, 21, 11)),
+        "lanes": torch.zeros((1, 70, 20, 12)),
+        "lanes_speed_limit": torch.zeros((1, 70, 1)),
+        "lanes_has_speed_limit": torch.zeros((1, 70, 1), dtype=torch.bool),
+        "route_lanes": torch.zeros((1, 25, 20, 12)),
+        "route_lanes_speed_limit": torch.zeros((1, 25, 1)),
+        "route_lanes_has_speed_limit": torch.zeros((1, 25, 1), dtype=torch.bool),
+        "static_objects": torch.zeros((1, 5, 10)),
+    }
+
+
+def run_client(address, num_requests, start_event, result_queue):
+    client = InferenceClient(address)
+    inputs = make_inputs()
+    client.predict(inputs)  # warm up the connection
+    start_event.wait()
+
+    latencies = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        client.predict(inputs)
+        latencies.append(time.perf_counter() - start)
+    client.close()
+    result_queue.put(latencies)
+
+
+def benchmark(model, device, num_clients, max_batch_size, max_wait_ms, num_requests):
+    address = os.path.join(tempfile.mkdtemp(), "diffusion_planner.sock")
+    server = InferenceServer(
+        model, address, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, device=device
+    )
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    while not os.path.exists(address):
+        time.sleep(0.01)
+
+    ctx = mp.get_context("spawn")
+    start_event = ctx.Event()
+    result_queue = ctx.Queue()
+    clients = [
+        ctx.Process(target=run_client, args=(address, num_requests, start_event, result_queue))
+        for _ in range(num_clients)
+    ]
+    for client in clients:
+        client.start()
+    # wait until all clients are connected and warmed up
+    while sum(server.batch_sizes) < num_clients:
+        time.sleep(0.01)
+    server.batch_sizes.clear()
+
+    start = time.perf_counter()
+    start_event.set()
+    latencies = [result_queue.get() for _ in clients]
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.join()
+    server.shutdown()
+    server_thread.join()
+
+    latencies = np.array(latencies).reshape(-1) * 1000
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50": np.percentile(latencies, 50),
+        "p99": np.percentile(latencies, 99),
+        "mean_batch": np.mean(server.batch_sizes),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    model = Diffusion_Planner(Config(args.config_json_path))
+    if args.ckpt_path is not None:
+        load_planner_checkpoint(model, args.ckpt_path, device=args.device)
+    model.eval()
+    model = model.to(args.device)
+
+    print("num_clients,max_batch_size,throughput[req/s],p50[ms],p99[ms],mean_batch_size")
+    for max_batch_size in args.max_batch_size:
+        for num_clients in args.num_clients:
+            result = benchmark(
+                model,
+                args.device,
+                num_clients,
+                max_batch_size,
+                args.max_wait_ms,
+                args.num_requests,
+            )
+            print(
+                f"{num_clients},{max_batch_size},{result['throughput']:.1f},"
+                f"{result['p50']:.2f},{result['p99']:.2f},{result['mean_batch']:.2f}"
+            )
@@ -0,0 +1,181 @@
+"""This script sweeps the sampler settings and reports decoder latency against open-loop error.
+
+Every combination of --solvers, --steps, --orders and --skip_types (and --guidance_scales with
+--guidance, --early_exit_tols with --early_exit, and --tols for the adaptive flow matching solvers)
+valid for the model type is run on the same validation batches with the same noise. The errors are
+those of the ego plan: ADE / FDE [m] and the final heading error [rad], with the mean number of
+solver steps run (and of model evaluations for the adaptive solvers).
+"""
+
+import argparse
+import itertools
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from diffusion_planner.model.diffusion_planner import Diffusion_Planner
+from diffusion_planner.model.flow_matching_utils.ode_solver import ADAPTIVE_ODE_SOLVERS, ODE_SOLVERS
+from diffusion_planner.utils.config import Config
+from diffusion_planner.utils.dataset import DiffusionPlannerData
+from diffusion_planner.utils.train_utils import load_planner_checkpoint
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_json_path", type=Path)
+    parser.add_argument("ckpt_path", type=Path)
+    parser.add_argument("valid_set_list", type=Path)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_samples", type=int, default=1024, help="validation samples used")
+    parser.add_argument(
+        "--solvers",
+        type=str,
+        nargs="+",
+        default=["dpm_multistep", "dpm_singlestep", "unipc", "euler", "heun", "rk4", "bosh3"],
+    )
+    parser.add_argument("--steps", type=int, nargs="+", default=[3, 4, 5, 6, 8, 10])
+    parser.add_argument("--orders", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--skip_types", type=str, nargs="+", default=["logSNR", "time_uniform"])
+    parser.add_argument("--guidance", action="store_true", help="use the GuidanceWrapper")
+    parser.add_argument("--guidance_scales", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--early_exit", type=str, choices=["ego", "all"], default=None)
+    parser.add_argument("--early_exit_tols", type=float, nargs="+", default=[0.05])
+    parser.add_argument("--tols", type=float, nargs="+", default=[1e-2], help="adaptive solvers")
+    parser.add_argument("--disable_ema", action="store_false", dest="enable_ema")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def load_batches(config, args):
+    data_set = DiffusionPlannerData(
+        args.valid_set_list, config.agent_num, config.predicted_neighbor_num, config.future_len
+    )
+    indices = np.random.default_rng(args.seed).permutation(len(data_set))[: args.num_samples]
+    loader = DataLoader(Subset(data_set, indices), batch_size=args.batch_size, shuffle=False)
+
+    batches = []
+    for batch in loader:
+        inputs = {
+            "ego_current_state": batch[0],
+            "neighbor_agents_past": batch[2],
+            "lanes": batch[4],
+            "lanes_speed_limit": batch[5],
+            "lanes_has_speed_limit": batch[6],
+            "route_lanes": batch[7],
+            "route_lanes_speed_limit": batch[8],
+            "route_lanes_has_speed_limit": batch[9],
+            "static_objects": batch[10],
+        }
+        inputs = config.observation_normalizer({k: v.to(args.device) for k, v in inputs.items()})
+        batches.append((inputs, batch[1].to(args.device)))  # ego_future_gt [B, T, 3]
+    return batches
+
+
+def sampler_settings(model_type, args):
+    """
+    Valid combinations for the model type, parameters the solver ignores are not swept.
+    """
+    settings = []
+    for solver in args.solvers:
+        if (model_type == "flow_matching") != (solver in ODE_SOLVERS):
+            continue
+        orders = [None] if model_type == "flow_matching" else args.orders
+        skip_types = [None] if model_type == "flow_matching" else args.skip_types
+        guidance_scales = args.guidance_scales if args.guidance else [None]
+        early_exit = args.early_exit is not None and solver in ["dpm_multistep", "unipc"]
+        early_exit_tols = args.early_exit_tols if early_exit else [None]
+        tols = args.tols if solver in ADAPTIVE_ODE_SOLVERS else [None]
+        for steps, order, skip_type, guidance_scale, early_exit_tol, tol in itertools.product(
+            args.steps, orders, skip_types, guidance_scales, early_exit_tols, tols
+        ):
+            if order is not None and steps < order:
+                continue
+            settings.append(
+                {
+                    "solver": solver,
+                    "steps": steps,
+                    "order": order,
+                    "skip_type": skip_type,
+                    "guidance_scale": guidance_scale,
+                    "early_exit": args.early_exit if early_exit else None,
+                    "early_exit_tol": early_exit_tol,
+                    "tol": tol,
+                }
+            )
+    return settings
+
+
+def evaluate(model, batches, device, seed):
+    latencies, steps, nfe = [], [], []
+    ade, fde, heading_error = [], [], []
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        for inputs, ego_future in batches:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            _, outputs = model(inputs)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start)
+            steps.append(outputs.get("sampler_steps", model.decoder.decoder.sampler["steps"]))
+            nfe.append(outputs.get("sampler_nfe", np.nan))
+
+            prediction = outputs["prediction"][:, 0]  # [B, T, 4]
+            distance = torch.norm(prediction[..., :2] - ego_future[..., :2], dim=-1)  # [B, T]
+            ade.append(distance.mean(dim=-1))
+            fde.append(distance[:, -1])
+            heading = torch.atan2(prediction[:, -1, 3], prediction[:, -1, 2])
+            diff = torch.remainder(heading - ego_future[:, -1, 2] + np.pi, 2 * np.pi) - np.pi
+            heading_error.append(diff.abs())
+
+    latencies = np.array(latencies[1:] if len(latencies) > 1 else latencies) * 1000  # warm-up
+    return {
+        "latency": np.mean(latencies),
+        "steps": np.mean(steps),
+        "nfe": np.mean(nfe),
+        "ade": torch.cat(ade).mean().item(),
+        "fde": torch.cat(fde).mean().item(),
+        "heading": torch.cat(heading_error).mean().item(),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    guidance_fn = None
+    if args.guidance:
+        from diffusion_planner.model.guidance.guidance_wrapper import GuidanceWrapper
+
+        guidance_fn = GuidanceWrapper()
+    config = Config(args.config_json_path, guidance_fn=guidance_fn)
+
+    model = Diffusion_Planner(config)
+    load_planner_checkpoint(model, args.ckpt_path, args.enable_ema, args.device)
+    model.eval()
+    model = model.to(args.device)
+    decoder = model.decoder.decoder
+
+    batches = load_batches(config, args)
+    print(f"{sum(len(b[1]) for b in batches)} samples, batch size {args.batch_size}")
+
+    print(
+        "solver,steps,order,skip_type,guidance_scale,early_exit_tol,tol,steps_run,nfe,latency[ms],"
+        "ade[m],fde[m],heading[rad]"
+    )
+    for setting in sampler_settings(config.diffusion_model_type, args):
+        decoder.sampler = setting
+        result = evaluate(model, batches, args.device, args.seed)
+        s = decoder.sampler
+        nfe = "-" if np.isnan(result["nfe"]) else f"{result['nfe']:.2f}"
+        print(
+            f"{s['solver']},{s['steps']},{setting['order'] or '-'},{setting['skip_type'] or '-'},"
+            f"{setting['guidance_scale'] if args.guidance else '-'},"
+            f"{setting['early_exit_tol'] or '-'},{setting['tol'] or '-'},{result['steps']:.2f},"
+            f"{nfe},"
+            f"{result['latency']:.2f},{result['ade']:.4f},{result['fde']:.4f},{result['heading']:.4f}"
+        )
@@ -0,0 +1,100 @@
+"""This script checks that SampleStatePerturbation (per-sample NumPy, DataLoader workers) matches
+the batched torch StatePerturbation on the same random draws.
+"""
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+
+from diffusion_planner.utils.data_augmentation import SampleStatePerturbation, StatePerturbation
+from diffusion_planner.utils.dataset import DiffusionPlannerData
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("train_set_list", type=Path)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--augment_prob", type=float, default=0.5)
+    parser.add_argument("--agent_num", type=int, default=32)
+    parser.add_argument("--predicted_neighbor_num", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    return parser.parse_args()
+
+
+def angle_diff(a, b):
+    diff = np.abs(a - b) % (2 * np.pi)
+    return np.minimum(diff, 2 * np.pi - diff)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    data_set = DiffusionPlannerData(
+        args.train_set_list, args.agent_num, args.predicted_neighbor_num, future_len=80
+    )
+    keys = [
+        "ego_current_state",
+        "ego_future_gt",
+        "neighbor_agents_past",
+        "neighbors_future_gt",
+        "lanes",
+        "lanes_speed_limit",
+        "lanes_has_speed_limit",
+        "route_lanes",
+        "route_lanes_speed_limit",
+        "route_lanes_has_speed_limit",
+        "static_objects",
+    ]
+    indices = np.random.default_rng(args.seed).choice(
+        len(data_set), min(args.batch_size, len(data_set)), replace=False
+    )
+    samples = [dict(zip(keys, data_set[i])) for i in indices]
+    B = len(samples)
+
+    # batched torch version
+    torch_aug = StatePerturbation(augment_prob=args.augment_prob, seed=args.seed)
+    batch = default_collate(samples)
+    batch = {k: v.float() if v.is_floating_point() else v for k, v in batch.items()}
+    inputs = {k: v for k, v in batch.items() if k not in ["ego_future_gt", "neighbors_future_gt"]}
+
+    # the random draws StatePerturbation.augment is going to make
+    generator_state = torch_aug.state_dict()
+    flag_random = torch.rand(B, generator=torch_aug._generator).double().numpy()
+    noise_random = torch.rand(B, 9, generator=torch_aug._generator).double().numpy()
+    torch_aug.load_state_dict(generator_state)
+
+    inputs, ego_future, neighbors_future = torch_aug(
+        inputs, batch["ego_future_gt"], batch["neighbors_future_gt"]
+    )
+    expected = {
+        **{k: v.numpy() for k, v in inputs.items()},
+        "ego_future_gt": ego_future.numpy(),
+        "neighbors_future_gt": neighbors_future.numpy(),
+    }
+
+    # per-sample NumPy version
+    sample_aug = SampleStatePerturbation(augment_prob=args.augment_prob)
+    actual = [
+        sample_aug.perturb(
+            {k: v.copy() for k, v in sample.items()}, flag_random[i], noise_random[i]
+        )
+        for i, sample in enumerate(samples)
+    ]
+    actual = {k: np.stack([sample[k] for sample in actual]) for k in keys}
+
+    print(f"Augmented {int((flag_random >= args.augment_prob).sum())} / {B} samples")
+    ok = True
+    for key in keys:
+        diff = np.abs(actual[key].astype(np.float64) - expected[key].astype(np.float64))
+        if key in ["ego_future_gt", "neighbors_future_gt"]:
+            diff[..., 2] = angle_diff(actual[key][..., 2], expected[key][..., 2])
+        max_diff = diff.max() if diff.size > 0 else 0.0
+        ok &= bool(max_diff <= args.atol)
+        print(f"{key}: max abs diff = {max_diff:.3e}")
+
+    print("OK" if ok else f"NG (atol={args.atol})")
+    exit(0 if ok else 1)
@@ -0,0 +1,76 @@
+"""This script compares the DPM solvers on a Gaussian mixture, whose data prediction is exact.
+
+The error is the mean absolute difference to a 500-step DPM-Solver++(3M) solution from the same
+noise, with the number of function evaluations (NFE) in parentheses.
+"""
+
+import argparse
+
+import torch
+
+import diffusion_planner.model.diffusion_utils.dpm_solver_pytorch as dpm
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, nargs="+", default=[3, 4, 5, 6, 8, 10, 20])
+    parser.add_argument("--skip_type", type=str, default="logSNR")
+    parser.add_argument("--variance", type=float, default=0.3, help="of the mixture components")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def gaussian_mixture_model(noise_schedule, means, variance):
+    """
+    Exact E[x_0 | x_t] of the equally weighted mixture of N(means[k], variance * I).
+    """
+
+    def model(x, t):
+        alpha = noise_schedule.marginal_alpha(t)[:, None, None, None]
+        sigma = noise_schedule.marginal_std(t)[:, None, None, None]
+        var_t = alpha**2 * variance + sigma**2
+        diff = x[:, :, None, :] - alpha * means  # [B, N, K, D]
+        weight = torch.softmax(-(diff**2).sum(dim=-1, keepdim=True) / (2 * var_t), dim=2)
+        posterior_mean = means + (alpha * variance / var_t) * diff
+        return (weight * posterior_mean).sum(dim=2)
+
+    return model
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.set_default_dtype(torch.float64)
+    generator = torch.Generator().manual_seed(args.seed)
+
+    noise_schedule = dpm.NoiseScheduleVP()
+    means = torch.tensor([[-2.0, 1.0], [1.5, -0.5], [0.5, 2.0]])
+    model_fn = dpm.model_wrapper(
+        gaussian_mixture_model(noise_schedule, means, args.variance),
+        noise_schedule,
+        model_type="x_start",
+    )
+    nfe = [0]
+
+    def counted_model_fn(x, t):
+        nfe[0] += 1
+        return model_fn(x, t)
+
+    x_T = torch.randn(4, 256, 2, generator=generator)
+    reference = dpm.DPM_Solver(model_fn, noise_schedule).sample(
+        x_T, steps=500, order=3, skip_type=args.skip_type, method="multistep"
+    )
+
+    for method in ["multistep", "singlestep", "unipc"]:
+        for order in [1, 2, 3]:
+            if method == "unipc" and order == 1:
+                continue  # same as multistep DPM-Solver-1 with the corrector
+            row = []
+            for steps in args.steps:
+                if steps < order:
+                    continue
+                nfe[0] = 0
+                x = dpm.DPM_Solver(counted_model_fn, noise_schedule).sample(
+                    x_T, steps=steps, order=order, skip_type=args.skip_type, method=method
+                )
+                row.append(f"{steps}:{(x - reference).abs().mean():.4f}({nfe[0]})")
+            print(f"{method:<10} order {order}: " + " ".join(row))